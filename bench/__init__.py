@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+
+from sa_bitcoin.core import Chain
+
+def make_chain():
+    "Returns a throwaway mainnet-like `Chain` for benchmark fixtures."
+    return Chain(magic=b'\xf9\xbe\xb4\xd9', port=8333, genesis=b'\0'*80,
+        genesis_hash=0, pubkey_hash_prefix=0, script_hash_prefix=5,
+        secret_prefix=128, is_testnet=False)
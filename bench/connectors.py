@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+"""Runs several connectors against one database at once, each in its own
+thread with its own session. Every connector ingests the same trunk of
+blocks, which exercises connectors racing to store the same block, and then
+a branch of its own forking from the trunk's tip. Checks that every block
+was stored and connected exactly once, and reports the elapsed time.
+
+    python -m bench.connectors [workers] [trunk] [branch] [url]
+
+The database defaults to a temporary SQLite file; pass the URL of an empty
+PostgreSQL database to exercise the advisory locks.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from sqlalchemy import create_engine, func, orm
+
+from bitcoin import core
+from bitcoin.script import Script
+
+from sa_bitcoin import Base, ingest
+from sa_bitcoin.core import Block, Chain, ConnectedBlockInfo, Input, \
+    Output, Transaction
+
+from . import make_chain
+
+BATCH_SIZE = 5
+
+def make_blocks(chain_id, parent, first, count, tag):
+    # Transactions refer to the chain by id, so that those of blocks which
+    # another connector has stored are never added to the session.
+    blocks = []
+    for height in xrange(first, first + count):
+        block = core.Block(parent_hash=parent, time=1231006505+height,
+            nonce=hash((tag, height)) & 0xffffffff)
+        block.transactions = [Transaction(chain_id=chain_id, format=0,
+            version=1, lock_time=0, reference_height=0,
+            inputs=[Input(endorsement=Script('\x08%s:%04d' % (tag, height)),
+                sequence=0)],
+            outputs=[Output(amount=50, contract=Script('\x51'))])]
+        blocks.append(block)
+        parent = block.hash
+    return blocks
+
+def connector(Session, chain_id, worker, trunk, branch, errors):
+    session = Session()
+    try:
+        chain = session.query(Chain).get(chain_id)
+        blocks = make_blocks(chain_id, 0, 0, trunk, 'trunk')
+        blocks += make_blocks(chain_id, blocks[-1].hash, trunk, branch,
+            'w%d' % worker)
+        for offset in xrange(0, len(blocks), BATCH_SIZE):
+            ingest.ingest_blocks(session, chain,
+                blocks[offset:offset+BATCH_SIZE])
+            session.commit()
+    except Exception as e:
+        session.rollback()
+        errors.append((worker, e))
+    finally:
+        session.close()
+
+def main(workers=4, trunk=20, branch=20, url=None):
+    directory = None
+    if url is None:
+        directory = tempfile.mkdtemp()
+        url = 'sqlite:///' + os.path.join(directory, 'connectors.db')
+    try:
+        engine = create_engine(url, connect_args=
+            {'timeout': 60} if url.startswith('sqlite') else {})
+        Base.metadata.create_all(engine)
+        Session = orm.sessionmaker(bind=engine)
+        session = Session()
+        chain = make_chain()
+        session.add(chain)
+        session.commit()
+        chain_id = chain.id
+
+        errors = []
+        threads = [threading.Thread(target=connector,
+            args=(Session, chain_id, worker, trunk, branch, errors))
+            for worker in xrange(workers)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+
+        expected = trunk + workers * branch
+        blocks = session.query(func.count(Block.id)).scalar()
+        infos = session.query(func.count(ConnectedBlockInfo.block_id)).scalar()
+        top = session.query(func.max(ConnectedBlockInfo.height)).scalar()
+        print '%d connectors, %d blocks in %.2fs' % (workers, blocks, elapsed)
+        for worker, error in errors:
+            print 'connector %d failed: %r' % (worker, error)
+        ok = (not errors and blocks == infos == expected and
+              top == trunk + branch - 1)
+        print 'ok' if ok else 'FAILED: expected %d blocks, height %d' % (
+            expected, trunk + branch - 1)
+        return ok
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    ok = main(*(map(int, args[:3]) + args[3:]))
+    sys.exit(0 if ok else 1)
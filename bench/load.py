@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+
+"""Replays a mix of operations against one database from several concurrent
+workers, on a synthetic chain of pay-to-pubkey-hash transactions, and
+reports the throughput and the p50/p99/p999 latencies of each kind of
+operation:
+
+    ingest    connect the next block of the chain
+    explorer  load a block at a random height, with its transactions
+    address   list the unspent outputs of a random address
+    proof     prove a random txid present in a `TxIdIndex`: walk its path
+              from the root, collecting the digest of each node, and verify
+              the proof against the root hash
+
+Each worker draws operations at random in proportion to their weights, and
+runs each in a session of its own. Blocks must be connected in order, so
+ingest operations run one at a time; their latency includes waiting for
+the one before.
+
+    python -m bench.load [workers] [seconds] [mix] [blocks] [url]
+
+The mix is a comma-separated list of name=weight pairs, by default
+`ingest=1,explorer=10,address=5,proof=5`. The database defaults to a
+temporary SQLite file; pass the URL of an empty database to load another.
+"""
+
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from sqlalchemy import create_engine, func, orm, select
+
+from bitcoin import core
+from bitcoin.base58 import VersionedPayload
+from bitcoin.hash import hash256
+from bitcoin.script import Script
+
+from sa_bitcoin import Base, configure, ingest, query
+from sa_bitcoin.core import Chain, Input, Output, Transaction
+from sa_bitcoin.ledger import TxIdIndex
+from sa_bitcoin.indexfile import verify_proof
+from sa_bitcoin.patricia import PatriciaNode, build_tree, node_digest, \
+    node_flags
+
+from . import make_chain
+
+MIX = 'ingest=1,explorer=10,address=5,proof=5'
+
+# The shape of the synthetic chain: each block has a coinbase with one
+# output per other transaction, each of which spends one of the outputs of
+# the previous block's coinbase and pays two addresses of the pool.
+TRANSACTIONS = 10
+ADDRESSES = 1000
+
+class ChainBuilder(object):
+    "Generates the blocks of the synthetic chain, in order."
+    def __init__(self, chain_id, seed=0):
+        self.chain_id, self.random = chain_id, random.Random(seed)
+        self.hashes = [os.urandom(20) for n in xrange(ADDRESSES)]
+        self.height, self.parent, self.coinbase = 0, 0, None
+        self.txids = []
+
+    def address(self, n):
+        return VersionedPayload(self.hashes[n], version=0).encode('base58')
+
+    def _output(self, amount):
+        hash = self.random.choice(self.hashes)
+        return Output(amount=amount,
+            contract=Script('\x76\xa9\x14' + hash + '\x88\xac'))
+
+    def _transaction(self, inputs, outputs):
+        # Transactions refer to the chain by id, so that they are not added to
+        # any session before they are ingested.
+        return Transaction(chain_id=self.chain_id, format=0, version=1,
+            lock_time=0, reference_height=0, inputs=inputs, outputs=outputs)
+
+    def next_block(self):
+        """Returns the block following the last one passed to `advance()`.
+        The builder stays where it is, so that a block which fails to be
+        stored is replaced by another at the same height."""
+        coinbase = self._transaction(
+            [Input(endorsement=Script('\x04' + str(self.height).zfill(4)),
+                   sequence=0)],
+            [self._output(5000) for n in xrange(TRANSACTIONS - 1)])
+        transactions = [coinbase]
+        if self.coinbase is not None:
+            transactions.extend(self._transaction(
+                [Input(hash=self.coinbase, index=n,
+                       endorsement=Script('\x51'), sequence=0)],
+                [self._output(2000), self._output(2999)])
+                for n in xrange(TRANSACTIONS - 1))
+        block = core.Block(parent_hash=self.parent,
+            time=1231006505 + 600*self.height, nonce=self.height)
+        block.transactions = transactions
+        return block
+
+    def advance(self, block):
+        "Moves past a block returned by `next_block()`, once it is stored."
+        self.txids.extend(tx.hash for tx in block.transactions)
+        self.height, self.parent, self.coinbase = \
+            self.height + 1, block.hash, block.transactions[0].hash
+
+def prove(session, root_id, key, node_class=TxIdIndex):
+    """Returns a proof of `key` in the persisted tree rooted at `root_id`, as
+    `IndexFile.proof()` does, reading the nodes on the path one at a time
+    with the hashes of their children."""
+    node = PatriciaNode.__table__
+    left, right = node.alias(), node.alias()
+    query = (select([node,
+            func.coalesce(node.c.left_hash, left.c.hash).label('left_child'),
+            func.coalesce(node.c.right_hash, right.c.hash)
+                .label('right_child')])
+        .select_from(node
+            .outerjoin(left, left.c.id == node.c.left_node_id)
+            .outerjoin(right, right.c.id == node.c.right_node_id)))
+    subkey, node_id, proof = node_class._prepare_key(key), root_id, []
+    while node_id is not None:
+        row = session.execute(query.where(node.c.id == node_id)).first()
+        branches = [(prefix, child_id, hash_)
+            for prefix, child_id, hash_ in (
+                (row.left_prefix,  row.left_node_id,  row.left_child),
+                (row.right_prefix, row.right_node_id, row.right_child))
+            if prefix is not None]
+        proof.append(node_digest(node_flags(row),
+            [(prefix, hash_) for prefix, child_id, hash_ in branches],
+            row.value))
+        node_id = None
+        for prefix, child_id, hash_ in len(subkey) and branches or ():
+            if subkey.startswith(prefix):
+                subkey, node_id = subkey[len(prefix):], child_id
+                break
+    return proof
+
+class Workload(object):
+    """The operations of the mix, each a method taking a session and a
+    random number generator."""
+    def __init__(self, Session, chain_id, builder, root_id, root_hash):
+        self.Session, self.chain_id = Session, chain_id
+        self.builder, self.root_id = builder, root_id
+        self.root_hash = root_hash
+        self.height = builder.height
+        self.txids = list(builder.txids)
+        self._ingest = threading.Lock()
+
+    def ingest(self, session, rng):
+        with self._ingest:
+            chain = session.query(Chain).get(self.chain_id)
+            block = self.builder.next_block()
+            ingest.ingest_blocks(session, chain, [block])
+            session.commit()
+            self.builder.advance(block)
+            self.height = self.builder.height
+
+    def explorer(self, session, rng):
+        chain = session.query(Chain).get(self.chain_id)
+        block = query.blocks_at_height(session, chain,
+            rng.randrange(self.height)).first()
+        for tx in block.transactions:
+            sum(output.amount for output in tx.outputs)
+
+    def address(self, session, rng):
+        chain = session.query(Chain).get(self.chain_id)
+        query.outputs_by_address(session, chain,
+            self.builder.address(rng.randrange(ADDRESSES)),
+            unspent=True).all()
+
+    def proof(self, session, rng):
+        key = hash256.serialize(rng.choice(self.txids))
+        proof = prove(session, self.root_id, key)
+        assert verify_proof(self.root_hash, key, proof, TxIdIndex) is not None
+
+def percentile(latencies, fraction):
+    "The nearest-rank percentile of a sorted list."
+    rank = int(math.ceil(fraction * len(latencies)))
+    return latencies[max(0, min(len(latencies), rank) - 1)]
+
+def worker(workload, operations, weights, deadline, seed, results):
+    rng = random.Random(seed)
+    total = sum(weights)
+    while time.time() < deadline:
+        pick, name = rng.uniform(0, total), operations[-1]
+        for operation, weight in zip(operations, weights):
+            if pick < weight:
+                name = operation
+                break
+            pick -= weight
+        session = workload.Session()
+        start = time.time()
+        try:
+            getattr(workload, name)(session, rng)
+        except Exception:
+            session.rollback()
+            results[name][1] += 1
+        else:
+            results[name][0].append(time.time() - start)
+        finally:
+            session.close()
+
+def setup(Session, blocks):
+    "Stores the synthetic chain and the `TxIdIndex` of its transactions."
+    session = Session()
+    chain = make_chain()
+    session.add(chain)
+    session.commit()
+    builder = ChainBuilder(chain.id)
+    for offset in xrange(0, blocks, 50):
+        batch = []
+        for n in xrange(min(50, blocks - offset)):
+            batch.append(builder.next_block())
+            builder.advance(batch[-1])
+        ingest.ingest_blocks(session, chain, batch)
+        session.commit()
+    root_id = build_tree(session, TxIdIndex,
+        sorted((hash256.serialize(txid), '\x00') for txid in builder.txids))
+    session.commit()
+    root_hash = session.query(PatriciaNode).get(root_id).hash
+    session.close()
+    return Workload(Session, builder.chain_id, builder, root_id, root_hash)
+
+def main(workers=4, seconds=10, mix=MIX, blocks=200, url=None):
+    configure()
+    operations, weights = zip(*((name, float(weight))
+        for name, weight in (pair.split('=') for pair in mix.split(','))))
+    directory = None
+    if url is None:
+        directory = tempfile.mkdtemp()
+        url = 'sqlite:///' + os.path.join(directory, 'load.db')
+    try:
+        engine = create_engine(url, connect_args=
+            {'timeout': 60} if url.startswith('sqlite') else {})
+        Base.metadata.create_all(engine)
+        workload = setup(orm.sessionmaker(bind=engine), blocks)
+
+        # Each worker has results of its own, as {operation: [latencies,
+        # errors]}, merged once all have finished.
+        results = [dict((name, [[], 0]) for name in operations)
+                   for n in xrange(workers)]
+        deadline = time.time() + seconds
+        threads = [threading.Thread(target=worker, args=(workload,
+            operations, weights, deadline, n, results[n]))
+            for n in xrange(workers)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+
+        print '%d workers, %.1fs, %d blocks at start' % (
+            workers, elapsed, blocks)
+        print '%-10s %8s %8s %9s %9s %9s %7s' % (
+            'operation', 'count', 'ops/s', 'p50 ms', 'p99 ms', 'p999 ms',
+            'errors')
+        for name in operations:
+            latencies = sorted(latency
+                for result in results for latency in result[name][0])
+            errors = sum(result[name][1] for result in results)
+            if not latencies:
+                print '%-10s %8d %8s %9s %9s %9s %7d' % (
+                    name, 0, '-', '-', '-', '-', errors)
+                continue
+            print '%-10s %8d %8.1f %9.2f %9.2f %9.2f %7d' % (
+                name, len(latencies), len(latencies) / elapsed,
+                1000 * percentile(latencies, 0.5),
+                1000 * percentile(latencies, 0.99),
+                1000 * percentile(latencies, 0.999), errors)
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(*(map(int, args[:2]) + args[2:3] + map(int, args[3:4]) + args[4:]))
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+"""Compares the per-call cost of the `query` helpers, which build and compile
+a new query each time, with the precompiled lookups of `lookup`, on a chain
+of small blocks, and prints the lookups' call and cache hit/miss counts.
+
+    python -m bench.lookup [blocks] [calls]
+"""
+
+import sys
+import timeit
+
+from sqlalchemy import create_engine, orm
+
+from bitcoin import core
+from bitcoin.script import Script
+
+from sa_bitcoin import Base, configure, ingest, lookup, query
+from sa_bitcoin.core import Chain, Input, Output, Transaction
+
+def make_chain(session, count):
+    chain = Chain(magic='\xf9\xbe\xb4\xd9', port=8333, genesis='\x00'*80,
+        genesis_hash=1, pubkey_hash_prefix=0, script_hash_prefix=5,
+        secret_prefix=128, is_testnet=False)
+    session.add(chain)
+    session.flush()
+    blocks, parent = [], 0
+    for height in xrange(count):
+        block = core.Block(parent_hash=parent, time=1231006505+height,
+            nonce=height)
+        block.transactions = [Transaction(chain=chain, format=0, version=1,
+            lock_time=0, reference_height=0,
+            inputs=[Input(endorsement=Script('\x04' + str(height).zfill(4)),
+                sequence=0)],
+            outputs=[Output(amount=50, contract=Script('\x51'))])]
+        blocks.append(block)
+        parent = block.hash
+    ingest.ingest_blocks(session, chain, blocks)
+    session.commit()
+    return chain, blocks
+
+def main(count=100, calls=1000):
+    configure()
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    session = orm.sessionmaker(bind=engine)()
+    chain, blocks = make_chain(session, count)
+    hashes = [block.hash for block in blocks]
+    txids = [block.transactions[0].hash for block in blocks]
+
+    cases = [
+        ('block_by_hash',
+            lambda n: query.block_by_hash(session, chain, hashes[n]).first(),
+            lambda n: lookup.block_by_hash(session, chain, hashes[n])),
+        ('transaction_by_hash',
+            lambda n: query.transaction_by_hash(session, chain,
+                txids[n]).first(),
+            lambda n: lookup.transaction_by_hash(session, chain, txids[n])),
+        ('output_by_outpoint',
+            lambda n: query.transaction_by_hash(session, chain,
+                txids[n]).first().outputs[0],
+            lambda n: lookup.output_by_outpoint(session, chain, txids[n], 0)),
+        ('best_tip',
+            lambda n: query.best_tip(session, chain).first(),
+            lambda n: lookup.best_tip(session, chain)),
+    ]
+    for name, built, precompiled in cases:
+        for label, fn in (('query', built), ('lookup', precompiled)):
+            def run():
+                for n in xrange(calls):
+                    fn(n % count)
+                    session.expunge_all()
+                    session.add(chain)
+            elapsed = timeit.timeit(run, number=1)
+            print '%-20s %-7s %8.1fus/call' % (
+                name, label, 1e6 * elapsed / calls)
+    for name, (calls_, hits, misses) in sorted(lookup.stats().iteritems()):
+        print '%-20s %6d calls %6d hits %6d misses' % (
+            name, calls_, hits, misses)
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
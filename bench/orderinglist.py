@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+"""Measures the cost of building a transaction with a large number of inputs
+and outputs through the ordering_list collections, with and without the
+append-only ingest mode, and of then flushing it. Append-only mode only
+speeds up the build; the flush, which dominates, is unaffected.
+
+    python -m bench.orderinglist [count]
+"""
+
+import sys
+import timeit
+
+from sqlalchemy import create_engine, orm
+
+from bitcoin.script import Script
+
+from sa_bitcoin import Base
+from sa_bitcoin.core import Transaction, Input, Output
+from sa_bitcoin.orderinglist import append_only
+
+from . import make_chain
+
+def make_transaction(count, mode):
+    tx = Transaction(format=0, version=1, lock_time=0, reference_height=0)
+    inputs = [Input(hash=n+1, index=0, endorsement=Script(b''),
+                    sequence=0xffffffff) for n in xrange(count)]
+    outputs = [Output(amount=n, contract=Script(b'\x51'))
+               for n in xrange(count)]
+    def build():
+        if mode == 'append_only':
+            with append_only(tx.inputs, tx.outputs):
+                tx.inputs.extend(inputs)
+                tx.outputs.extend(outputs)
+        elif mode == 'insert':
+            # Worst case for renumbering collections: every insertion at the
+            # head shifts the offset of every entry already present.
+            for input in reversed(inputs):
+                tx.inputs.insert(0, input)
+            for output in reversed(outputs):
+                tx.outputs.insert(0, output)
+        else:
+            tx.inputs.extend(inputs)
+            tx.outputs.extend(outputs)
+    return tx, build
+
+def flush(tx):
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    session = orm.sessionmaker(bind=engine)()
+    tx.chain = make_chain()
+    session.add(tx)
+    session.flush()
+    session.rollback()
+
+def main(count=10000):
+    orm.configure_mappers()
+    for mode in ('default', 'append_only', 'insert'):
+        n = mode == 'insert' and count // 10 or count
+        tx, build = make_transaction(n, mode)
+        elapsed = timeit.timeit(build, number=1)
+        assert [x.offset for x in tx.inputs] == range(n)
+        flushed = timeit.timeit(lambda: flush(tx), number=1)
+        print ('%-12s %6d inputs/outputs: build %8.4fs  flush %8.4fs  '
+               'total %8.4fs') % (mode, n, elapsed, flushed, elapsed + flushed)
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+"""Compares building a `TxIdIndex` by inserting keys one at a time through
+the ORM with the bottom-up bulk builder, and then applying a block's worth of
+changes to it key by key with applying them with `batch_update()`, checking
+that each pair produces the same root hash.
+
+    python -m bench.patricia [count] [changes]
+"""
+
+import os
+import sys
+import timeit
+
+from sqlalchemy import create_engine, orm
+
+from sa_bitcoin import Base
+from sa_bitcoin.ledger import TxIdIndex
+from sa_bitcoin.patricia import PatriciaNode, build_tree
+
+def make_session():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    return orm.sessionmaker(bind=engine)()
+
+def main(count=1000, changes=100):
+    orm.configure_mappers()
+    items = sorted((os.urandom(32), os.urandom(20)) for n in xrange(count))
+    updates = ([(key, None) for key, value in items[:changes//2]] +
+               [(os.urandom(32), os.urandom(20)) for n in xrange(changes//2)])
+
+    roots = []
+    def insert():
+        index = TxIdIndex()
+        for key, value in items:
+            index[key] = value
+        session.add(index)
+        session.flush()
+        roots.append(index.hash)
+    def bulk():
+        roots.append(session.query(PatriciaNode)
+            .get(build_tree(session, TxIdIndex, items)).hash)
+
+    for name, build in (('insert', insert), ('bulk', bulk)):
+        session = make_session()
+        elapsed = timeit.timeit(build, number=1)
+        print '%-8s %6d keys: %8.4fs' % (name, count, elapsed)
+    assert roots[0] == roots[1]
+
+    def update(index):
+        for key, value in updates:
+            if value is None:
+                del index[key]
+            else:
+                index[key] = value
+    def batch(index):
+        index.batch_update(updates)
+    for name, apply in (('update', update), ('batch', batch)):
+        session = make_session()
+        index = session.query(PatriciaNode).get(
+            build_tree(session, TxIdIndex, items))
+        before = session.query(PatriciaNode).count()
+        elapsed = timeit.timeit(lambda: apply(index), number=1)
+        elapsed += timeit.timeit(session.flush, number=1)
+        created = session.query(PatriciaNode).count() - before
+        print '%-8s %6d changes: %8.4fs, %6d nodes written' % (
+            name, changes, elapsed, created)
+        roots.append(index.hash)
+    assert roots[2] == roots[3]
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+"""Compares scanning the output table with contracts decoded eagerly into
+`Script` instances with scanning it with lazily decoded `LazyScript`
+wrappers, both when only the amounts are used and when the raw contract
+bytes are read too.
+
+    python -m bench.script [count]
+"""
+
+import os
+import sys
+import timeit
+
+from sqlalchemy import create_engine, select, type_coerce
+
+from sa_bitcoin import Base
+from sa_bitcoin.core import Output
+from sa_bitcoin.fields.script import BitcoinScript
+
+def main(count=200000):
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    output = Output.__table__
+    engine.execute(output.insert(), [{
+        'transaction_id': n // 2,
+        'offset':         n % 2,
+        'amount':         n,
+        'contract':       b'\x76\xa9\x14' + os.urandom(20) + b'\x88\xac',
+    } for n in xrange(count)])
+
+    def scan(type_, use):
+        def run():
+            total = 0
+            for amount, contract in engine.execute(select([output.c.amount,
+                    type_coerce(output.c.contract, type_)])):
+                total += use(amount, contract)
+            return total
+        return run
+    amounts = lambda amount, contract: amount
+    raw = lambda amount, contract: len(getattr(contract, 'raw', contract))
+
+    for name, use in (('amounts', amounts), ('raw bytes', raw)):
+        for label, type_ in (('eager', BitcoinScript()),
+                             ('lazy',  BitcoinScript(lazy=True))):
+            elapsed = min(timeit.repeat(scan(type_, use), number=1, repeat=3))
+            print '%-10s %-6s %7d outputs: %8.4fs' % (
+                name, label, count, elapsed)
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
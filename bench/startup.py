@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+"""Measures the startup cost of short-lived processes: importing the model
+modules, configuring the mappers and running a first query, each in a fresh
+interpreter, reporting the median of several runs.
+
+    python -m bench.startup [runs]
+"""
+
+import subprocess
+import sys
+
+# (name, setup, measured statement) triples. Setup is run, untimed, before the
+# statement in the same interpreter.
+STEPS = [
+    ('import sqlalchemy', '',
+        'import sqlalchemy.orm'),
+    ('import sa_bitcoin.core', 'import sqlalchemy.orm',
+        'import sa_bitcoin.core'),
+    ('import sa_bitcoin.ingest', 'import sqlalchemy.orm',
+        'import sa_bitcoin.ingest'),
+    ('import all models', 'import sqlalchemy.orm',
+        'import sa_bitcoin.core, sa_bitcoin.ledger, sa_bitcoin.mempool'),
+    ('configure mappers',
+        'import sa_bitcoin.core, sa_bitcoin.ledger, sa_bitcoin.mempool',
+        'import sa_bitcoin; sa_bitcoin.configure()'),
+    ('first query, unconfigured',
+        'import sa_bitcoin.core, sa_bitcoin.ledger, sa_bitcoin.mempool; '
+        'from sqlalchemy import orm',
+        'str(orm.Query(sa_bitcoin.core.Block).filter_by(chain_id=1))'),
+    ('first query, configured',
+        'import sa_bitcoin; sa_bitcoin.configure(); '
+        'from sqlalchemy import orm',
+        'str(orm.Query(sa_bitcoin.core.Block).filter_by(chain_id=1))'),
+]
+
+TEMPLATE = '''\
+import time
+%s
+start = time.time()
+%s
+print repr(time.time() - start)
+'''
+
+def measure(setup, statement):
+    output = subprocess.check_output(
+        [sys.executable, '-c', TEMPLATE % (setup, statement)])
+    return float(output.splitlines()[-1])
+
+def main(runs=5):
+    for name, setup, statement in STEPS:
+        times = sorted(measure(setup, statement) for _ in xrange(runs))
+        print '%-28s %8.1fms' % (name, 1000 * times[len(times) // 2])
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
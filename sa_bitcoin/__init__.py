@@ -35,3 +35,22 @@ def lazy_defaults(session, flush_context, instances):
             # kludgy.. but necessary as SQLAlchemy never calls `getattr()`
             # before passing the field values to the database layer.
             getattr(target, attr)
+
+# ===----------------------------------------------------------------------===
+
+# The package itself imports nothing beyond what `Base` needs, and each module
+# imports only the models it uses, so that a short-lived job pays only for the
+# mappers it touches. Long-running servers can instead pay the whole cost up
+# front, before forking workers which then share the result:
+
+MODEL_MODULES = ('core', 'ledger', 'mempool', 'patricia', 'sigcache')
+
+def configure(modules=MODEL_MODULES):
+    """Imports the passed model modules of this package and configures all
+    mappers, including the polymorphic `PatriciaNode` hierarchy, which
+    SQLAlchemy would otherwise do on first use. Opens no connections, so is
+    safe to call before forking."""
+    import importlib
+    for name in modules:
+        importlib.import_module('.' + name, __name__)
+    orm.configure_mappers()
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+# Statements which match a list of keys, with IN or with a disjunction of
+# equalities, are issued in chunks to stay below the bound parameter limit of
+# SQLite. This lives in a module of its own so that users of the helpers do
+# not have to import (and configure the mappers of) any particular model.
+
+import itertools
+
+# SQLAlchemy object-relational mapper
+from sqlalchemy import and_, or_
+
+CHUNK_SIZE = 400
+
+# Statements which write one row per row read are run a page of rows at a
+# time, so that neither the rows read nor the parameters written grow with
+# the size of a block.
+PAGE_SIZE = 10000
+
+def _chunks(sequence, size=CHUNK_SIZE):
+    for offset in xrange(0, len(sequence), size):
+        yield sequence[offset:offset+size]
+
+def _slices(iterable, size=CHUNK_SIZE):
+    """Yields lists of up to `size` consecutive items of the passed iterable,
+    which is consumed lazily, or a single list of every item if `size` is
+    None. Unlike `_chunks()` the iterable need not be a sequence."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def _after(keys, values):
+    "Matches the rows which sort after `values` in order of the `keys` columns"
+    if len(keys) == 1:
+        return keys[0] > values[0]
+    return or_(keys[0] > values[0],
+               and_(keys[0] == values[0], _after(keys[1:], values[1:])))
+
+def _pages(session, query, keys, size=None):
+    """Yields the rows of the select `query` in lists of at most `size` (by
+    default `PAGE_SIZE`), in
+    order of the `keys` columns, which must be selected by the query and
+    together identify a row. Each page is read by a query resuming after the
+    last row of the one before, so the caller may write to the rows read
+    before asking for the next page."""
+    if size is None:
+        size = PAGE_SIZE
+    last = None
+    while True:
+        page = query
+        if last is not None:
+            page = page.where(_after(keys, last))
+        rows = session.execute(page.order_by(*keys).limit(size)).fetchall()
+        if rows:
+            yield rows
+        if len(rows) < size:
+            return
+        last = [rows[-1][key] for key in keys]
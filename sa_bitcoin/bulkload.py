@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+# Bulk-load mode for the initial sync of a chain. The secondary indexes and
+# check constraints of the largest tables are only needed to answer queries
+# and to guard against application bugs, not by `ingest_blocks()` itself, so
+# while loading they are dropped and afterwards rebuilt in one pass over the
+# table, rather than maintained row by row:
+#
+#     with bulk_load(engine, progress=report):
+#         ingest_blocks(session, chain, blocks)
+#         session.commit()
+#
+# The session must be committed (or closed) before the block exits, since the
+# rebuild runs on connections of its own. The definitions dropped and rebuilt
+# are those of the model, so they cannot drift from what the migrations
+# create.
+
+from contextlib import contextmanager
+import Queue
+import threading
+
+# SQLAlchemy object-relational mapper
+from sqlalchemy import *
+from sqlalchemy import sql
+from sqlalchemy.schema import AddConstraint, DropConstraint
+
+from .core import BlockTransactionListNode, Input, Output, index_where
+
+# The deferred schema items, as (table, name) pairs. Unique indexes and
+# primary keys are never deferred: ingest relies upon them both for lookups
+# and for detecting duplicates.
+DEFERRED = [
+    (Output.__table__,  'ix__bitcoin_output__contract'),
+    (Output.__table__,  'ix__bitcoin_output__destination'),
+    (Output.__table__,  'ix__bitcoin_output__unspent'),
+    (Input.__table__,   'ix__bitcoin_input__hash__index'),
+    (BlockTransactionListNode.__table__,
+        'ix__bitcoin_block_transaction_list_node__transaction_id'),
+    (Output.__table__,  'ck__bitcoin_output__amount'),
+    (Output.__table__,  'ck__bitcoin_output__spent'),
+]
+
+def deferred_schema(bind):
+    """Returns the `Index` and `CheckConstraint` objects of `DEFERRED`, indexes
+    first. Constraints are left out on SQLite, which cannot add or drop
+    them once a table has been created."""
+    items = dict((item.name, item)
+        for table, name in DEFERRED
+        for item in table.indexes.union(table.constraints))
+    indexes = [items[name] for table, name in DEFERRED
+               if isinstance(items[name], Index)]
+    constraints = [items[name] for table, name in DEFERRED
+                   if isinstance(items[name], CheckConstraint)]
+    if bind.dialect.name == 'sqlite':
+        constraints = []
+    return indexes + constraints
+
+def _existing(bind):
+    "Returns the names of the deferred schema items present in the database"
+    names = set()
+    inspector = inspect(bind)
+    for table in set(table for table, name in DEFERRED):
+        names.update(index['name'] for index in inspector.get_indexes(table.name))
+    if bind.dialect.name != 'sqlite':
+        constraints = sql.table('table_constraints',
+            sql.column('constraint_name'), sql.column('constraint_type'),
+            sql.column('table_name'))
+        constraints.schema = 'information_schema'
+        names.update(row[0] for row in bind.execute(
+            select([constraints.c.constraint_name])
+            .where((constraints.c.constraint_type == 'CHECK') &
+                   constraints.c.table_name.in_(
+                       set(table.name for table, name in DEFERRED)))))
+    return names
+
+def _create(bind, item):
+    if isinstance(item, Index):
+        # Partial indexes only have their condition once it is attached.
+        index_where(item, bind.dialect)
+        item.create(bind)
+    else:
+        bind.execute(AddConstraint(item))
+
+def _drop(bind, item):
+    if isinstance(item, Index):
+        item.drop(bind)
+    else:
+        bind.execute(DropConstraint(item))
+
+def drop_deferred(engine):
+    """Drops the deferred indexes and constraints which are present, and
+    returns their names."""
+    existing = _existing(engine)
+    dropped = []
+    for item in reversed(deferred_schema(engine)):
+        if item.name in existing:
+            _drop(engine, item)
+            dropped.append(item.name)
+    return dropped
+
+def restore_deferred(engine, workers=4, progress=None):
+    """Creates whichever of the deferred indexes and constraints are missing,
+    and returns their names. Indexes are built by up to `workers` threads,
+    each on its own connection; constraints, which lock their table
+    exclusively, are then added one at a time. `progress`, if given, is
+    called as `progress(name, done, total)` as each item completes.
+
+    If a build fails, or the rebuild is interrupted, no further parallel
+    work is started; once the builds in flight have finished the remaining
+    items are created one by one, and then the error is re-raised. An item
+    which still cannot be created (e.g. a constraint violated by the loaded
+    data) is left missing, and a later call picks up where this one left
+    off, so this is also the way to recover a database left in bulk-load
+    mode by a crashed process."""
+    existing = _existing(engine)
+    missing = [item for item in deferred_schema(engine)
+               if item.name not in existing]
+    if engine.dialect.name == 'sqlite':
+        # Connections to SQLite do not share an in-memory database, and a
+        # file is locked by its writer anyway.
+        workers = 1
+
+    created, lock = [], threading.Lock()
+    def done(item):
+        with lock:
+            created.append(item.name)
+            if progress is not None:
+                progress(item.name, len(created), len(missing))
+
+    indexes = [x for x in missing if isinstance(x, Index)]
+    queue, failures = Queue.Queue(), []
+    for item in indexes:
+        queue.put(item)
+    def worker():
+        while not failures:
+            try:
+                item = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                _create(engine, item)
+            except Exception as e:
+                failures.append(e)
+                return
+            done(item)
+    threads = [threading.Thread(target=worker)
+               for _ in xrange(min(workers, len(indexes)))]
+
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            # A timeout keeps the main thread responsive to interrupts.
+            while thread.is_alive():
+                thread.join(1)
+        if failures:
+            raise failures[0]
+        for item in missing:
+            if item.name not in created:
+                _create(engine, item)
+                done(item)
+    except BaseException:
+        failures.append(None)
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)
+        for item in missing:
+            if item.name not in created:
+                try:
+                    _create(engine, item)
+                except Exception:
+                    continue
+                done(item)
+        raise
+    return created
+
+@contextmanager
+def bulk_load(engine, workers=4, progress=None):
+    """Drops the deferred indexes and constraints for the duration of the
+    block, and restores them with `restore_deferred()` on exit, including
+    when the block raises."""
+    drop_deferred(engine)
+    try:
+        yield
+    finally:
+        restore_deferred(engine, workers=workers, progress=progress)
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+# A result cache for the by-hash and by-height lookups of `query`, for blocks
+# and transactions buried deeply enough in the chain that they will not
+# change. Cached instances are detached copies, which are merged into the
+# caller's session without emitting any SQL (and without any of the column
+# types' result processing), so a hit costs a dictionary lookup:
+#
+#     cache = QueryCache(depth=288, path='/var/cache/blocks')
+#     block = cache.block_by_hash(session, chain, hash)
+#
+# Storage is pluggable: a cache is a list of tiers, searched in order, each
+# an object with `get()`, `set()`, `delete()` and `keys()` methods. By default
+# this is a size-bounded `MemoryStore`, backed by a `DiskStore` if a path is
+# given. Entries are only admitted once at least `depth` blocks deep, and
+# `invalidate()` must be called when a reorganization disconnects a block;
+# `ingest.disconnect_block()` does so for the cache passed to it.
+
+from collections import OrderedDict
+import cPickle as pickle
+import shelve
+import threading
+
+# SQLAlchemy object-relational mapper
+from sqlalchemy import *
+from sqlalchemy import orm
+
+from .core import BlockTransactionListNode, ConnectedBlockInfo
+from .query import best_tip, block_by_hash, blocks_at_height, \
+    transaction_by_hash
+
+# Roughly two days of blocks.
+DEFAULT_DEPTH = 288
+
+DEFAULT_SIZE = 10000
+
+class MemoryStore(object):
+    "An in-process tier, holding at most `size` entries in LRU order."
+    def __init__(self, size=DEFAULT_SIZE):
+        self.size, self._entries = size, OrderedDict()
+        self._lock = threading.Lock()
+    def get(self, key):
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is not None:
+                self._entries[key] = value
+            return value
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+    def keys(self):
+        with self._lock:
+            return list(self._entries)
+
+class DiskStore(object):
+    """A local on-disk tier, storing pickled entries in the `shelve` database
+    at `path`. Unlike `MemoryStore` it is unbounded, and persists across
+    restarts."""
+    def __init__(self, path):
+        self._shelf = shelve.open(path, protocol=pickle.HIGHEST_PROTOCOL)
+        self._lock = threading.Lock()
+    def get(self, key):
+        with self._lock:
+            return self._shelf.get(key)
+    def set(self, key, value):
+        with self._lock:
+            self._shelf[key] = value
+    def delete(self, key):
+        with self._lock:
+            self._shelf.pop(key, None)
+    def keys(self):
+        with self._lock:
+            return self._shelf.keys()
+    def close(self):
+        self._shelf.close()
+
+class QueryCache(object):
+    """Caches blocks and transactions by hash, and blocks by height, for
+    entries at least `depth` blocks below the best tip of their chain."""
+    def __init__(self, depth=DEFAULT_DEPTH, size=DEFAULT_SIZE, path=None,
+                 stores=None):
+        if stores is None:
+            stores = [MemoryStore(size)]
+            if path is not None:
+                stores.append(DiskStore(path))
+        self.depth, self.stores = depth, stores
+        # Serializes writes, so that the high-water marks of the tiers never
+        # fall below the height of any of their entries.
+        self._lock = threading.RLock()
+
+    # Keys are strings, as required by `shelve`, and lead with the chain id so
+    # that `invalidate()` can pick out the entries of a chain.
+    @staticmethod
+    def _key(kind, chain, value):
+        return '%d:%s:%x' % (chain.id, kind, value)
+
+    # Each tier also records, as an entry of its own, the greatest height of
+    # the entries of each chain it holds, so that `invalidate()` can skip the
+    # tiers with nothing to drop without looking at their other entries.
+    @staticmethod
+    def _top_key(chain_id):
+        return '%d:top' % chain_id
+
+    def _set(self, store, chain_id, key, entry):
+        with self._lock:
+            top_key = self._top_key(chain_id)
+            top = store.get(top_key)
+            if top is None or top[0] < entry[0]:
+                store.set(top_key, (entry[0], None))
+            store.set(key, entry)
+
+    def _get(self, session, key):
+        for index, store in enumerate(self.stores):
+            entry = store.get(key)
+            if entry is not None:
+                chain_id = int(key.split(':', 1)[0])
+                for upper in self.stores[:index]:
+                    self._set(upper, chain_id, key, entry)
+                return session.merge(entry[1], load=False)
+        return None
+
+    @staticmethod
+    def _detached(session, instance):
+        """A detached copy of `instance`, unaffected by changes made through
+        the session. It is loaded afresh by primary key through a session of
+        its own, on the same connection: the caller's instance may have been
+        constructed rather than loaded (e.g. by `ingest.ingest_blocks()`),
+        or have relationships loaded, and neither copies cleanly."""
+        mapper = orm.object_mapper(instance)
+        other = orm.Session(bind=session.connection(), autocommit=True)
+        try:
+            return other.query(mapper).get(
+                mapper.primary_key_from_instance(instance))
+        finally:
+            other.close()
+
+    def _admit(self, session, chain, key, height, instance):
+        tip = best_tip(session, chain).first()
+        if tip is None or height is None or tip.height - height < self.depth:
+            return
+        entry = (height, self._detached(session, instance))
+        for store in self.stores:
+            self._set(store, chain.id, key, entry)
+
+    def block_by_hash(self, session, chain, hash):
+        "As `query.block_by_hash(...).first()`."
+        key = self._key('block', chain, hash)
+        block = self._get(session, key)
+        if block is None:
+            block = block_by_hash(session, chain, hash).first()
+            if block is not None:
+                info = session.query(ConnectedBlockInfo).get(block.id)
+                self._admit(session, chain, key,
+                    getattr(info, 'height', None), block)
+        return block
+
+    def block_at_height(self, session, chain, height):
+        "As `query.blocks_at_height(...).first()`."
+        key = self._key('height', chain, height)
+        block = self._get(session, key)
+        if block is None:
+            block = blocks_at_height(session, chain, height).first()
+            if block is not None:
+                self._admit(session, chain, key, height, block)
+        return block
+
+    def transaction_by_hash(self, session, chain, hash):
+        """As `query.transaction_by_hash(...).first()`. The depth of a
+        transaction is that of the lowest connected block including it."""
+        key = self._key('transaction', chain, hash)
+        tx = self._get(session, key)
+        if tx is None:
+            tx = transaction_by_hash(session, chain, hash).first()
+            if tx is not None:
+                node = BlockTransactionListNode.__table__
+                info = ConnectedBlockInfo.__table__
+                height = session.execute(select([func.min(info.c.height)])
+                    .select_from(node.join(info,
+                        info.c.block_id == node.c.block_id))
+                    .where(node.c.transaction_id == tx.id)).scalar()
+                self._admit(session, chain, key, height, tx)
+        return tx
+
+    def invalidate(self, chain, height):
+        """Drops the entries of `chain` at or above `height`, e.g. the height
+        of a block being disconnected. Only a reorganization reaching at
+        least `depth` blocks deep has anything to drop, so usually this
+        reads only the high-water mark of each tier. Otherwise, or if a
+        tier has lost its mark, every key of the tier is examined."""
+        prefix, top_key = '%d:' % chain.id, self._top_key(chain.id)
+        with self._lock:
+            for store in self.stores:
+                top = store.get(top_key)
+                if top is not None and top[0] < height:
+                    continue
+                for key in store.keys():
+                    if key.startswith(prefix) and key != top_key:
+                        entry = store.get(key)
+                        if entry is not None and entry[0] >= height:
+                            store.delete(key)
+                store.set(top_key, (height - 1, None))
+
+    def clear(self):
+        with self._lock:
+            for store in self.stores:
+                for key in store.keys():
+                    store.delete(key)
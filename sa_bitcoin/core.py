@@ -2,20 +2,26 @@
 
 # SQLAlchemy object-relational mapper
 from sqlalchemy import *
-from sqlalchemy import orm
+from sqlalchemy import event, orm, sql
 from . import Base
 
 from sqlalchemy.ext.associationproxy import association_proxy
-from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.ext.orderinglist import ordering_list
+from sqlalchemy.ext.hybrid import Comparator, hybrid_property
+from sqlalchemy.sql import operators
 
-from .fields.hash_ import Hash256
-from .fields.integer import UnsignedInteger
+from .fields.hash_ import Hash160, Hash256
+from .fields.integer import UnsignedInteger, UnsignedSmallInteger
 from .fields.script import BitcoinScript
 from .fields.time_ import BlockTime, UNIXDateTime
 from .mixins.hashable import HybridHashableMixin
+from .orderinglist import ordering_list
 
 from bitcoin import core
+from bitcoin.base58 import VersionedPayload
+from bitcoin.errors import InvalidAddressError
+from bitcoin.hash import hash256
+from bitcoin.serialize import serialize_hash, deserialize_hash
+from bitcoin.tools import StringIO
 
 __tableprefix__ = 'bitcoin_'
 
@@ -52,7 +58,7 @@ class Chain(ReplMixin, Base):
     # by the SHA-256^2 hash of their genesis block, which should be different
     # for every chain (and is different for every chain that matters).
     genesis = Column(LargeBinary(80), nullable=False)
-    genesis_hash = Column(Hash256, nullable=False)
+    genesis_hash = Column(Hash256(order_preserving=True), nullable=False)
 
     # The payload version prefixes used to indicate whether the payload type.
     pubkey_hash_prefix = Column(SmallInteger, nullable=False)
@@ -87,6 +93,23 @@ class Chain(ReplMixin, Base):
     def __unicode__(self):
         return serialize_hash(self.genesis_hash).encode('hex').decode('ascii')
 
+    def address_destination(self, address):
+        """Decodes a base58 address of this chain, returning the pair of
+        `Output.destination_type` and `Output.destination_hash` values which
+        identify the outputs paying to it."""
+        payload = VersionedPayload(data=address.decode('base58'))
+        if len(payload.payload) != 20:
+            raise InvalidAddressError(
+                u"address payload must be 20 bytes, not %d" % len(payload.payload))
+        if payload.version == self.pubkey_hash_prefix:
+            type_ = 'pubkey_hash'
+        elif payload.version == self.script_hash_prefix:
+            type_ = 'script_hash'
+        else:
+            raise InvalidAddressError(
+                u"unrecognized address version: %x (%d)" % ((payload.version,)*2))
+        return (type_, deserialize_hash(StringIO(payload.payload), 20))
+
 class Checkpoint(ReplMixin, Base):
     __tablename__ = __tableprefix__ + 'checkpoint'
 
@@ -100,7 +123,7 @@ class Checkpoint(ReplMixin, Base):
     height = Column(Integer, nullable=False)
 
     # The SHA-256^2 hash value of the checkpoint.
-    hash = Column(Hash256, nullable=False)
+    hash = Column(Hash256(order_preserving=True), nullable=False)
 
     # FIXME: The ultraprune branch of bitcoin records the number of unspent
     # transactions, called 'coins'. The upcoming authenticated prefix tree
@@ -139,6 +162,16 @@ class Block(HybridHashableMixin, core.Block, Base):
         Sequence('__'.join(['sq', __tablename__, 'id'])),
         nullable = False)
 
+    # Blocks are scoped to the chain they belong to. The chain id is the
+    # leading component of the natural key indexes so that networks stored
+    # side-by-side (e.g. mainnet and testnet) occupy disjoint index ranges
+    # and per-chain queries do not interfere with each other.
+    chain_id = Column(Integer,
+        ForeignKey(__tableprefix__ + 'chain.id',
+            name = '__'.join(['fk', __tablename__, 'chain'])),
+        nullable = False)
+    chain = orm.relationship(lambda: Chain)
+
     # The hard-fork version.
     # Known values are 0 (original).
     format = Column(SmallInteger, nullable=False)
@@ -155,7 +188,7 @@ class Block(HybridHashableMixin, core.Block, Base):
     # Called ‘parent’ because this is technically a branching/tree relationship,
     # this field is called called the ‘previous block’ in the bitcoin protocol as
     # it represents the last block in the nominally linear chain.
-    parent_hash = Column(Hash256, nullable=False)
+    parent_hash = Column(Hash256(order_preserving=True), nullable=False)
 
     # The hash of the root node of the Block/Transaction merkle list recording
     # the transactions confirmed by this block.
@@ -178,15 +211,17 @@ class Block(HybridHashableMixin, core.Block, Base):
     nonce = Column(UnsignedInteger, nullable=False)
 
     # The digest value which results from applying the proof-of-work function
-    # to the serial representation of this block.
-    _hash = Column('hash', Hash256, nullable=False)
+    # to the serial representation of this block. Like every column holding a
+    # block hash or txid it is stored big-endian, so that prefix searches with
+    # `Block.hash.startswith()` are range scans of the index.
+    _hash = Column('hash', Hash256(order_preserving=True), nullable=False)
 
     __lazy_slots__ = ('hash',)
     __table_args__ = (
         PrimaryKeyConstraint('id',
             name = '__'.join(['pk', __tablename__])),
-        Index('__'.join(['ix', __tablename__, 'hash']),
-            'hash', unique = True),
+        Index('__'.join(['ix', __tablename__, 'chain_id', 'hash']),
+            'chain_id', 'hash', unique = True),
         CheckConstraint(
             (16842752 <= sql.column('bits')) & (sql.column('bits') <= 486604799),
             name = '__'.join(['ck', __tablename__, 'bits'])),)
@@ -201,9 +236,9 @@ class Block(HybridHashableMixin, core.Block, Base):
         uselist     = False)
 
     # The list of transactions is stored in a many-to-many relationship with
-    # an intermediary ordering field. We use SQLAlchemy's ordering_list and
-    # association_proxy extensions to make the transactions accessible as a
-    # list-like object.
+    # an intermediary ordering field. We use our own append-only capable
+    # ordering_list and SQLAlchemy's association_proxy extension to make the
+    # transactions accessible as a list-like object.
     transaction_list_nodes = orm.relationship(lambda: BlockTransactionListNode,
         collection_class = ordering_list('offset'),
         order_by         = lambda: BlockTransactionListNode.offset)
@@ -243,6 +278,16 @@ class Transaction(HybridHashableMixin, core.Transaction, Base):
     # constraints. So we use a simple auto-incrementing integer instead:
     id = Column(Integer, Sequence('__'.join(['sq', __tablename__])))
 
+    # Transactions are scoped to the chain they belong to. The chain id is the
+    # leading component of the natural key indexes so that networks stored
+    # side-by-side (e.g. mainnet and testnet) occupy disjoint index ranges
+    # and per-chain queries do not interfere with each other.
+    chain_id = Column(Integer,
+        ForeignKey(__tableprefix__ + 'chain.id',
+            name = '__'.join(['fk', __tablename__, 'chain'])),
+        nullable = False)
+    chain = orm.relationship(lambda: Chain)
+
     # The hard-fork version.
     # Known values are 0 (original) and 1 (refheight).
     format = Column(SmallInteger, nullable=False)
@@ -268,19 +313,32 @@ class Transaction(HybridHashableMixin, core.Transaction, Base):
     # this context it has no meaning and assumes the default value of zero.
     reference_height = Column(UnsignedInteger, nullable=False)
 
+    # The total amounts of the outputs spent by the inputs and of the outputs
+    # of this transaction, and the fee which is their difference. These are
+    # denormalized from the `Input.output` links and `Output.amount` by
+    # `sa_bitcoin.ingest`, so that fees can be aggregated over whole blocks
+    # without touching the input and output tables. `input_amount` and `fee`
+    # are NULL for coinbase transactions, and until every input is linked.
+    input_amount = Column(BigInteger)
+    output_amount = Column(BigInteger)
+    fee = Column(BigInteger)
+
     # The digest value which results from applying the double-SHA256 function
-    # to the serial representation of this transaction.
-    _hash = Column('hash', Hash256, nullable=False)
+    # to the serial representation of this transaction. Stored big-endian; see
+    # `Block.hash`.
+    _hash = Column('hash', Hash256(order_preserving=True), nullable=False)
 
     __lazy_slots__ = ('hash',)
     __table_args__ = (
         PrimaryKeyConstraint('id',
             name = '__'.join(['pk', __tablename__])),
-        Index('__'.join(['ix', __tablename__, 'hash']),
-            'hash', unique = True),)
+        Index('__'.join(['ix', __tablename__, 'chain_id', 'hash']),
+            'chain_id', 'hash', unique = True),)
 
     # The inputs and outputs are joined from separate models using the
-    # ordering_list collection class, which maintains the offset index.
+    # ordering_list collection class, which maintains the offset index. Bulk
+    # ingest should wrap construction in `append_only(tx.inputs, tx.outputs)`
+    # so that offsets are assigned once and never renumbered.
     # The create_inputs() and create_outputs() methods are necessary to
     # override python-bitcoin's default behavior which itself would
     # override the SQLAlchemy collection classes.
@@ -296,6 +354,57 @@ class Transaction(HybridHashableMixin, core.Transaction, Base):
     def create_outputs(self):
         pass
 
+class SharedScript(Base):
+    __tablename__ = __tableprefix__ + 'script'
+
+    # Content-addressed storage for scripts which recur across many rows, such
+    # as the contract of a reused address. Rows referencing a shared script
+    # store its 4-byte id in place of the script itself.
+    id = Column(Integer,
+        Sequence('__'.join(['sq', __tablename__, 'id'])),
+        nullable = False)
+
+    # The double-SHA256 digest of the script, by which it is deduplicated.
+    hash = Column(Hash256, nullable=False)
+
+    script = Column(BitcoinScript, nullable=False)
+
+    __table_args__ = (
+        PrimaryKeyConstraint('id',
+            name = '__'.join(['pk', __tablename__])),
+        Index('__'.join(['ix', __tablename__, 'hash']),
+            'hash', unique = True),)
+
+    @staticmethod
+    def digest(script):
+        "Returns the `hash` of the passed script."
+        return hash256(script).intdigest()
+
+class ContractComparator(Comparator):
+    """Compares `Output.contract`, whether stored inline or shared. Equality
+    with a script is an OR of two indexed probes, of the inline column and
+    of the shared script with the script's digest; every other comparison
+    is made with the `coalesce()` of the two, which no index covers."""
+    def __init__(self, cls):
+        super(ContractComparator, self).__init__(func.coalesce(cls._contract,
+            select([SharedScript.script])
+            .where(SharedScript.id == cls.contract_id)
+            .as_scalar()))
+        self.cls = cls
+
+    def operate(self, op, *other, **kwargs):
+        return op(self.expression, *other, **kwargs)
+    def reverse_operate(self, op, other, **kwargs):
+        return op(other, self.expression, **kwargs)
+
+    def __eq__(self, other):
+        if other is None or hasattr(other, '__clause_element__') or \
+                isinstance(other, sql.ClauseElement):
+            return self.operate(operators.eq, other)
+        return (self.cls._contract == other) | self.cls.contract_id.in_(
+            select([SharedScript.id])
+            .where(SharedScript.hash == SharedScript.digest(other)))
+
 class Output(core.Output, Base):
     __tablename__ = __tableprefix__ + 'output'
 
@@ -312,21 +421,119 @@ class Output(core.Output, Base):
     #   constant 2^53 - 1.
     amount = Column(BigInteger, nullable=False)
 
-    # What the Satoshi client calls scriptPubKey:
-    contract = Column(BitcoinScript, nullable=False)
+    # What the Satoshi client calls scriptPubKey. It is stored either inline,
+    # or, if written by `ingest_blocks(..., share_scripts=True)`, as a
+    # reference to a `SharedScript`; exactly one of the two columns is set.
+    # Either way the `contract` attribute is a `Script`.
+    _contract = Column('contract', BitcoinScript)
+    contract_id = Column(Integer,
+        ForeignKey(__tableprefix__ + 'script.id',
+            name = '__'.join(['fk', __tablename__, 'contract_id'])))
+
+    # The destination of a standard pay-to-pubkey-hash or pay-to-script-hash
+    # contract, which is the payload of the corresponding address. These are
+    # derived from `contract` in batches by `sa_bitcoin.ingest`, and are NULL
+    # for non-standard contracts (or those not yet processed).
+    destination_type = Column(
+        Enum('pubkey_hash', 'script_hash',
+            name = '__'.join([__tablename__, 'destination_type', 'enum'])))
+    destination_hash = Column(Hash160)
+
+    # The input which spends this output on the best chain, and the height of
+    # the block containing it. These are a denormalized reverse index of the
+    # `Input.output` link, maintained by `sa_bitcoin.ingest` as blocks are
+    # connected and disconnected, so that asking whether an output is spent
+    # (and by whom) is a primary-key read. All three are NULL when unspent.
+    spent_by_transaction_id = Column(Integer)
+    spent_by_offset = Column(SmallInteger)
+    spent_height = Column(Integer)
 
     __table_args__ = (
         PrimaryKeyConstraint('transaction_id', 'offset',
             name = '__'.join(['pk', __tablename__])),
+        ForeignKeyConstraint(
+            ['spent_by_transaction_id', 'spent_by_offset'],
+            [__tableprefix__ + 'input.transaction_id',
+             __tableprefix__ + 'input.offset'],
+            name = '__'.join(['fk', __tablename__, 'spent_by']),
+            use_alter = True),
         CheckConstraint(
             (0 <= sql.column('amount')) &
             (sql.column('amount') <= 9007199254740991), # 2^53 - 1
             name = '__'.join(['ck', __tablename__, 'amount'])),
-        Index('__'.join(['ix', __tablename__, 'contract']), 'contract'),)
+        CheckConstraint(
+            ((sql.column('spent_by_transaction_id') == None) &
+             (sql.column('spent_by_offset')         == None) &
+             (sql.column('spent_height')            == None)) |
+            ((sql.column('spent_by_transaction_id') != None) &
+             (sql.column('spent_by_offset')         != None) &
+             (sql.column('spent_height')            != None)),
+            name = '__'.join(['ck', __tablename__, 'spent'])),
+        CheckConstraint(
+            ((sql.column('contract')    != None) &
+             (sql.column('contract_id') == None)) |
+            ((sql.column('contract')    == None) &
+             (sql.column('contract_id') != None)),
+            name = '__'.join(['ck', __tablename__, 'contract'])),
+        Index('__'.join(['ix', __tablename__, 'contract']), 'contract'),
+        Index('__'.join(['ix', __tablename__, 'contract_id']), 'contract_id'),
+        Index('__'.join(['ix', __tablename__, 'destination']),
+            'destination_hash', 'destination_type'),
+        # Only the unspent outputs are indexed, which keeps the index small
+        # and allows the unspent set to be scanned without touching the
+        # (much larger) set of spent outputs. See `index_where()`.
+        Index('__'.join(['ix', __tablename__, 'unspent']),
+            'transaction_id', 'offset'),)
 
     transaction = orm.relationship(lambda: Transaction)
+    # Loaded on first use, which for an inline contract emits no SQL. Readers
+    # of many outputs join it explicitly (see `query.outputs_by_address()`).
+    shared_contract = orm.relationship(lambda: SharedScript)
+    spent_by = orm.relationship(lambda: Input,
+        foreign_keys = lambda: [Output.spent_by_transaction_id,
+                                Output.spent_by_offset],
+        post_update  = True)
+
+    @hybrid_property
+    def contract(self):
+        if self.shared_contract is not None:
+            return self.shared_contract.script
+        return self._contract
+    @contract.setter
+    def contract(self, value):
+        self._contract, self.shared_contract = value, None
+    @contract.comparator
+    def contract(cls):
+        return ContractComparator(cls)
+
+    @hybrid_property
+    def is_spent(self):
+        return self.spent_by_transaction_id is not None
+    @is_spent.expression
+    def is_spent(cls):
+        return cls.spent_by_transaction_id != None
 Transaction.output_class = Output
 
+# The condition of the partial unspent index is attached only as the index is
+# created, and only for the dialect creating it. Given to `Index()` as dialect
+# keyword arguments, it made SQLAlchemy import every dialect named in order
+# to validate them, which was most of the cost of importing this module.
+def index_where(index, dialect):
+    """Attaches to `index` its condition as a partial index on `dialect`, if
+    it has one there. This is done for the whole table as it is created;
+    code creating one of its indexes on its own, with `Index.create()`,
+    must call it first."""
+    table = Output.__table__
+    if (dialect.name in ('postgresql', 'sqlite') and index.table is table and
+            index.name == '__'.join(['ix', table.name, 'unspent'])):
+        index.dialect_kwargs[dialect.name + '_where'] = \
+            table.c.spent_by_transaction_id == None
+
+@event.listens_for(Output.__table__, 'before_create')
+def _unspent_where(table, bind, **kwargs):
+    for index in table.indexes:
+        index_where(index, bind.dialect)
+
 class Input(core.Input, Base):
     __tablename__ = __tableprefix__ + 'input'
 
@@ -340,11 +547,13 @@ class Input(core.Input, Base):
 
     # Identification of the transaction containing this output, and
     # the index within its output list.
-    hash = Column(Hash256, nullable=False)
+    hash = Column(Hash256(order_preserving=True), nullable=False)
     index = Column(UnsignedInteger, nullable=False)
-    output_id = Column(Integer,
-        ForeignKey(__tableprefix__ + 'output.id',
-            name = '__'.join(['fk', __tablename__])))
+
+    # The output being spent, once it has been located. Outputs are keyed by
+    # (transaction_id, offset), so the link is a composite foreign key.
+    output_transaction_id = Column(Integer)
+    output_offset = Column(SmallInteger)
 
     # What the Satoshi client calls scriptSig:
     endorsement = Column(BitcoinScript, nullable=False)
@@ -356,11 +565,18 @@ class Input(core.Input, Base):
     __table_args__ = (
         PrimaryKeyConstraint('transaction_id', 'offset',
             name = '__'.join(['pk', __tablename__])),
+        ForeignKeyConstraint(
+            ['output_transaction_id', 'output_offset'],
+            [__tableprefix__ + 'output.transaction_id',
+             __tableprefix__ + 'output.offset'],
+            name = '__'.join(['fk', __tablename__, 'output'])),
         Index('__'.join(['ix', __tablename__, 'hash', 'index']),
             'hash', 'index'),)
 
     transaction = orm.relationship(lambda: Transaction)
-    output = orm.relationship(lambda: Output)
+    output = orm.relationship(lambda: Output,
+        foreign_keys = lambda: [Input.output_transaction_id,
+                                Input.output_offset])
 
     is_coinbase = hybrid_property(core.Input.is_coinbase.fget,
                                   core.Input.is_coinbase.fset,
@@ -382,6 +598,13 @@ class ConnectedBlockInfo(core.ConnectedBlockInfo, Base):
         ForeignKey(__tableprefix__ + 'block.id',
             name = '__'.join(['fk', __tablename__, 'parent_id'])))
 
+    # A copy of `Block.chain_id`, so that the height and best-tip indexes
+    # can be scoped to a single chain.
+    chain_id = Column(Integer,
+        ForeignKey(__tableprefix__ + 'chain.id',
+            name = '__'.join(['fk', __tablename__, 'chain'])),
+        nullable = False)
+
     height = Column(Integer, nullable=False)
 
     aggregate_work = Column(Numeric(31,0), nullable=False)
@@ -389,10 +612,10 @@ class ConnectedBlockInfo(core.ConnectedBlockInfo, Base):
     __table_args__ = (
         PrimaryKeyConstraint('block_id',
             name = '__'.join(['pk', __tablename__])),
-        Index('__'.join(['ix', __tablename__, 'height']),
-            'height'),
-        Index('__'.join(['ix', __tablename__, 'aggregate_work']),
-            'aggregate_work'),
+        Index('__'.join(['ix', __tablename__, 'chain_id', 'height']),
+            'chain_id', 'height'),
+        Index('__'.join(['ix', __tablename__, 'chain_id', 'aggregate_work']),
+            'chain_id', 'aggregate_work'),
         CheckConstraint(0 <= sql.column('height'),
             name = '__'.join(['ck', __tablename__, 'height'])),
         CheckConstraint(1 <= sql.column('aggregate_work'),
@@ -402,6 +625,55 @@ class ConnectedBlockInfo(core.ConnectedBlockInfo, Base):
         primaryjoin = 'Block.id == ConnectedBlockInfo.block_id')
     parent = orm.relationship(lambda: Block,
         primaryjoin = 'Block.id == ConnectedBlockInfo.parent_id')
+    chain = orm.relationship(lambda: Chain)
 
     def __init__(self, *args, **kwargs):
+        if not any(x in kwargs for x in ('chain', 'chain_id')):
+            kwargs['chain'] = getattr(kwargs.get('block'), 'chain', None)
         return Base.__init__(self, *args, **kwargs)
+
+class BlockStats(Base):
+    __tablename__ = __tableprefix__ + 'block_stats'
+
+    # A rollup of the contents of a connected block, maintained set-wise by
+    # `sa_bitcoin.ingest` as blocks are connected and disconnected, so that
+    # charts over a range of blocks scan this small table rather than
+    # aggregating over the transaction, input and output tables.
+    block_id = Column(Integer,
+        ForeignKey(__tableprefix__ + 'block.id',
+            name = '__'.join(['fk', __tablename__, 'block_id'])),
+        nullable = False)
+
+    # Copies of `ConnectedBlockInfo.chain_id`, `ConnectedBlockInfo.height`
+    # and `Block.time`, the keys of range aggregation.
+    chain_id = Column(Integer,
+        ForeignKey(__tableprefix__ + 'chain.id',
+            name = '__'.join(['fk', __tablename__, 'chain'])),
+        nullable = False)
+    height = Column(Integer, nullable=False)
+    time = Column(UNIXDateTime, nullable=False)
+
+    transaction_count = Column(Integer, nullable=False)
+    input_count = Column(Integer, nullable=False)
+    output_count = Column(Integer, nullable=False)
+
+    # The total of the block's output amounts, including the coinbase, and
+    # of the fees of its transactions which have a known fee (see
+    # `Transaction.fee`).
+    output_amount = Column(BigInteger, nullable=False)
+    fee = Column(BigInteger, nullable=False)
+
+    # The size in bytes of the serialized block.
+    size = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        PrimaryKeyConstraint('block_id',
+            name = '__'.join(['pk', __tablename__])),
+        Index('__'.join(['ix', __tablename__, 'chain_id', 'height']),
+            'chain_id', 'height'),
+        Index('__'.join(['ix', __tablename__, 'chain_id', 'time']),
+            'chain_id', 'time'),)
+
+    block = orm.relationship(lambda: Block,
+        backref = orm.backref('stats', uselist=False))
+    chain = orm.relationship(lambda: Chain)
@@ -1,11 +1,56 @@
 # -*- coding: utf-8 -*-
 
+# SQLAlchemy object-relational mapper
+from sqlalchemy import *
+
+from bitcoin.serialize import serialize_beint, deserialize_beint
+from bitcoin.tools import StringIO
+
 from .integer import LittleEndian
 
-class Hash160(LittleEndian):
+class Hash(LittleEndian):
+    """A hash value, stored little-endian as it is serialized on the wire. If
+    `order_preserving` is set it is stored big-endian instead, so that the
+    byte order of the column matches the numeric order of the hashes, and
+    with it their customary hex display. Prefix searches on such a column,
+    e.g. `Transaction.hash.startswith('000000')`, compile to a `BETWEEN`
+    range scan of its index."""
+    class comparator_factory(TypeDecorator.Comparator):
+        def startswith(self, other, **kwargs):
+            return self.between(*self.expr.type.prefix_range(other))
+
+    def __init__(self, length, order_preserving=False, *args, **kwargs):
+        super(Hash, self).__init__(length, *args, **kwargs)
+        self.order_preserving = order_preserving
+
+    def process_bind_param(self, value, dialect):
+        if value is None or not self.order_preserving:
+            return super(Hash, self).process_bind_param(value, dialect)
+        return serialize_beint(value, self.impl.length)
+    def process_result_value(self, value, dialect):
+        if value is None or not self.order_preserving:
+            return super(Hash, self).process_result_value(value, dialect)
+        return deserialize_beint(StringIO(value), len(value))
+    def copy(self):
+        return self.__class__(self.impl.length,
+            order_preserving = self.order_preserving)
+
+    def prefix_range(self, prefix):
+        """Returns the (lowest, highest) hash values whose hex display begins
+        with the passed hex string."""
+        if not self.order_preserving:
+            raise ValueError(u"prefix search requires an order-preserving "
+                u"hash column")
+        digits = 2 * self.impl.length
+        if len(prefix) > digits:
+            raise ValueError(u"prefix is longer than the hash")
+        return (int(prefix.ljust(digits, '0'), 16),
+                int(prefix.ljust(digits, 'f'), 16))
+
+class Hash160(Hash):
     def __init__(self, length=20, *args, **kwargs):
         super(Hash160, self).__init__(length, *args, **kwargs)
 
-class Hash256(LittleEndian):
+class Hash256(Hash):
     def __init__(self, length=32, *args, **kwargs):
         super(Hash256, self).__init__(length, *args, **kwargs)
@@ -5,12 +5,86 @@ from sqlalchemy import *
 
 from bitcoin.script import Script
 
+class LazyScript(object):
+    """A script as fetched from the database, holding the buffer returned by
+    the driver and only constructing the `Script` on first script-level
+    access. `raw` is that buffer, uncopied, for callers which only need the
+    bytes, and `script` the `Script` itself. It compares, hashes and
+    concatenates as the `Script` does, but is not one: it fails isinstance()
+    checks and has no buffer interface, so e.g. `hash256()` needs `script`
+    or `raw`."""
+    __slots__ = ('raw', '_script')
+
+    def __init__(self, raw):
+        self.raw, self._script = raw, None
+
+    @property
+    def script(self):
+        if self._script is None:
+            self._script = Script(self.raw)
+        return self._script
+
+    def __getattr__(self, name):
+        return getattr(self.script, name)
+
+    def __len__(self):
+        return len(self.raw)
+    def __iter__(self):
+        return iter(self.script)
+    def __getitem__(self, key):
+        return self.script[key]
+    def __str__(self):
+        return str(self.script)
+    def __repr__(self):
+        return repr(self.script)
+
+    def __eq__(self, other):
+        return self.script == other
+    def __ne__(self, other):
+        return self.script != other
+    def __hash__(self):
+        return hash(self.script)
+
+    def __add__(self, other):
+        return self.script + other
+    def __radd__(self, other):
+        return other + self.script
+
+    def __reduce__(self):
+        return (self.__class__, (str(self.raw),))
+
 class BitcoinScript(TypeDecorator):
+    """A script, stored as its raw bytes. Fetched values are `Script`
+    instances, or if `lazy` is set `LazyScript` wrappers, which skip the
+    conversion and copying of the driver's buffer for rows whose scripts
+    are never looked at. Mapped columns decode eagerly, so that model
+    attributes are always true `Script` instances; scans of many rows opt
+    in to lazy decoding per query:
+
+        select([output.c.amount,
+                type_coerce(output.c.contract, BitcoinScript(lazy=True))])
+    """
     impl = LargeBinary
 
+    def __init__(self, length=None, lazy=False, *args, **kwargs):
+        super(BitcoinScript, self).__init__(length, *args, **kwargs)
+        self.lazy = lazy
+
     def process_bind_param(self, value, dialect):
+        if isinstance(value, LazyScript):
+            return value.raw
         return value
     def process_result_value(self, value, dialect):
+        if value is None:
+            return None
         return Script(value)
+    def result_processor(self, dialect, coltype):
+        if not self.lazy:
+            return super(BitcoinScript, self).result_processor(dialect, coltype)
+        def process(value):
+            if value is not None:
+                value = LazyScript(value)
+            return value
+        return process
     def copy(self):
-        return self.__class__(self.impl.length)
+        return self.__class__(self.impl.length, lazy=self.lazy)
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+
+# Flat, read-only images of committed Patricia trees (`TxIdIndex`,
+# `ContractIndex`), for read-heavy lookups without touching the database. An
+# image is written once from a persisted root, and is then opened with `mmap`
+# by any number of processes, which share it through the page cache. Lookups
+# walk the mapped file directly; values and proofs are sliced out of it
+# without copying.
+#
+# The first page of an image is its header:
+#
+#   magic 'sabi', format version, page size, node type, root hash,
+#   offset of the root node, number of nodes, size and length of the tree
+#
+# Nodes follow from the second page on, in post-order so that every node
+# refers only to nodes before it. A node never straddles a page boundary
+# unless it is larger than a page. Each node is laid out as:
+#
+#   hash, flags, size, length
+#   for each branch (left, then right): the bit length and bits of the prefix
+#     following its implicit first bit, then the file offset of the child,
+#     or its hash if the child is pruned
+#   value length and value, if the node has a value
+#
+# All integers are little-endian, and hashes are 32 little-endian bytes as
+# stored in the database.
+
+import mmap
+import os
+from struct import Struct
+
+from .patricia import PatriciaNode, node_digest, node_flags, select_tree
+
+from bitcoin import patricia as core
+from bitcoin.hash import hash256
+from bitcoin.serialize import (
+    serialize_hash, deserialize_hash, deserialize_varint, deserialize_varchar)
+from bitcoin.tools import Bits, StringIO
+
+MAGIC = b'sabi'
+VERSION = 1
+PAGE_SIZE = mmap.PAGESIZE
+
+_header = Struct('<4sHI16s32sQQQQ')
+_node = Struct('<32sBII')
+_length = Struct('<I')
+_offset = Struct('<Q')
+
+_implicit = ((Bits('0b0'), core.PatriciaNode.OFFSET_LEFT,
+                           core.PatriciaNode.PRUNE_LEFT),
+             (Bits('0b1'), core.PatriciaNode.OFFSET_RIGHT,
+                           core.PatriciaNode.PRUNE_RIGHT))
+
+def _hash(data):
+    return deserialize_hash(StringIO(bytes(data)), 32)
+
+def export_index(session, root, path, page_size=PAGE_SIZE):
+    """Writes an image of the persisted tree rooted at the passed
+    `PatriciaNode` to `path`. Every node hash is recomputed as the image is
+    written, and `ValueError` is raised if the result does not match the
+    hash of `root`. The image is written to a temporary file which is
+    renamed into place once complete, so that readers never see a partial
+    image. Returns the number of nodes written."""
+    temp = path + '.tmp'
+    try:
+        with open(temp, 'wb') as file_:
+            file_.write(b'\x00' * page_size)
+            offset, stack, count = page_size, [], 0
+            for row in session.execute(select_tree(root.id)):
+                flags = node_flags(row)
+                branches = []
+                for prefix, node_id, hash_ in (
+                        (row.left_prefix,  row.left_node_id,  row.left_hash),
+                        (row.right_prefix, row.right_node_id, row.right_hash)):
+                    if prefix is not None:
+                        branches.append([prefix, node_id is None, None, hash_])
+                # Completed subtrees are on the stack; non-pruned children
+                # are popped right-to-left.
+                for branch in reversed(branches):
+                    if not branch[1]:
+                        branch[2], branch[3] = stack.pop()
+                hash_ = hash256.new(node_digest(flags,
+                    [(prefix, child) for prefix, _, _, child in branches],
+                    row.value)).intdigest()
+
+                parts = [_node.pack(serialize_hash(hash_, 32), flags,
+                                    row.size, row.length)]
+                for prefix, pruned, child_offset, child in branches:
+                    parts.append(_length.pack(len(prefix) - 1))
+                    parts.append(prefix[1:].tobytes())
+                    if pruned:
+                        parts.append(serialize_hash(child, 32))
+                    else:
+                        parts.append(_offset.pack(child_offset))
+                if row.value is not None:
+                    parts.append(_length.pack(len(row.value)))
+                    parts.append(row.value)
+                record = b''.join(parts)
+
+                space = page_size - offset % page_size
+                if len(record) > space and len(record) <= page_size:
+                    file_.write(b'\x00' * space)
+                    offset += space
+                file_.write(record)
+                stack.append((offset, hash_))
+                offset += len(record)
+                count += 1
+
+            if len(stack) != 1 or stack[0][1] != root.hash:
+                raise ValueError(u"recomputed root hash does not match the "
+                    u"persisted root")
+            file_.seek(0)
+            file_.write(_header.pack(MAGIC, VERSION, page_size,
+                root.type.encode('ascii'), serialize_hash(root.hash, 32),
+                stack[0][0], count, root.size, root.length))
+        os.rename(temp, path)
+    except:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+    return count
+
+class IndexFile(object):
+    """A read-only, memory-mapped image of a Patricia tree written by
+    `export_index()`. Keys and values are as for the index class the image
+    was exported from, e.g. `TxIdIndex`:
+
+        with IndexFile(path) as index:
+            if txid in index:
+                unspent = index[txid]
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as file_:
+            self._mmap = mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            view = memoryview(self._mmap)
+            self._slice = lambda offset, length: view[offset:offset+length]
+        except TypeError:
+            # Python 2 `mmap` objects only support the old buffer interface.
+            self._slice = lambda offset, length: buffer(self._mmap, offset, length)
+
+        (magic, version, self.page_size, type_, root_hash, self._root,
+         self.count, self.size, self.length) = _header.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError(u"not an index file")
+        if version != VERSION:
+            raise ValueError(u"unsupported index file version %d" % version)
+        self.type = type_.rstrip(b'\x00').decode('ascii')
+        self.root_hash = _hash(root_hash)
+        self.node_class = PatriciaNode.__mapper__.polymorphic_map[self.type].class_
+
+    def close(self):
+        self._slice = None
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.length
+
+    def _read_node(self, offset):
+        """Returns the (hash, flags, branches, value) of the node at `offset`,
+        where branches is a list of (prefix, child offset or None, child hash
+        or None) tuples, and the hash and value are zero-copy slices."""
+        hash_, flags, size, length = _node.unpack_from(self._mmap, offset)
+        hash_ = self._slice(offset, 32)
+        offset += _node.size
+        branches = []
+        for implicit, shift, prune in _implicit:
+            if not (flags >> shift) & 3:
+                continue
+            bitlength = _length.unpack_from(self._mmap, offset)[0]
+            offset += _length.size
+            bytelength = (bitlength + 7) // 8
+            prefix = implicit + Bits(bytes=self._mmap[offset:offset+bytelength],
+                                     length=bitlength)
+            offset += bytelength
+            if flags & (1 << prune):
+                branches.append((prefix, None, self._slice(offset, 32)))
+                offset += 32
+            else:
+                branches.append((prefix,
+                    _offset.unpack_from(self._mmap, offset)[0], None))
+                offset += _offset.size
+        value = None
+        if flags & (1 << core.PatriciaNode.HAS_VALUE):
+            length = _length.unpack_from(self._mmap, offset)[0]
+            value = self._slice(offset + _length.size, length)
+        return (hash_, flags, branches, value)
+
+    def _walk(self, key):
+        """Follows `key` from the root, as `PatriciaNode._get_node_by_key()`.
+        Returns the list of (offset, node) pairs visited, and whether the key
+        was consumed in full."""
+        subkey, offset, path = key, self._root, []
+        while True:
+            node = self._read_node(offset)
+            path.append((offset, node))
+            if not len(subkey):
+                return (path, True)
+            for prefix, child, hash_ in node[2]:
+                if subkey.startswith(prefix):
+                    if child is None:
+                        return (path, False)
+                    subkey, offset = subkey[len(prefix):], child
+                    break
+            else:
+                return (path, False)
+
+    def get_view(self, key):
+        """Returns the serialized value for `key` as a zero-copy slice of the
+        mapped file, or None if the key is not present."""
+        path, found = self._walk(self.node_class._prepare_key(key))
+        return path[-1][1][3] if found else None
+
+    def __contains__(self, key):
+        return self.get_view(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get_view(key)
+        if value is None:
+            raise KeyError(key)
+        return self.node_class._unpickle_value(bytes(value))
+
+    def get(self, key, value=None):
+        try:
+            return self[key]
+        except KeyError:
+            return value
+
+    def proof(self, key):
+        """Returns the digest serializations of the nodes on the path from the
+        root to `key`, or to the point where the path to `key` leaves the
+        tree. Each hashes to the value committed to by its parent, and the
+        first to `root_hash`. See `verify_proof()`."""
+        path, found = self._walk(self.node_class._prepare_key(key))
+        proof = []
+        for offset, (hash_, flags, branches, value) in path:
+            if value is not None:
+                value = bytes(value)
+            proof.append(node_digest(flags, [(prefix, _hash(
+                    digest if child is None else self._slice(child, 32)))
+                for prefix, child, digest in branches], value))
+        return proof
+
+def verify_proof(root_hash, key, proof, node_class=PatriciaNode):
+    """Checks a proof returned by `IndexFile.proof()` against `root_hash`.
+    Returns the serialized value of `key` if the proof shows it present, or
+    None if the proof shows it absent; raises `ValueError` if the proof is
+    invalid."""
+    subkey, hash_ = node_class._prepare_key(key), root_hash
+    for index, digest in enumerate(proof):
+        if hash256.new(digest).intdigest() != hash_:
+            raise ValueError(u"proof does not match the committed hash")
+        file_ = StringIO(digest)
+        flags = ord(file_.read(1))
+        branches = []
+        for implicit, shift, prune in _implicit:
+            bitlength = (flags >> shift) & 3
+            if not bitlength:
+                continue
+            if bitlength == 3:
+                bitlength = deserialize_varint(file_) + 3
+            prefix = implicit + Bits(bytes=file_.read((bitlength + 6) // 8),
+                                     length=bitlength - 1)
+            branches.append((prefix, deserialize_hash(file_, 32)))
+        value = None
+        if flags & (1 << core.PatriciaNode.HAS_VALUE):
+            value = deserialize_varchar(file_)
+
+        last = index == len(proof) - 1
+        if not len(subkey):
+            if not last:
+                raise ValueError(u"proof continues past the key")
+            return value
+        for prefix, child in branches:
+            if subkey.startswith(prefix):
+                subkey, hash_ = subkey[len(prefix):], child
+                break
+        else:
+            if not last:
+                raise ValueError(u"proof continues past the key")
+            return None
+    raise ValueError(u"proof ends before the key")
@@ -0,0 +1,898 @@
+# -*- coding: utf-8 -*-
+
+# SQLAlchemy object-relational mapper
+from sqlalchemy import *
+from sqlalchemy import event
+
+from . import batching
+from .batching import _chunks, _pages, _slices
+from .core import Block, BlockStats, BlockTransactionListNode, Chain, \
+    Checkpoint, ConnectedBlockInfo, Input, Output, SharedScript, Transaction
+from .locking import insert_ignore, lock_blocks, lock_hashes
+from .mempool import _evict_conflicts, promote
+from .query import best_tip
+
+# Set-based maintenance of the derived columns which depend upon a block being
+# part of the best chain. None of this is done by the ORM, since a block may
+# be stored (and even have a `ConnectedBlockInfo`) long before it becomes, or
+# after it ceases to be, part of the best chain. Callers connecting a block
+# to the tip call `connect_block()`, and `disconnect_block()` when unwinding
+# it, or `reorganize()` to switch branches in one transaction. Each
+# operation takes a list of block ids, so that a run of blocks can be
+# processed with a handful of statements.
+#
+# Connecting and disconnecting first lock the blocks involved (see
+# `sa_bitcoin.locking`), so that any number of connectors may share a
+# database.
+#
+# Transactions staged in the mempool are promoted as the blocks connecting
+# them are stored, and the derived columns of the promoted rows are then
+# maintained here like those of any other transaction. Connecting a block
+# also evicts the staged transactions which it double-spends (see
+# `sa_bitcoin.mempool`).
+
+def _block_inputs(block_ids):
+    "Selects the non-coinbase inputs of the transactions in a list of blocks"
+    input_, node = Input.__table__, BlockTransactionListNode.__table__
+    return (select([input_, node.c.block_id])
+        .select_from(input_.join(node,
+            node.c.transaction_id == input_.c.transaction_id))
+        .where(node.c.block_id.in_(block_ids) &
+              ~((input_.c.hash == 0) & (input_.c.index == 0xffffffff))))
+
+def _link_inputs(session, block_ids):
+    input_, output, tx = Input.__table__, Output.__table__, Transaction.__table__
+    block, count = Block.__table__, 0
+    for chunk in _chunks(list(block_ids)):
+        inputs = _block_inputs(chunk).alias()
+        for rows in _pages(session,
+                select([inputs.c.transaction_id, inputs.c.offset,
+                        inputs.c.block_id,
+                        output.c.transaction_id.label('output_transaction_id'),
+                        output.c.offset.label('output_offset')])
+                .select_from(inputs
+                    .join(block, block.c.id == inputs.c.block_id)
+                    .join(tx, (tx.c.chain_id == block.c.chain_id) &
+                              (tx.c.hash == inputs.c.hash))
+                    .join(output, (output.c.transaction_id == tx.c.id) &
+                                  (output.c.offset == inputs.c.index)))
+                .where(inputs.c.output_transaction_id == None),
+                [inputs.c.transaction_id, inputs.c.offset,
+                 inputs.c.block_id]):
+            session.execute(input_.update()
+                .where((input_.c.transaction_id == bindparam('_transaction_id')) &
+                       (input_.c.offset == bindparam('_offset')))
+                .values(output_transaction_id = bindparam('_output_transaction_id'),
+                        output_offset         = bindparam('_output_offset')),
+                [{'_transaction_id':        row.transaction_id,
+                  '_offset':                row.offset,
+                  '_output_transaction_id': row.output_transaction_id,
+                  '_output_offset':         row.output_offset} for row in rows])
+            count += len(rows)
+    return count
+
+def link_inputs(session, block_id):
+    """Sets `Input.output` for every input of the block with the passed id
+    which is not yet linked to the output it spends, by matching the input's
+    (hash, index) outpoint against the confirmed transactions of the same
+    chain. Inputs spending an output which has not been stored are left
+    unlinked."""
+    return _link_inputs(session, [block_id])
+
+def _spender(row, height):
+    "The (transaction id, offset) recorded as spending an output, if any"
+    if height is None:
+        return (None, None)
+    return (row.transaction_id, row.offset)
+
+def _update_spent(session, heights):
+    # `heights` maps block ids to the height at which their inputs spend, or
+    # to None to clear the spends.
+    output, count = Output.__table__, 0
+    for chunk in _chunks(list(heights)):
+        inputs = _block_inputs(chunk).alias()
+        # The outputs are written in primary key order, across pages, so that
+        # connectors spending the same outputs (from blocks of different
+        # branches) wait for one another rather than deadlock. Each output
+        # is addressed by its primary key, so this is one indexed write per
+        # spent output rather than a scan of the output table.
+        for rows in _pages(session,
+                select([inputs.c.transaction_id, inputs.c.offset,
+                        inputs.c.block_id, inputs.c.output_transaction_id,
+                        inputs.c.output_offset])
+                .where(inputs.c.output_transaction_id != None),
+                [inputs.c.output_transaction_id, inputs.c.output_offset,
+                 inputs.c.transaction_id, inputs.c.offset,
+                 inputs.c.block_id]):
+            session.execute(output.update()
+                .where((output.c.transaction_id == bindparam('_transaction_id')) &
+                       (output.c.offset == bindparam('_offset')))
+                .values(spent_by_transaction_id = bindparam('_spent_by_transaction_id'),
+                        spent_by_offset         = bindparam('_spent_by_offset'),
+                        spent_height            = bindparam('_spent_height')),
+                [{'_transaction_id':          row.output_transaction_id,
+                  '_offset':                  row.output_offset,
+                  '_spent_by_transaction_id': spender[0],
+                  '_spent_by_offset':         spender[1],
+                  '_spent_height':            height}
+                 for row in rows
+                 for height in (heights[row.block_id],)
+                 for spender in (_spender(row, height),)])
+            count += len(rows)
+    return count
+
+def mark_spent(session, block_id, height):
+    """Records each output spent by the block with the passed id as spent by
+    the corresponding input at `height`. Inputs must already be linked."""
+    return _update_spent(session, {block_id: height})
+
+def clear_spent(session, block_id):
+    "Reverts `mark_spent()` for the block with the passed id."
+    return _update_spent(session, {block_id: None})
+
+# Standard contract templates, as (destination_type, length, [(position,
+# bytes)], payload position) tuples, with 1-based positions as used by the SQL
+# substr() function:
+#
+#   pubkey_hash: OP_DUP OP_HASH160 <20 bytes> OP_EQUALVERIFY OP_CHECKSIG
+#   script_hash: OP_HASH160 <20 bytes> OP_EQUAL
+#
+# The 20-byte payload is stored as-is, which is the serialized form of the
+# `Hash160` value of the corresponding address.
+DESTINATION_TEMPLATES = (
+    ('pubkey_hash', 25, [(1, b'\x76\xa9\x14'), (24, b'\x88\xac')], 4),
+    ('script_hash', 23, [(1, b'\xa9\x14'),     (23, b'\x87')],     3),
+)
+
+def _contract(output):
+    "The contract of a row of the output table, whether inline or shared"
+    script = SharedScript.__table__
+    return func.coalesce(output.c.contract,
+        select([script.c.script])
+        .where(script.c.id == output.c.contract_id)
+        .as_scalar())
+
+def _materialize_destinations(session, where):
+    output, count = Output.__table__, 0
+    contract = _contract(output)
+    for type_, length, patterns, position in DESTINATION_TEMPLATES:
+        match = func.length(contract) == length
+        for start, bytes_ in patterns:
+            match &= (func.substr(contract, start, len(bytes_)) ==
+                      literal(bytes_, LargeBinary))
+        count += session.execute(output.update()
+            .where(where & (output.c.destination_type == None) & match)
+            .values(destination_type = type_,
+                    destination_hash = func.substr(
+                        contract, position, 20))).rowcount
+    return count
+
+def _materialize_blocks(session, block_ids):
+    output, node = Output.__table__, BlockTransactionListNode.__table__
+    return sum(_materialize_destinations(session, output.c.transaction_id.in_(
+        select([node.c.transaction_id]).where(node.c.block_id.in_(chunk))))
+        for chunk in _chunks(list(block_ids)))
+
+def materialize_destinations(session, block_id):
+    """Derives `Output.destination_type` and `Output.destination_hash` for
+    the outputs of the block with the passed id, with one set-based UPDATE
+    per contract template. Returns the number of outputs updated."""
+    return _materialize_blocks(session, [block_id])
+
+def backfill_destinations(session, batch_size=10000):
+    """Derives the destination columns of existing outputs, in batches of
+    `batch_size` transaction ids. This is a generator which yields the pair
+    (last transaction id processed, outputs updated) after each batch, so
+    the caller can commit and report progress between batches:
+
+        for upto, count in backfill_destinations(session):
+            session.commit()
+    """
+    output = Output.__table__
+    last = session.execute(select([func.max(output.c.transaction_id)])).scalar()
+    start = session.execute(select([func.min(output.c.transaction_id)])).scalar()
+    while start is not None and start <= last:
+        end = start + batch_size
+        count = _materialize_destinations(session,
+            (output.c.transaction_id >= start) &
+            (output.c.transaction_id <  end))
+        yield (min(end, last+1) - 1, count)
+        start = end
+
+def _update_values(session, where):
+    tx, input_, output = \
+        Transaction.__table__, Input.__table__, Output.__table__
+    spent = output.alias()
+    output_amount = (select([func.coalesce(func.sum(output.c.amount), 0)])
+        .where(output.c.transaction_id == tx.c.id)
+        .as_scalar())
+    input_amount = (select([func.sum(spent.c.amount)])
+        .select_from(input_.join(spent,
+            (spent.c.transaction_id == input_.c.output_transaction_id) &
+            (spent.c.offset == input_.c.output_offset)))
+        .where(input_.c.transaction_id == tx.c.id)
+        .as_scalar())
+    unlinked = exists().where(
+        (input_.c.transaction_id == tx.c.id) &
+        (input_.c.output_transaction_id == None) &
+       ~((input_.c.hash == 0) & (input_.c.index == 0xffffffff)))
+    count = session.execute(tx.update()
+        .where(where)
+        .values(output_amount = output_amount,
+                input_amount  = case([(unlinked, null())],
+                                     else_ = input_amount))).rowcount
+    # A second statement, since within one UPDATE the right-hand sides see
+    # the columns' old values.
+    session.execute(tx.update()
+        .where(where)
+        .values(fee = tx.c.input_amount - tx.c.output_amount))
+    return count
+
+def _update_block_values(session, block_ids):
+    tx, node = Transaction.__table__, BlockTransactionListNode.__table__
+    return sum(_update_values(session, tx.c.id.in_(
+        select([node.c.transaction_id]).where(node.c.block_id.in_(chunk))))
+        for chunk in _chunks(list(block_ids)))
+
+def update_values(session, block_id):
+    """Computes `Transaction.input_amount`, `Transaction.output_amount` and
+    `Transaction.fee` for the transactions of the block with the passed id,
+    with set-based UPDATEs over their linked inputs and outputs. Returns the
+    number of transactions updated."""
+    return _update_block_values(session, [block_id])
+
+def backfill_values(session, batch_size=10000):
+    """Computes the value columns of existing transactions, in batches of
+    `batch_size` transaction ids. Like `backfill_destinations()` this is a
+    generator yielding (last transaction id processed, transactions updated)
+    after each batch."""
+    tx = Transaction.__table__
+    last = session.execute(select([func.max(tx.c.id)])).scalar()
+    start = session.execute(select([func.min(tx.c.id)])).scalar()
+    while start is not None and start <= last:
+        end = start + batch_size
+        count = _update_values(session,
+            (tx.c.id >= start) & (tx.c.id < end))
+        yield (min(end, last+1) - 1, count)
+        start = end
+
+def _varint_size(n):
+    "The serialized size of the variable-length integer `n`"
+    return case([(n < 0xfd,       1),
+                 (n <= 0xffff,     3),
+                 (n <= 0xffffffff, 5)], else_ = 9)
+
+def _store_stats(session, block_ids):
+    block, info, node = Block.__table__, ConnectedBlockInfo.__table__, \
+        BlockTransactionListNode.__table__
+    tx, input_, output, stats = Transaction.__table__, Input.__table__, \
+        Output.__table__, BlockStats.__table__
+    count = 0
+    for chunk in _chunks(list(block_ids)):
+        session.execute(stats.delete().where(stats.c.block_id.in_(chunk)))
+        tx_ids = select([node.c.transaction_id]).where(node.c.block_id.in_(chunk))
+
+        # Per-transaction counts and serialized sizes of the inputs (outpoint,
+        # endorsement and sequence) and outputs (amount and contract).
+        endorsement = func.length(input_.c.endorsement)
+        inputs = (select([input_.c.transaction_id,
+                          func.count().label('count'),
+                          func.sum(40 + _varint_size(endorsement) +
+                                   endorsement).label('size')])
+            .where(input_.c.transaction_id.in_(tx_ids))
+            .group_by(input_.c.transaction_id)).alias()
+        contract = func.length(_contract(output))
+        outputs = (select([output.c.transaction_id,
+                           func.count().label('count'),
+                           func.sum(output.c.amount).label('amount'),
+                           func.sum(8 + _varint_size(contract) +
+                                    contract).label('size')])
+            .where(output.c.transaction_id.in_(tx_ids))
+            .group_by(output.c.transaction_id)).alias()
+
+        input_count = func.coalesce(inputs.c.count, 0)
+        output_count = func.coalesce(outputs.c.count, 0)
+        tx_size = (8 + # version and lock time
+            _varint_size(input_count) + func.coalesce(inputs.c.size, 0) +
+            _varint_size(output_count) + func.coalesce(outputs.c.size, 0) +
+            case([(tx.c.format == 1, 4)], else_ = 0)) # reference height
+        txs = (select([node.c.block_id,
+                       func.count().label('transaction_count'),
+                       func.sum(input_count).label('input_count'),
+                       func.sum(output_count).label('output_count'),
+                       func.sum(outputs.c.amount).label('output_amount'),
+                       func.sum(tx.c.fee).label('fee'),
+                       func.sum(tx_size).label('size')])
+            .select_from(node
+                .join(tx, tx.c.id == node.c.transaction_id)
+                .outerjoin(inputs, inputs.c.transaction_id == tx.c.id)
+                .outerjoin(outputs, outputs.c.transaction_id == tx.c.id))
+            .where(node.c.block_id.in_(chunk))
+            .group_by(node.c.block_id)).alias()
+
+        transaction_count = func.coalesce(txs.c.transaction_count, 0)
+        count += session.execute(stats.insert().from_select(
+            ['block_id', 'chain_id', 'height', 'time', 'transaction_count',
+             'input_count', 'output_count', 'output_amount', 'fee', 'size'],
+            select([block.c.id, info.c.chain_id, info.c.height, block.c.time,
+                    transaction_count,
+                    func.coalesce(txs.c.input_count, 0),
+                    func.coalesce(txs.c.output_count, 0),
+                    func.coalesce(txs.c.output_amount, 0),
+                    func.coalesce(txs.c.fee, 0),
+                    80 + _varint_size(transaction_count) +
+                        func.coalesce(txs.c.size, 0)])
+            .select_from(block
+                .join(info, info.c.block_id == block.c.id)
+                .outerjoin(txs, txs.c.block_id == block.c.id))
+            .where(block.c.id.in_(chunk)))).rowcount
+    return count
+
+def store_stats(session, block_id):
+    """(Re)computes the `BlockStats` row of the connected block with the
+    passed id from its stored transactions, with a single INSERT ... SELECT.
+    Transaction values must be up to date, as after `update_values()`."""
+    return _store_stats(session, [block_id])
+
+def backfill_stats(session, batch_size=1000):
+    """Computes the `BlockStats` rows of existing connected blocks, in
+    batches of `batch_size` block ids. Like `backfill_destinations()` this
+    is a generator yielding (last block id processed, rows written) after
+    each batch. Run `backfill_values()` first, for the fee totals."""
+    info = ConnectedBlockInfo.__table__
+    last = session.execute(select([func.max(info.c.block_id)])).scalar()
+    start = session.execute(select([func.min(info.c.block_id)])).scalar()
+    while start is not None and start <= last:
+        end = start + batch_size
+        block_ids = [row[0] for row in session.execute(
+            select([info.c.block_id])
+            .where((info.c.block_id >= start) & (info.c.block_id < end)))]
+        yield (min(end, last+1) - 1, _store_stats(session, block_ids))
+        start = end
+
+def _connect_blocks(session, heights):
+    _link_inputs(session, heights)
+    _update_spent(session, heights)
+    _materialize_blocks(session, heights)
+    _update_block_values(session, heights)
+    _store_stats(session, heights)
+    _evict_conflicts(session, heights)
+
+def connect_blocks(session, heights):
+    """Updates the derived indexes for a run of blocks becoming part of the
+    best chain, given as a dictionary mapping block ids to their heights.
+    The blocks' transactions must have been flushed to the database."""
+    lock_blocks(session, heights)
+    _connect_blocks(session, heights)
+
+def connect_block(session, block_id, height):
+    """Updates the derived indexes for the block with the passed id becoming
+    the best chain tip at `height`. The block's transactions must have been
+    flushed to the database."""
+    connect_blocks(session, {block_id: height})
+
+def _invalidate(session, cache, block_ids):
+    # Entries at and above the lowest of the blocks are dropped.
+    block, info = Block.__table__, ConnectedBlockInfo.__table__
+    lowest = {}
+    for chunk in _chunks(list(block_ids)):
+        for row in session.execute(select([block.c.chain_id, info.c.height])
+                .select_from(block.join(info, info.c.block_id == block.c.id))
+                .where(block.c.id.in_(chunk))):
+            lowest[row.chain_id] = min(row.height,
+                lowest.get(row.chain_id, row.height))
+    chains = [(session.query(Chain).get(chain_id), height)
+              for chain_id, height in lowest.iteritems()]
+    def invalidate(session=None):
+        for chain, height in chains:
+            cache.invalidate(chain, height)
+    invalidate()
+    # Until the session commits, other sessions still see the blocks as
+    # connected, and may admit their entries again.
+    event.listen(session, 'after_commit', invalidate, once=True)
+
+def _disconnect_blocks(session, block_ids, cache=None):
+    _update_spent(session, dict.fromkeys(block_ids))
+    stats = BlockStats.__table__
+    for chunk in _chunks(list(block_ids)):
+        session.execute(stats.delete().where(stats.c.block_id.in_(chunk)))
+    if cache is not None:
+        _invalidate(session, cache, block_ids)
+
+def disconnect_block(session, block_id, cache=None):
+    """Reverts `connect_block()` for the block with the passed id, which must
+    be the current best chain tip. Input links are left in place, since an
+    outpoint names the same output whichever branch is connected, and so are
+    the values of the block's transactions, which depend only on those
+    links. The block's `BlockStats` row is removed. If a `cache.QueryCache`
+    is passed, its entries at and above the block's height are dropped, both
+    now and when the session commits.
+
+    To disconnect one branch and connect another in a single transaction,
+    use `reorganize()` instead."""
+    lock_blocks(session, [block_id])
+    _disconnect_blocks(session, [block_id], cache)
+
+def reorganize(session, disconnect_ids, connect_heights, cache=None):
+    """Makes another branch the best chain, in the session's transaction:
+    reverts `connect_block()` for the blocks with the ids `disconnect_ids`,
+    the old branch back to the fork point, as for `disconnect_block()`, and
+    then connects the new branch, given as for `connect_blocks()` by a
+    dictionary mapping block ids to their heights.
+
+    The blocks of both branches and their parents are locked together before
+    anything is written, in the single global order of `sa_bitcoin.locking`.
+    Locking each side as it is processed would take the locks of one
+    transaction in two batches, and two reorganizations between the same
+    branches in opposite directions could then deadlock."""
+    disconnect_ids = list(disconnect_ids)
+    lock_blocks(session, disconnect_ids + list(connect_heights))
+    _disconnect_blocks(session, disconnect_ids, cache)
+    _connect_blocks(session, connect_heights)
+
+def branches(session, old_id, new_id):
+    """Returns the arguments of `reorganize()` which switch the best chain
+    from the tip with the id `old_id` to the stored block with the id
+    `new_id`: the ids of the blocks from the old tip back to the fork point,
+    and a dictionary mapping the ids of the blocks from the new one back to
+    the fork point to their heights. Both blocks must have a
+    `ConnectedBlockInfo`, which is walked back one block at a time."""
+    info = ConnectedBlockInfo.__table__
+    def parent(block_id):
+        if block_id is None:
+            return (None, -1)
+        row = session.execute(select([info.c.parent_id, info.c.height])
+            .where(info.c.block_id == block_id)).first()
+        return (row.parent_id, row.height)
+
+    disconnect_ids, connect_heights = [], {}
+    (old_parent, old_height), (new_parent, new_height) = \
+        parent(old_id), parent(new_id)
+    while old_id != new_id:
+        if old_height >= new_height:
+            disconnect_ids.append(old_id)
+            old_id, (old_parent, old_height) = \
+                old_parent, parent(old_parent)
+        else:
+            connect_heights[new_id] = new_height
+            new_id, (new_parent, new_height) = \
+                new_parent, parent(new_parent)
+    return disconnect_ids, connect_heights
+
+# ===----------------------------------------------------------------------===
+
+# Assume-valid ingest. Blocks at or below the highest `Checkpoint` of a chain
+# are committed to by the checkpoint hash, since every header commits to its
+# parent. Such blocks are therefore written with bulk Core statements rather
+# than through the unit of work, which skips the ORM validators, lazy default
+# evaluation and per-object flush bookkeeping, and the `ConnectedBlockInfo`
+# rows of the whole batch are computed in a single pass. Nothing is verified
+# per block; instead the chain is checked against the checkpoint hash once the
+# checkpointed block has been written, and any block below it which is not
+# its ancestor is rejected. Blocks above the checkpoint go through the ORM and
+# are fully validated as before.
+
+def last_checkpoint(session, chain):
+    "Returns the highest `Checkpoint` of `chain`, or None if it has none."
+    return (session.query(Checkpoint)
+        .filter(Checkpoint.chain_id == chain.id)
+        .order_by(Checkpoint.height.desc())
+        .first())
+
+def _connected_infos(session, chain, blocks):
+    """Computes the (parent id, height, aggregate work) of each of the passed
+    blocks, which must be ordered so that every block follows its parent.
+    Parents which precede the batch are looked up in one query; the parent
+    id is None for the genesis block and for parents within the batch."""
+    block, info = Block.__table__, ConnectedBlockInfo.__table__
+    hashes = set(x.hash for x in blocks)
+    missing = list(set(x.parent_hash for x in blocks) - hashes)
+    known = {}
+    for chunk in _chunks(missing):
+        known.update((row.hash, (row.id, row.height, int(row.aggregate_work)))
+            for row in session.execute(
+                select([block.c.hash, block.c.id,
+                        info.c.height, info.c.aggregate_work])
+                .select_from(block.join(info, info.c.block_id == block.c.id))
+                .where((block.c.chain_id == chain.id) &
+                       block.c.hash.in_(chunk))))
+
+    infos = []
+    for x in blocks:
+        if x.parent_hash in known:
+            parent, height, work = known[x.parent_hash]
+            height, work = height + 1, work + x.work
+        elif not x.parent_hash:
+            parent, height, work = None, 0, x.work
+        else:
+            raise ValueError(u"parent of block %064x is not connected"
+                % x.hash)
+        known[x.hash] = (None, height, work)
+        infos.append((parent, height, work))
+    return infos
+
+def _store_scripts(session, scripts):
+    """Stores those of the passed scripts which are not yet shared, once
+    each, and returns a dictionary mapping every passed script to its
+    `SharedScript.id`. A script stored by another session meanwhile is
+    skipped, and its id read back."""
+    script = SharedScript.__table__
+    digests = dict((SharedScript.digest(x), x) for x in set(scripts))
+    def lookup(hashes):
+        for chunk in _chunks(hashes):
+            ids.update((digests[row.hash], row.id) for row in session.execute(
+                select([script.c.hash, script.c.id])
+                .where(script.c.hash.in_(chunk))))
+    ids = {}
+    lookup(list(digests))
+    new = [hash for hash, x in digests.iteritems() if x not in ids]
+    if new:
+        session.execute(insert_ignore(script),
+            [{'hash': hash, 'script': digests[hash]} for hash in new])
+        lookup(new)
+    return ids
+
+def _transaction_ids(session, chain, hashes):
+    """Returns a dictionary mapping those of the passed hashes which are the
+    hashes of stored transactions of `chain` to their `Transaction.id`."""
+    tx, ids = Transaction.__table__, {}
+    for chunk in _chunks(list(set(hashes))):
+        ids.update((row.hash, row.id) for row in session.execute(
+            select([tx.c.hash, tx.c.id])
+            .where((tx.c.chain_id == chain.id) & tx.c.hash.in_(chunk))))
+    return ids
+
+def _share_contracts(session, transaction_ids):
+    """Moves the inline contracts of the outputs of the transactions with the
+    passed ids into `SharedScript` rows, as for `_store_transactions()`."""
+    output = Output.__table__
+    for chunk in _chunks(list(transaction_ids)):
+        rows = session.execute(
+            select([output.c.transaction_id, output.c.offset,
+                    output.c.contract])
+            .where(output.c.transaction_id.in_(chunk) &
+                   (output.c.contract != None))).fetchall()
+        if not rows:
+            continue
+        script_ids = _store_scripts(session, [row.contract for row in rows])
+        session.execute(output.update()
+            .where((output.c.transaction_id == bindparam('_transaction_id')) &
+                   (output.c.offset == bindparam('_offset')))
+            .values(contract    = None,
+                    contract_id = bindparam('_contract_id')),
+            [{'_transaction_id': row.transaction_id,
+              '_offset':         row.offset,
+              '_contract_id':    script_ids[row.contract]} for row in rows])
+
+def _store_transactions(session, chain, transactions, share_scripts=False):
+    """Bulk-inserts those of the passed transactions which are not yet stored
+    for `chain`, and returns a dictionary mapping the hash of every passed
+    transaction to its `Transaction.id`. If `share_scripts` is set output
+    contracts are stored as references to `SharedScript` rows."""
+    tx = Transaction.__table__
+    ids = _transaction_ids(session, chain, [x.hash for x in transactions])
+
+    new = []
+    for x in transactions:
+        if x.hash not in ids:
+            ids[x.hash] = None
+            new.append(x)
+    if not new:
+        return ids
+
+    session.execute(tx.insert(), [{
+        'chain_id':         chain.id,
+        'format':           getattr(x, 'format', 0),
+        'version':          x.version,
+        'lock_time':        x.lock_time,
+        'reference_height': x.reference_height,
+        'hash':             x.hash,
+    } for x in new])
+    ids.update(_transaction_ids(session, chain, [x.hash for x in new]))
+
+    inputs = [{
+        'transaction_id': ids[x.hash],
+        'offset':         offset,
+        'hash':           input.hash,
+        'index':          input.index,
+        'endorsement':    input.endorsement,
+        'sequence':       input.sequence,
+    } for x in new for offset, input in enumerate(x.inputs)]
+    if inputs:
+        session.execute(Input.__table__.insert(), inputs)
+    outputs = [{
+        'transaction_id': ids[x.hash],
+        'offset':         offset,
+        'amount':         output.amount,
+        'contract':       output.contract,
+        'contract_id':    None,
+    } for x in new for offset, output in enumerate(x.outputs)]
+    if share_scripts:
+        script_ids = _store_scripts(session, [row['contract'] for row in outputs])
+        for row in outputs:
+            row['contract_id'] = script_ids[row['contract']]
+            row['contract'] = None
+    if outputs:
+        session.execute(Output.__table__.insert(), outputs)
+    return ids
+
+def _store_blocks(session, chain, blocks, infos, share_scripts=False,
+                  chunk_size=None, staged=()):
+    """Bulk-inserts the passed blocks, with their `ConnectedBlockInfo` rows
+    and transactions, and returns their ids. Transactions of the blocks
+    with the hashes `staged` which are staged in the mempool are promoted
+    rather than inserted anew."""
+    block, info = Block.__table__, ConnectedBlockInfo.__table__
+    session.execute(block.insert(), [{
+        'chain_id':    chain.id,
+        'format':      getattr(x, 'format', 0),
+        'version':     x.version,
+        'parent_hash': x.parent_hash,
+        'merkle_hash': x.merkle_hash,
+        'time':        x.time,
+        'bits':        x.bits,
+        'nonce':       x.nonce,
+        'hash':        x.hash,
+    } for x in blocks])
+    ids = {}
+    for chunk in _chunks([x.hash for x in blocks]):
+        ids.update((row.hash, row.id) for row in session.execute(
+            select([block.c.hash, block.c.id])
+            .where((block.c.chain_id == chain.id) & block.c.hash.in_(chunk))))
+
+    # The ids of parents within the batch were not known when the connection
+    # information was computed.
+    session.execute(info.insert(), [{
+        'block_id':       ids[x.hash],
+        'parent_id':      ids.get(x.parent_hash, parent),
+        'chain_id':       chain.id,
+        'height':         height,
+        'aggregate_work': work,
+    } for x, (parent, height, work) in zip(blocks, infos)])
+
+    # Transactions are written `chunk_size` at a time, if given, consuming
+    # each block's `transactions` only once and as they are needed.
+    staged_ids = set(ids[hash] for hash in staged)
+    for chunk in _slices(((ids[x.hash], offset, tx) for x in blocks
+            for offset, tx in enumerate(getattr(x, 'transactions', ()))),
+            chunk_size):
+        promoted = promote(session, chain, [tx.hash
+            for block_id, offset, tx in chunk if block_id in staged_ids])
+        if share_scripts and promoted:
+            _share_contracts(session, promoted.values())
+        tx_ids = _store_transactions(session, chain,
+            [tx for block_id, offset, tx in chunk], share_scripts)
+        session.execute(BlockTransactionListNode.__table__.insert(), [{
+            'block_id':       block_id,
+            'offset':         offset,
+            'transaction_id': tx_ids[tx.hash],
+        } for block_id, offset, tx in chunk])
+    return [ids[x.hash] for x in blocks]
+
+def verify_checkpoint(session, chain, checkpoint):
+    """Checks that the stored block of `chain` at the height of the passed
+    checkpoint has the checkpointed hash, and that every other block of
+    `chain` at or below that height is one of its ancestors, raising
+    `ValueError` otherwise. As each header commits to its parent, the
+    ancestors are verified by the checkpoint hash. Blocks off the
+    checkpointed chain have not been validated at all, since they are
+    written in bulk, and are rejected."""
+    block, info = Block.__table__, ConnectedBlockInfo.__table__
+    block_id = session.execute(select([block.c.id])
+        .select_from(block.join(info, info.c.block_id == block.c.id))
+        .where((block.c.chain_id == chain.id) &
+               (block.c.hash == checkpoint.hash) &
+               (info.c.height == checkpoint.height))).scalar()
+    if block_id is None:
+        raise ValueError(u"no block at height %d matches the checkpoint"
+            % checkpoint.height)
+
+    # The ancestors are found by walking `parent_id` back from the
+    # checkpointed block, through the blocks of `PAGE_SIZE` heights at a
+    # time. Any block of a page which the walk does not pass through is off
+    # the checkpointed chain.
+    top = checkpoint.height
+    while top >= 0:
+        bottom = max(0, top - batching.PAGE_SIZE + 1)
+        rows = session.execute(
+            select([info.c.block_id, info.c.parent_id, info.c.height])
+            .where((info.c.chain_id == chain.id) &
+                   info.c.height.between(bottom, top))).fetchall()
+        parents, ancestors = dict((row.block_id, row.parent_id)
+                                  for row in rows), set()
+        while block_id in parents:
+            ancestors.add(block_id)
+            block_id = parents[block_id]
+        forks = [row.height for row in rows if row.block_id not in ancestors]
+        if forks:
+            raise ValueError(u"a block at height %d is not an ancestor of "
+                u"the checkpoint" % min(forks))
+        top = bottom - 1
+
+def _orm_transaction(chain, tx):
+    "Returns an ORM `Transaction` equivalent to the passed transaction."
+    if isinstance(tx, Transaction):
+        return tx
+    return Transaction(chain=chain, format=getattr(tx, 'format', 0),
+        version=tx.version, lock_time=tx.lock_time,
+        reference_height=tx.reference_height,
+        inputs=[Input(hash=i.hash, index=i.index,
+                      endorsement=i.endorsement, sequence=i.sequence)
+                for i in tx.inputs],
+        outputs=[Output(amount=o.amount, contract=o.contract)
+                 for o in tx.outputs])
+
+def _orm_block(chain, x, transactions=True):
+    """Returns an ORM `Block` equivalent to the passed header-like object,
+    with its transactions unless `transactions` is false."""
+    if isinstance(x, Block):
+        return x
+    block = Block(chain=chain, format=getattr(x, 'format', 0),
+        version=x.version, parent_hash=x.parent_hash,
+        merkle_hash=x.merkle_hash, time=x.time, bits=x.bits, nonce=x.nonce)
+    if transactions:
+        for tx in getattr(x, 'transactions', ()):
+            block.transactions.append(_orm_transaction(chain, tx))
+    return block
+
+def _promote_transactions(session, chain, block):
+    """Promotes the staged transactions of the passed ORM block, and points
+    its list nodes at the promoted rows in place of new copies."""
+    nodes = [node for node in block.transaction_list_nodes
+             if node.transaction_id is None]
+    promoted = promote(session, chain,
+        [node.transaction.hash for node in nodes])
+    with session.no_autoflush:
+        for node in nodes:
+            if node.transaction.hash in promoted:
+                node.transaction = session.query(Transaction).get(
+                    promoted[node.transaction.hash])
+
+def _stream_transactions(session, chain, block_id, transactions, chunk_size,
+                         staged=True):
+    """Stores the passed transactions of the flushed block with the passed id
+    through the ORM, `chunk_size` at a time. Each chunk is flushed and then
+    expunged from the session, so that neither the session nor the
+    `before_flush` hooks ever hold more than one chunk of objects.
+    Transactions already stored are linked to rather than duplicated, as
+    are those staged in the mempool, which are promoted, if `staged` is
+    set."""
+    offset = 0
+    for chunk in _slices(transactions, chunk_size):
+        chunk = [_orm_transaction(chain, tx) for tx in chunk]
+        if staged:
+            promote(session, chain, [tx.hash for tx in chunk])
+        ids = _transaction_ids(session, chain, [tx.hash for tx in chunk])
+        objects = []
+        for tx in chunk:
+            # Nodes are created directly, with explicit offsets, rather than
+            # through `Block.transactions`, which would keep every node of
+            # the block loaded.
+            if tx.hash in ids:
+                node = BlockTransactionListNode(block_id=block_id,
+                    offset=offset, transaction_id=ids[tx.hash])
+            else:
+                node = BlockTransactionListNode(block_id=block_id,
+                    offset=offset, transaction=tx)
+                objects.extend([tx] + list(tx.inputs) + list(tx.outputs))
+            session.add(node)
+            objects.append(node)
+            offset += 1
+        session.flush()
+        for obj in objects:
+            session.expunge(obj)
+
+class _BestTip(object):
+    "The best tip of a chain, as the blocks of a batch are stored."
+    def __init__(self, session, chain):
+        info = best_tip(session, chain).first()
+        self.hash = info.block.hash if info is not None else None
+        self.work = int(info.aggregate_work) if info is not None else 0
+        self.connected = True
+
+    def extend(self, x, work):
+        """Returns whether the passed block, with `work` aggregate work,
+        extends the connected best tip, which it then becomes. A block which
+        outweighs the tip without extending it becomes an unconnected best
+        tip, which its descendants do not extend either."""
+        extends = self.connected and (x.parent_hash or None) == self.hash
+        if extends or work > self.work:
+            self.hash, self.work, self.connected = x.hash, work, extends
+        return extends
+
+def ingest_blocks(session, chain, blocks, share_scripts=False,
+                  chunk_size=None):
+    """Stores and connects the passed blocks of `chain`, which are ordered so
+    that every block follows its parent, with the first block's parent
+    either already stored or absent for the genesis block. Blocks may be
+    `Block` instances, or any objects with the same header attributes and an
+    optional `transactions` sequence. Blocks already stored are skipped.
+
+    Only blocks which extend the best tip of `chain` are connected. Other
+    blocks, such as those of a branch with no more work than the best chain,
+    are stored with their `ConnectedBlockInfo` but not connected, and
+    neither are their descendants. Once such a branch outweighs the best
+    chain it is the caller's to switch to, with `reorganize()` given the
+    result of `branches()`, before any of its descendants are ingested. Transactions staged in the mempool of `chain`
+    are promoted rather than stored anew as the blocks connecting them are
+    stored, and those which the blocks double-spend are evicted.
+
+    Blocks at or below the highest checkpoint of `chain` are written in bulk,
+    and the result verified against the checkpoint once the block at its
+    height has been written, by this batch or an earlier one. Blocks above
+    the checkpoint are added to the session and flushed one at a time.
+    Returns the list of stored block ids, in order.
+
+    The blocks and their parents are locked first (see `sa_bitcoin.locking`),
+    so a block being stored by another connector is waited for and then
+    skipped, and a block whose parent is being stored waits for it.
+
+    If `share_scripts` is set, the output contracts of each bulk-written batch
+    are deduplicated into `SharedScript` rows, which the outputs reference
+    by id. Blocks written through the ORM store their contracts inline.
+
+    If `chunk_size` is given, transactions are written that many at a time,
+    so that memory use is bounded by the chunk size rather than by the size
+    of the largest block. Blocks above the checkpoint are then stored as a
+    flushed header followed by their transactions, each chunk of which is
+    expunged from the session once flushed (see `_stream_transactions()`).
+    To be streamed end to end a block's `transactions` may be an iterator,
+    which is consumed once; `Block` instances are stored as they are."""
+    block = Block.__table__
+    blocks = list(blocks)
+    lock_hashes(session, chain.id,
+        [x.hash for x in blocks] + [x.parent_hash for x in blocks])
+    stored = set()
+    for chunk in _chunks([x.hash for x in blocks]):
+        stored.update(row.hash for row in session.execute(
+            select([block.c.hash])
+            .where((block.c.chain_id == chain.id) & block.c.hash.in_(chunk))))
+    blocks = [x for x in blocks if x.hash not in stored]
+    if not blocks:
+        return []
+
+    infos = _connected_infos(session, chain, blocks)
+    checkpoint = last_checkpoint(session, chain)
+    split = 0
+    if checkpoint is not None:
+        while split < len(infos) and infos[split][1] <= checkpoint.height:
+            split += 1
+
+    tip = _BestTip(session, chain)
+    ids = []
+    if split:
+        extends = [tip.extend(x, work)
+                   for x, (parent, height, work) in zip(blocks, infos[:split])]
+        ids.extend(_store_blocks(session, chain, blocks[:split], infos[:split],
+            share_scripts, chunk_size,
+            [x.hash for x, connect in zip(blocks, extends) if connect]))
+        _connect_blocks(session, dict((id_, height)
+            for id_, (parent, height, work), connect
+            in zip(ids, infos, extends) if connect))
+        reached = session.execute(select([block.c.id])
+            .where((block.c.chain_id == chain.id) &
+                   (block.c.hash == checkpoint.hash))).scalar()
+        if reached is not None:
+            verify_checkpoint(session, chain, checkpoint)
+
+    for x, (parent, height, work) in zip(blocks[split:], infos[split:]):
+        connect = tip.extend(x, work)
+        streamed = chunk_size is not None and not isinstance(x, Block)
+        header, x = x, _orm_block(chain, x, transactions=not streamed)
+        if parent is None and x.parent_hash:
+            parent = session.execute(select([block.c.id])
+                .where((block.c.chain_id == chain.id) &
+                       (block.c.hash == x.parent_hash))).scalar()
+        if connect and not streamed:
+            _promote_transactions(session, chain, x)
+        x.info = ConnectedBlockInfo(chain=chain, parent_id=parent,
+            height=height, aggregate_work=work)
+        session.add(x)
+        session.flush()
+        if streamed:
+            _stream_transactions(session, chain, x.id,
+                getattr(header, 'transactions', ()), chunk_size, connect)
+        if connect:
+            _connect_blocks(session, {x.id: height})
+        ids.append(x.id)
+    return ids
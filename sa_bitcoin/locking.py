@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+# Coordination of concurrent connectors. Each process (or thread) storing,
+# connecting or disconnecting blocks first locks the blocks involved and
+# their parents, so that two connectors never work on the same block, and a
+# connector extending a block waits for the connector storing that block to
+# commit. Blocks of independent branches, and runs of blocks which do not
+# adjoin, share no locks and are processed in parallel.
+#
+# The locks belong to the session's transaction and are released when it
+# commits or rolls back; there is no explicit unlock. All the locks of a call
+# are requested at once and in a single global order, so connectors cannot
+# deadlock on them. The order only holds within a call: a transaction which
+# disconnects and connects blocks should do so with a single call to
+# `ingest.reorganize()`, and one spanning other calls should commit between
+# them:
+#
+#   - On PostgreSQL each block is a transaction-level advisory lock keyed by
+#     the chain id and 31 bits of the block hash. A collision between two
+#     hashes only makes their connectors wait for each other.
+#   - On SQLite, where there is only ever one writer, the database write
+#     lock is taken up front, before anything is read, rather than by the
+#     first write part-way through. Concurrent connectors then wait (up to
+#     the `timeout` connect argument of the engine) instead of failing with
+#     "database is locked" mid-block.
+#   - Elsewhere the `Chain` row is locked FOR UPDATE, which serializes the
+#     connectors of each chain.
+
+#
+# Rows which are looked up by a unique key and inserted if missing, such as
+# shared scripts and verified signatures, are instead inserted with
+# `insert_ignore()`, so that a connector which loses the race to insert a row
+# skips it rather than failing, and then reads back the winner's row.
+
+# SQLAlchemy object-relational mapper
+from sqlalchemy import *
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import Insert
+
+from .batching import _chunks
+from .core import Block, Chain
+
+def _key(hash):
+    "The advisory lock key of a block hash, a positive 32-bit integer"
+    return int(hash & 0x7fffffff)
+
+def lock_hashes(session, chain_id, hashes):
+    """Locks the blocks of chain `chain_id` with the passed hashes, whether
+    or not they have been stored, until the end of the session's
+    transaction."""
+    hashes = [hash for hash in set(hashes) if hash]
+    if not hashes:
+        return
+    dialect = session.connection().dialect.name
+    if dialect == 'postgresql':
+        # One statement per lock, in key order: the order in which a single
+        # statement takes its locks is up to the planner.
+        for key in sorted(set(_key(hash) for hash in hashes)):
+            session.execute(select([func.pg_advisory_xact_lock(
+                literal(chain_id, Integer), literal(key, Integer))]))
+    elif dialect == 'sqlite':
+        # A write which changes nothing still starts a write transaction.
+        chain = Chain.__table__
+        session.execute(chain.update()
+            .where(chain.c.id == None)
+            .values(id = chain.c.id))
+    else:
+        chain = Chain.__table__
+        session.execute(select([chain.c.id])
+            .where(chain.c.id == chain_id)
+            .with_for_update())
+
+def lock_blocks(session, block_ids):
+    """Locks the stored blocks with the passed ids and their parents, as
+    for `lock_hashes()`."""
+    block, hashes = Block.__table__, {}
+    for chunk in _chunks(list(block_ids)):
+        for row in session.execute(
+                select([block.c.chain_id, block.c.hash, block.c.parent_hash])
+                .where(block.c.id.in_(chunk))):
+            hashes.setdefault(row.chain_id, set()).update(
+                (row.hash, row.parent_hash))
+    for chain_id in sorted(hashes):
+        lock_hashes(session, chain_id, hashes[chain_id])
+
+class InsertIgnore(Insert):
+    "An INSERT which skips rows violating a unique constraint."
+
+def insert_ignore(table):
+    """Returns an INSERT into `table` which skips the rows conflicting with
+    an existing row on any unique constraint: INSERT OR IGNORE on SQLite,
+    ON CONFLICT DO NOTHING on PostgreSQL (9.5 and later) and INSERT IGNORE
+    on MySQL. Elsewhere it is a plain INSERT, and a conflict fails."""
+    return InsertIgnore(table)
+
+@compiles(InsertIgnore)
+def _compile_insert_ignore(insert, compiler, **kwargs):
+    return compiler.visit_insert(insert, **kwargs)
+
+@compiles(InsertIgnore, 'sqlite')
+def _compile_insert_or_ignore(insert, compiler, **kwargs):
+    return compiler.visit_insert(insert, **kwargs).replace(
+        'INSERT', 'INSERT OR IGNORE', 1)
+
+@compiles(InsertIgnore, 'mysql')
+def _compile_mysql_insert_ignore(insert, compiler, **kwargs):
+    return compiler.visit_insert(insert, **kwargs).replace(
+        'INSERT', 'INSERT IGNORE', 1)
+
+@compiles(InsertIgnore, 'postgresql')
+def _compile_on_conflict_do_nothing(insert, compiler, **kwargs):
+    # The clause goes before any RETURNING of the generated primary key.
+    head, returning, tail = compiler.visit_insert(insert, **kwargs) \
+        .partition(' RETURNING ')
+    return head + ' ON CONFLICT DO NOTHING' + returning + tail
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+# Precompiled versions of the hottest lookups of `query`. Building an ORM
+# query and compiling it to SQL costs far more Python time than executing a
+# primary key or unique index probe, so each lookup here builds its query
+# once, with bound parameters in place of the looked-up values, and reuses
+# the compiled form on every call:
+#
+#   * with SQLAlchemy 1.0 and later, through the baked query extension;
+#   * before that, by executing the query's statement on a connection with a
+#     `compiled_cache`, and loading instances from the result. The session
+#     is autoflushed first, as `Query` would, so that pending objects are
+#     found.
+#
+# Every `Lookup` counts its calls, and where the compiled form is cached here,
+# how many of them found it cached; `stats()` returns them all. The bakery
+# does not expose whether a call found its query cached, so with the baked
+# query extension every call is counted but none as a hit or a miss.
+
+import threading
+
+# SQLAlchemy object-relational mapper
+from sqlalchemy import *
+from sqlalchemy import orm
+
+try:
+    from sqlalchemy.ext import baked
+except ImportError:
+    baked = None
+
+from .core import Block, ConnectedBlockInfo, Output, Transaction
+
+LOOKUPS = {}
+
+class Lookup(object):
+    """A lookup returning the list of results of the query built by `build`,
+    a function taking no arguments and returning a `Query` (with no
+    session) of `entity`, for the bound parameters passed on each call."""
+    def __init__(self, name, entity, build):
+        self.name, self.entity, self.build = name, entity, build
+        self.calls = self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        self._query = self._statement = None
+        self._cache = {}
+        if baked is not None:
+            self._baked = _bakery(lambda session: build().with_session(session),
+                                  name)
+        LOOKUPS[name] = self
+
+    def _count(self, hit=None):
+        with self._lock:
+            self.calls += 1
+            if hit is not None:
+                self.hits, self.misses = (self.hits + bool(hit),
+                                          self.misses + (not hit))
+
+    def __call__(self, session, **params):
+        if baked is not None:
+            self._count()
+            return self._baked(session).params(**params).all()
+
+        if self._query is None:
+            self._query = self.build()
+            self._statement = self._query.statement
+        session._autoflush()
+        connection = (session.connection(mapper=orm.class_mapper(self.entity))
+            .execution_options(compiled_cache=self._cache))
+        # A call which finds the cache grown compiled the statement; calls
+        # racing with the first may count its compilation as their own.
+        size = len(self._cache)
+        result = connection.execute(self._statement, **params)
+        self._count(hit = len(self._cache) <= size)
+        return list(self._query.with_session(session).instances(result))
+
+if baked is not None:
+    _bakery = baked.bakery()
+
+def stats():
+    """Returns a dictionary mapping each lookup name to its (calls, hits,
+    misses)."""
+    return dict((name, (x.calls, x.hits, x.misses))
+        for name, x in LOOKUPS.iteritems())
+
+def reset_stats():
+    for lookup in LOOKUPS.itervalues():
+        with lookup._lock:
+            lookup.calls = lookup.hits = lookup.misses = 0
+
+def _first(results):
+    return results and results[0] or None
+
+# ===----------------------------------------------------------------------===
+
+_block_by_hash = Lookup('block_by_hash', Block, lambda:
+    orm.Query(Block)
+        .filter(Block.chain_id == bindparam('chain_id'))
+        .filter(Block.hash == bindparam('hash'))
+        .limit(1))
+
+def block_by_hash(session, chain, hash):
+    "As `query.block_by_hash(...).first()`."
+    return _first(_block_by_hash(session, chain_id=chain.id, hash=hash))
+
+_transaction_by_hash = Lookup('transaction_by_hash', Transaction, lambda:
+    orm.Query(Transaction)
+        .filter(Transaction.chain_id == bindparam('chain_id'))
+        .filter(Transaction.hash == bindparam('hash'))
+        .limit(1))
+
+def transaction_by_hash(session, chain, hash):
+    "As `query.transaction_by_hash(...).first()`."
+    return _first(_transaction_by_hash(session, chain_id=chain.id, hash=hash))
+
+_output_by_outpoint = Lookup('output_by_outpoint', Output, lambda:
+    orm.Query(Output)
+        .join(Transaction, Transaction.id == Output.transaction_id)
+        .filter(Transaction.chain_id == bindparam('chain_id'))
+        .filter(Transaction.hash == bindparam('hash'))
+        .filter(Output.offset == bindparam('index'))
+        .limit(1))
+
+def output_by_outpoint(session, chain, hash, index):
+    """Returns the output of `chain` identified by the (hash, index) outpoint,
+    or None if it has not been stored."""
+    return _first(_output_by_outpoint(session,
+        chain_id=chain.id, hash=hash, index=index))
+
+_best_tip = Lookup('best_tip', ConnectedBlockInfo, lambda:
+    orm.Query(ConnectedBlockInfo)
+        .filter(ConnectedBlockInfo.chain_id == bindparam('chain_id'))
+        .order_by(ConnectedBlockInfo.aggregate_work.desc(),
+                  ConnectedBlockInfo.block_id)
+        .limit(1))
+
+def best_tip(session, chain):
+    "As `query.best_tip(...).first()`."
+    return _first(_best_tip(session, chain_id=chain.id))
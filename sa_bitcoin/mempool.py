@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+
+# SQLAlchemy object-relational mapper
+from sqlalchemy import *
+from sqlalchemy import orm, sql
+from . import Base
+
+from .batching import CHUNK_SIZE, _chunks
+from .core import Block, Chain, Transaction, Input, Output, \
+    BlockTransactionListNode
+from .fields.hash_ import Hash256
+from .fields.integer import UnsignedInteger
+from .fields.script import BitcoinScript
+from .fields.time_ import BlockTime
+from .mixins.hashable import HybridHashableMixin
+from .orderinglist import ordering_list
+
+from bitcoin import core
+
+__tableprefix__ = 'bitcoin_mempool_'
+
+# Unconfirmed transactions are staged in their own set of tables, which mirror
+# the layout of `Transaction`, `Input` and `Output` so that promotion into the
+# confirmed tables is a straight INSERT ... SELECT. Only the indexes needed for
+# lookup and double-spend detection are kept, since mempool rows churn at a
+# much higher rate than anything in the block chain tables.
+
+class MempoolTransaction(HybridHashableMixin, core.Transaction, Base):
+    __tablename__ = __tableprefix__ + 'transaction'
+
+    id = Column(Integer, Sequence('__'.join(['sq', __tablename__, 'id'])))
+
+    # Each chain has its own mempool. See `Transaction.chain_id`.
+    chain_id = Column(Integer,
+        ForeignKey(Chain.__tablename__ + '.id',
+            name = '__'.join(['fk', __tablename__, 'chain'])),
+        nullable = False)
+    chain = orm.relationship(lambda: Chain)
+
+    # See `Transaction` for a description of these fields.
+    format = Column(SmallInteger, nullable=False)
+
+    @orm.validates('format')
+    def format_range(self, key, format):
+        assert format in (0,1)
+        return format
+
+    version = Column(UnsignedInteger, nullable=False)
+    lock_time = Column(BlockTime, nullable=False)
+    reference_height = Column(UnsignedInteger, nullable=False)
+    _hash = Column('hash', Hash256(order_preserving=True), nullable=False)
+
+    __lazy_slots__ = ('hash',)
+    __table_args__ = (
+        PrimaryKeyConstraint('id',
+            name = '__'.join(['pk', __tablename__])),
+        Index('__'.join(['ix', __tablename__, 'chain_id', 'hash']),
+            'chain_id', 'hash', unique = True),)
+
+    inputs = orm.relationship(lambda: MempoolInput,
+        collection_class = ordering_list('offset'),
+        order_by         = lambda: MempoolInput.offset,
+        cascade          = 'all, delete-orphan')
+    def create_inputs(self):
+        pass
+
+    outputs = orm.relationship(lambda: MempoolOutput,
+        collection_class = ordering_list('offset'),
+        order_by         = lambda: MempoolOutput.offset,
+        cascade          = 'all, delete-orphan')
+    def create_outputs(self):
+        pass
+
+class MempoolOutput(core.Output, Base):
+    __tablename__ = __tableprefix__ + 'output'
+
+    transaction_id = Column(Integer,
+        ForeignKey(__tableprefix__ + 'transaction.id',
+            name = '__'.join(['fk', __tablename__, 'transaction_id'])),
+        nullable = False)
+    offset = Column(SmallInteger, nullable=False)
+    amount = Column(BigInteger, nullable=False)
+    contract = Column(BitcoinScript, nullable=False)
+
+    __table_args__ = (
+        PrimaryKeyConstraint('transaction_id', 'offset',
+            name = '__'.join(['pk', __tablename__])),
+        CheckConstraint(
+            (0 <= sql.column('amount')) &
+            (sql.column('amount') <= 9007199254740991), # 2^53 - 1
+            name = '__'.join(['ck', __tablename__, 'amount'])),)
+
+    transaction = orm.relationship(lambda: MempoolTransaction)
+MempoolTransaction.output_class = MempoolOutput
+
+class MempoolInput(core.Input, Base):
+    __tablename__ = __tableprefix__ + 'input'
+
+    transaction_id = Column(Integer,
+        ForeignKey(__tableprefix__ + 'transaction.id',
+            name = '__'.join(['fk', __tablename__, 'transaction_id'])),
+        nullable = False)
+    offset = Column(SmallInteger, nullable=False)
+
+    # A copy of `MempoolTransaction.chain_id`, so that conflicting spends can
+    # be detected per-chain with a probe of the unique index below.
+    chain_id = Column(Integer,
+        ForeignKey(Chain.__tablename__ + '.id',
+            name = '__'.join(['fk', __tablename__, 'chain'])),
+        nullable = False)
+
+    hash = Column(Hash256(order_preserving=True), nullable=False)
+    index = Column(UnsignedInteger, nullable=False)
+    endorsement = Column(BitcoinScript, nullable=False)
+    sequence = Column(UnsignedInteger, nullable=False)
+
+    # Unlike the confirmed `Input` table, an outpoint may be spent at most
+    # once within a chain's mempool. The unique index makes a conflicting spend a
+    # single indexed probe, and guarantees that one can never be stored.
+    __table_args__ = (
+        PrimaryKeyConstraint('transaction_id', 'offset',
+            name = '__'.join(['pk', __tablename__])),
+        Index('__'.join(['ix', __tablename__, 'chain_id', 'hash', 'index']),
+            'chain_id', 'hash', 'index', unique = True),)
+
+    transaction = orm.relationship(lambda: MempoolTransaction)
+MempoolTransaction.input_class = MempoolInput
+
+# ===----------------------------------------------------------------------===
+
+# Outpoints are matched with a disjunction of (hash, index) equalities, which
+# every supported backend resolves against the unique index. Batches are
+# chunked to stay below the bound parameter limit of SQLite; see `batching`.
+
+def _next_id(session, table):
+    "Returns a column expression generating primary keys for INSERT ... SELECT"
+    default = table.c.id.default
+    dialect = session.connection().dialect
+    if getattr(default, 'is_sequence', False) and dialect.supports_sequences:
+        return [default.next_value().label('id')]
+    return []
+
+def find_conflicts(session, chain, outpoints):
+    """Returns a dictionary mapping each of the passed (hash, index) outpoints
+    which is already spent by a transaction staged for `chain` to the hash of
+    the transaction spending it."""
+    txn, inp = MempoolTransaction.__table__, MempoolInput.__table__
+    outpoints = list(set(outpoints))
+    conflicts = {}
+    for chunk in _chunks(outpoints):
+        query = (select([inp.c.hash, inp.c.index, txn.c.hash.label('spender')])
+            .select_from(inp.join(txn, txn.c.id == inp.c.transaction_id))
+            .where((inp.c.chain_id == chain.id) &
+                   or_(*[(inp.c.hash == hash) & (inp.c.index == index)
+                         for hash, index in chunk])))
+        for row in session.execute(query):
+            conflicts[(row.hash, row.index)] = row.spender
+    return conflicts
+
+def stage(session, chain, transactions):
+    """Bulk-inserts the passed transactions into the mempool of `chain`. Any
+    transaction which spends an outpoint already spent within the mempool, or
+    by an earlier transaction in the same batch, is not staged; transactions
+    already present are silently skipped. Returns the list of transactions
+    rejected as double-spends. A transaction passed more than once is staged
+    once."""
+    unique, seen = [], set()
+    for tx in transactions:
+        if tx.hash not in seen:
+            seen.add(tx.hash)
+            unique.append(tx)
+    transactions = unique
+    conflicts = find_conflicts(session, chain,
+        [(input.hash, input.index) for tx in transactions for input in tx.inputs])
+
+    accepted, rejected, spent = [], [], set()
+    for tx in transactions:
+        outpoints = [(input.hash, input.index) for input in tx.inputs]
+        spenders = set(conflicts.get(outpoint) for outpoint in outpoints)
+        if spenders == set([tx.hash]):
+            continue
+        if spenders - set([None]) or any(x in spent for x in outpoints):
+            rejected.append(tx)
+            continue
+        spent.update(outpoints)
+        accepted.append(tx)
+    if not accepted:
+        return rejected
+
+    txn = MempoolTransaction.__table__
+    session.execute(txn.insert(), [{
+        'chain_id':         chain.id,
+        'format':           getattr(tx, 'format', 0),
+        'version':          tx.version,
+        'lock_time':        tx.lock_time,
+        'reference_height': tx.reference_height,
+        'hash':             tx.hash,
+    } for tx in accepted])
+
+    ids = {}
+    for chunk in _chunks([tx.hash for tx in accepted]):
+        query = (select([txn.c.hash, txn.c.id])
+            .where((txn.c.chain_id == chain.id) & txn.c.hash.in_(chunk)))
+        ids.update((row.hash, row.id) for row in session.execute(query))
+
+    inputs = [{
+        'transaction_id': ids[tx.hash],
+        'offset':         offset,
+        'chain_id':       chain.id,
+        'hash':           input.hash,
+        'index':          input.index,
+        'endorsement':    input.endorsement,
+        'sequence':       input.sequence,
+    } for tx in accepted for offset, input in enumerate(tx.inputs)]
+    if inputs:
+        session.execute(MempoolInput.__table__.insert(), inputs)
+
+    outputs = [{
+        'transaction_id': ids[tx.hash],
+        'offset':         offset,
+        'amount':         output.amount,
+        'contract':       output.contract,
+    } for tx in accepted for offset, output in enumerate(tx.outputs)]
+    if outputs:
+        session.execute(MempoolOutput.__table__.insert(), outputs)
+
+    return rejected
+
+def _delete_staged(session, ids):
+    for chunk in _chunks(list(ids)):
+        for model in (MempoolInput, MempoolOutput):
+            table = model.__table__
+            session.execute(table.delete().where(
+                table.c.transaction_id.in_(chunk)))
+        table = MempoolTransaction.__table__
+        session.execute(table.delete().where(table.c.id.in_(chunk)))
+
+def promote(session, chain, hashes):
+    """Moves the transactions staged for `chain` with the passed hashes into
+    the confirmed `Transaction`, `Input` and `Output` tables with set-based
+    INSERT ... SELECT statements, and removes them from the mempool. Hashes
+    which are not staged are ignored. Returns a dictionary mapping the hash
+    of each promoted transaction to its new `Transaction.id`, which the
+    caller uses to build the block's `BlockTransactionListNode` entries.
+
+    `sa_bitcoin.ingest` promotes the transactions of each block as it is
+    stored. The derived columns (input links, spends, destinations and
+    values) are left unset, and are filled in when the block is connected,
+    as for the block's other transactions."""
+    mtx, min_, mout = (MempoolTransaction.__table__,
+        MempoolInput.__table__, MempoolOutput.__table__)
+    tx, in_, out = (Transaction.__table__,
+        Input.__table__, Output.__table__)
+
+    promoted = {}
+    for chunk in _chunks(list(hashes)):
+        staged = dict((row.hash, row.id) for row in session.execute(
+            select([mtx.c.hash, mtx.c.id])
+                .where((mtx.c.chain_id == chain.id) & mtx.c.hash.in_(chunk))))
+        if not staged:
+            continue
+        chunk = list(staged)
+
+        ids = mtx.c.id.in_(staged.values())
+        columns = ['chain_id', 'format', 'version', 'lock_time',
+                   'reference_height', 'hash']
+        id_ = _next_id(session, tx)
+        session.execute(tx.insert().from_select(
+            [x.name for x in id_] + columns,
+            select(id_ + [mtx.c[x] for x in columns]).where(ids)))
+
+        # Staged and confirmed transactions are matched by (chain_id, hash),
+        # which is uniquely indexed on both sides.
+        join = mtx.join(tx, (tx.c.chain_id == mtx.c.chain_id) &
+                            (tx.c.hash == mtx.c.hash))
+        columns = ['offset', 'hash', 'index', 'endorsement', 'sequence']
+        session.execute(in_.insert().from_select(
+            ['transaction_id'] + columns,
+            select([tx.c.id] + [min_.c[x] for x in columns])
+                .select_from(join.join(min_, min_.c.transaction_id == mtx.c.id))
+                .where(ids)))
+        columns = ['offset', 'amount', 'contract']
+        session.execute(out.insert().from_select(
+            ['transaction_id'] + columns,
+            select([tx.c.id] + [mout.c[x] for x in columns])
+                .select_from(join.join(mout, mout.c.transaction_id == mtx.c.id))
+                .where(ids)))
+
+        promoted.update((row.hash, row.id) for row in session.execute(
+            select([tx.c.hash, tx.c.id])
+                .where((tx.c.chain_id == chain.id) & tx.c.hash.in_(chunk))))
+        _delete_staged(session, staged.values())
+
+    return promoted
+
+def _evict_conflicts(session, block_ids):
+    mtx, min_ = MempoolTransaction.__table__, MempoolInput.__table__
+    block, tx = Block.__table__, Transaction.__table__
+    in_, node = Input.__table__, BlockTransactionListNode.__table__
+
+    # A staged transaction spending an outpoint which a transaction of the
+    # blocks spends is either a copy of that transaction, which is now
+    # confirmed and is dropped without its descendants, or a double-spend.
+    # Copies are normally promoted when the block is stored, and so are
+    # found here only for blocks stored before they were staged.
+    copies, ids = set(), set()
+    for chunk in _chunks(list(block_ids)):
+        query = (select([mtx.c.id, mtx.c.hash,
+                         tx.c.hash.label('confirmed')])
+            .select_from(node
+                .join(block, block.c.id == node.c.block_id)
+                .join(tx, tx.c.id == node.c.transaction_id)
+                .join(in_, in_.c.transaction_id == tx.c.id)
+                .join(min_, (min_.c.chain_id == block.c.chain_id) &
+                            (min_.c.hash == in_.c.hash) &
+                            (min_.c.index == in_.c.index))
+                .join(mtx, mtx.c.id == min_.c.transaction_id))
+            .where(node.c.block_id.in_(chunk)))
+        for row in session.execute(query):
+            if row.hash == row.confirmed:
+                copies.add(row.id)
+            else:
+                ids.add(row.id)
+    _delete_staged(session, copies)
+
+    evicted = 0
+    while ids:
+        spent = {}
+        for chunk in _chunks(list(ids)):
+            for row in session.execute(select([mtx.c.chain_id, mtx.c.hash])
+                    .where(mtx.c.id.in_(chunk))):
+                spent.setdefault(row.chain_id, []).append(row.hash)
+        _delete_staged(session, ids)
+        evicted += len(ids)
+        # Descendants spend the outputs of evicted transactions, and are
+        # therefore no longer valid either.
+        ids = set()
+        for chain_id, hashes in spent.iteritems():
+            for chunk in _chunks(hashes):
+                ids.update(row[0] for row in session.execute(
+                    select([min_.c.transaction_id]).distinct()
+                        .where((min_.c.chain_id == chain_id) &
+                               min_.c.hash.in_(chunk))))
+    return evicted
+
+def evict_conflicts(session, block_id):
+    """Removes every staged transaction which conflicts with an input of the
+    block with the passed id, together with all staged descendants of the
+    evicted transactions. Staged copies of the block's own transactions are
+    removed too, being confirmed, but their descendants are kept. Must be
+    called once all of the block's transactions have been stored, and is
+    called by `sa_bitcoin.ingest` for every block it connects. Only the
+    mempool of the block's chain is affected. Returns the number of
+    transactions evicted."""
+    return _evict_conflicts(session, [block_id])
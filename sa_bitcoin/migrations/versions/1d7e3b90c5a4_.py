@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2013 by its contributors. See AUTHORS for details.
+# Distributed under the MIT/X11 software license, see the accompanying
+# file LICENSE or http://www.opensource.org/licenses/mit-license.php.
+
+"""\
+Add spent-by reverse index to outputs.
+
+Revision ID: 1d7e3b90c5a4
+Revises: 4b1f6c2a9d3e
+Create Date: 2026-10-19 10:02:17.553081
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1d7e3b90c5a4'
+down_revision = '4b1f6c2a9d3e'
+
+from alembic import op
+from sqlalchemy import *
+from sqlalchemy import sql
+
+__tableprefix__ = 'bitcoin_'
+
+def upgrade():
+    # SQLite cannot ALTER a table to add constraints.
+    alter = op.get_bind().dialect.name != 'sqlite'
+
+    # Output
+    __tablename__ = __tableprefix__ + 'output'
+    op.add_column(__tablename__, Column('spent_by_transaction_id', Integer))
+    op.add_column(__tablename__, Column('spent_by_offset', SmallInteger))
+    op.add_column(__tablename__, Column('spent_height', Integer))
+    if alter:
+        op.create_foreign_key(
+            '__'.join(['fk', __tablename__, 'spent_by']),
+                             __tablename__,
+            __tableprefix__ + 'input',
+            ('spent_by_transaction_id', 'spent_by_offset'),
+            (         'transaction_id',          'offset'))
+        op.create_check_constraint(
+            '__'.join(['ck', __tablename__, 'spent']),
+                             __tablename__,
+            ((sql.column('spent_by_transaction_id') == None) &
+             (sql.column('spent_by_offset')         == None) &
+             (sql.column('spent_height')            == None)) |
+            ((sql.column('spent_by_transaction_id') != None) &
+             (sql.column('spent_by_offset')         != None) &
+             (sql.column('spent_height')            != None)))
+    op.create_index(
+        '__'.join(['ix', __tablename__, 'unspent']),
+                         __tablename__,
+        ('transaction_id', 'offset'),
+        postgresql_where = sql.column('spent_by_transaction_id') == None,
+        sqlite_where     = sql.column('spent_by_transaction_id') == None)
+
+def downgrade():
+    alter = op.get_bind().dialect.name != 'sqlite'
+
+    # Output
+    __tablename__ = __tableprefix__ + 'output'
+    op.drop_index('__'.join(['ix', __tablename__, 'unspent']),
+                                   __tablename__)
+    if alter:
+        op.drop_constraint('__'.join(['ck', __tablename__, 'spent']),
+                                            __tablename__, type_='check')
+        op.drop_constraint('__'.join(['fk', __tablename__, 'spent_by']),
+                                            __tablename__, type_='foreignkey')
+    op.drop_column(__tablename__, 'spent_height')
+    op.drop_column(__tablename__, 'spent_by_offset')
+    op.drop_column(__tablename__, 'spent_by_transaction_id')
@@ -17,6 +17,12 @@ down_revision = None
 
 from alembic import op
 from sqlalchemy import *
+from sqlalchemy import sql
+
+from sa_bitcoin.fields.hash_ import Hash256
+from sa_bitcoin.fields.integer import UnsignedInteger, UnsignedSmallInteger
+from sa_bitcoin.fields.script import BitcoinScript
+from sa_bitcoin.fields.time_ import BlockTime, UNIXDateTime
 
 __tableprefix__ = 'bitcoin_'
 
@@ -124,7 +130,7 @@ def upgrade():
 
     # Input
     __tablename__ = __tableprefix__ + 'input'
-    op.create_table(__tableprefix__,
+    op.create_table(__tablename__,
         Column('transaction_id', Integer,
             ForeignKey(__tableprefix__ + 'transaction.id',
                 name = '__'.join(['fk', __tablename__, 'transaction_id'])),
@@ -132,13 +138,17 @@ def upgrade():
         Column('offset', SmallInteger, nullable=False),
         Column('hash', Hash256, nullable=False),
         Column('index', UnsignedInteger, nullable=False),
-        Column('output_id', Integer,
-            ForeignKey(__tableprefix__ + 'output.id',
-                name = '__'.join(['fk', __tablename__]))),
+        Column('output_transaction_id', Integer),
+        Column('output_offset', SmallInteger),
         Column('endorsement', BitcoinScript, nullable=False),
         Column('sequence', UnsignedInteger, nullable=False),
         PrimaryKeyConstraint('transaction_id', 'offset',
             name = '__'.join(['pk', __tablename__])),
+        ForeignKeyConstraint(
+            ['output_transaction_id', 'output_offset'],
+            [__tableprefix__ + 'output.transaction_id',
+             __tableprefix__ + 'output.offset'],
+            name = '__'.join(['fk', __tablename__, 'output'])),
         Index('__'.join(['ix', __tablename__, 'hash', 'index']),
             'hash', 'index'),)
 
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2013 by its contributors. See AUTHORS for details.
+# Distributed under the MIT/X11 software license, see the accompanying
+# file LICENSE or http://www.opensource.org/licenses/mit-license.php.
+
+"""\
+Create mempool staging tables for unconfirmed transactions.
+
+Revision ID: 4b1f6c2a9d3e
+Revises: 221200742ae7
+Create Date: 2026-10-19 09:12:40.118212
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4b1f6c2a9d3e'
+down_revision = '221200742ae7'
+
+from alembic import op
+from sqlalchemy import *
+from sqlalchemy import sql
+
+from sa_bitcoin.fields.hash_ import Hash256
+from sa_bitcoin.fields.integer import UnsignedInteger
+from sa_bitcoin.fields.script import BitcoinScript
+from sa_bitcoin.fields.time_ import BlockTime
+
+__tableprefix__ = 'bitcoin_mempool_'
+
+def upgrade():
+    # MempoolTransaction
+    __tablename__ = __tableprefix__ + 'transaction'
+    op.create_table(__tablename__,
+        Column('id', Integer,
+            Sequence('__'.join(['sq', __tablename__, 'id'])),
+            nullable = False),
+        Column('format', SmallInteger, nullable=False),
+        Column('version', UnsignedInteger, nullable=False),
+        Column('lock_time', BlockTime, nullable=False),
+        Column('reference_height', UnsignedInteger, nullable=False),
+        Column('hash', Hash256, nullable=False),
+        PrimaryKeyConstraint('id',
+            name = '__'.join(['pk', __tablename__])),
+        Index('__'.join(['ix', __tablename__, 'hash']),
+            'hash', unique = True),)
+
+    # MempoolOutput
+    __tablename__ = __tableprefix__ + 'output'
+    op.create_table(__tablename__,
+        Column('transaction_id', Integer,
+            ForeignKey(__tableprefix__ + 'transaction.id',
+                name = '__'.join(['fk', __tablename__, 'transaction_id'])),
+            nullable = False),
+        Column('offset', SmallInteger, nullable=False),
+        Column('amount', BigInteger, nullable=False),
+        Column('contract', BitcoinScript, nullable=False),
+        PrimaryKeyConstraint('transaction_id', 'offset',
+            name = '__'.join(['pk', __tablename__])),
+        CheckConstraint(
+            (0 <= sql.column('amount')) &
+            (sql.column('amount') <= 9007199254740991), # 2^53 - 1
+            name = '__'.join(['ck', __tablename__, 'amount'])),)
+
+    # MempoolInput
+    __tablename__ = __tableprefix__ + 'input'
+    op.create_table(__tablename__,
+        Column('transaction_id', Integer,
+            ForeignKey(__tableprefix__ + 'transaction.id',
+                name = '__'.join(['fk', __tablename__, 'transaction_id'])),
+            nullable = False),
+        Column('offset', SmallInteger, nullable=False),
+        Column('hash', Hash256, nullable=False),
+        Column('index', UnsignedInteger, nullable=False),
+        Column('endorsement', BitcoinScript, nullable=False),
+        Column('sequence', UnsignedInteger, nullable=False),
+        PrimaryKeyConstraint('transaction_id', 'offset',
+            name = '__'.join(['pk', __tablename__])),
+        Index('__'.join(['ix', __tablename__, 'hash', 'index']),
+            'hash', 'index', unique = True),)
+
+def downgrade():
+    op.drop_table(__tableprefix__ + 'input')
+    op.drop_table(__tableprefix__ + 'output')
+    op.drop_table(__tableprefix__ + 'transaction')
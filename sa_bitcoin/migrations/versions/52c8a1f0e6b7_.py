@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2013 by its contributors. See AUTHORS for details.
+# Distributed under the MIT/X11 software license, see the accompanying
+# file LICENSE or http://www.opensource.org/licenses/mit-license.php.
+
+"""\
+Add materialized destination columns to outputs.
+
+Existing rows are populated by `sa_bitcoin.ingest.backfill_destinations()`.
+
+Revision ID: 52c8a1f0e6b7
+Revises: 1d7e3b90c5a4
+Create Date: 2026-10-19 10:41:55.207316
+"""
+
+# revision identifiers, used by Alembic.
+revision = '52c8a1f0e6b7'
+down_revision = '1d7e3b90c5a4'
+
+from alembic import op
+from sqlalchemy import *
+
+from sa_bitcoin.fields.hash_ import Hash160
+
+__tableprefix__ = 'bitcoin_'
+
+def upgrade():
+    # Output
+    __tablename__ = __tableprefix__ + 'output'
+    destination_type = Enum('pubkey_hash', 'script_hash',
+        name = '__'.join([__tablename__, 'destination_type', 'enum']))
+    destination_type.create(op.get_bind(), checkfirst=True)
+    op.add_column(__tablename__, Column('destination_type', destination_type))
+    op.add_column(__tablename__, Column('destination_hash', Hash160))
+    op.create_index(
+        '__'.join(['ix', __tablename__, 'destination']),
+                         __tablename__,
+        ('destination_hash', 'destination_type'))
+
+def downgrade():
+    # Output
+    __tablename__ = __tableprefix__ + 'output'
+    op.drop_index('__'.join(['ix', __tablename__, 'destination']),
+                                   __tablename__)
+    op.drop_column(__tablename__, 'destination_hash')
+    op.drop_column(__tablename__, 'destination_type')
+    Enum(name = '__'.join([__tablename__, 'destination_type', 'enum'])
+        ).drop(op.get_bind(), checkfirst=True)
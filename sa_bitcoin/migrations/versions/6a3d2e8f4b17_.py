@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2013 by its contributors. See AUTHORS for details.
+# Distributed under the MIT/X11 software license, see the accompanying
+# file LICENSE or http://www.opensource.org/licenses/mit-license.php.
+
+"""\
+Scope blocks, transactions and the mempool by chain.
+
+Existing rows are assigned to the only chain in the database. Databases which
+already hold blocks or transactions of more than one chain cannot be upgraded
+automatically.
+
+Revision ID: 6a3d2e8f4b17
+Revises: 52c8a1f0e6b7
+Create Date: 2026-10-19 11:20:04.618392
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6a3d2e8f4b17'
+down_revision = '52c8a1f0e6b7'
+
+from alembic import op
+from sqlalchemy import *
+from sqlalchemy import sql
+
+__tableprefix__ = 'bitcoin_'
+
+# (table, index columns, unique, parent) for every index which gains a leading
+# `chain_id` column. Where the chain of a row is that of a parent row, parent
+# is the (parent table, foreign key, parent key) to copy it from.
+TABLES = [
+    (__tableprefix__ + 'block',
+        ['hash'], True, None),
+    (__tableprefix__ + 'transaction',
+        ['hash'], True, None),
+    (__tableprefix__ + 'connected_block_info',
+        ['height'], False, (__tableprefix__ + 'block', 'block_id', 'id')),
+    (__tableprefix__ + 'connected_block_info',
+        ['aggregate_work'], False, None),
+    (__tableprefix__ + 'mempool_transaction',
+        ['hash'], True, None),
+    (__tableprefix__ + 'mempool_input',
+        ['hash', 'index'], True,
+        (__tableprefix__ + 'mempool_transaction', 'transaction_id', 'id')),
+]
+
+def _chain_id(bind):
+    ids = [row[0] for row in bind.execute(
+        sql.text('SELECT id FROM %schain' % __tableprefix__))]
+    return ids[0] if len(ids) == 1 else None
+
+def upgrade():
+    # SQLite cannot ALTER a table to add constraints.
+    bind = op.get_bind()
+    alter = bind.dialect.name != 'sqlite'
+    chain_id = _chain_id(bind)
+
+    added = set()
+    for __tablename__, columns, unique, parent in TABLES:
+        table = sql.table(__tablename__, sql.column('chain_id'))
+        if __tablename__ not in added:
+            added.add(__tablename__)
+            op.add_column(__tablename__, Column('chain_id', Integer))
+            if parent is not None:
+                parent_table, fk, pk = parent
+                parent_table = sql.table(parent_table,
+                    sql.column(pk), sql.column('chain_id'))
+                table.append_column(sql.column(fk))
+                op.execute(table.update().values(chain_id =
+                    select([parent_table.c.chain_id])
+                        .where(parent_table.c[pk] == table.c[fk])
+                        .as_scalar()))
+            elif chain_id is not None:
+                op.execute(table.update().values(chain_id = chain_id))
+            count = bind.execute(select([func.count()])
+                .select_from(table).where(table.c.chain_id == None)).scalar()
+            if count:
+                raise ValueError(u"cannot assign a chain to the existing rows "
+                    u"of '%s'; set chain_id manually" % __tablename__)
+            if alter:
+                op.alter_column(__tablename__, 'chain_id', nullable=False)
+                op.create_foreign_key(
+                    '__'.join(['fk', __tablename__, 'chain']),
+                                     __tablename__,
+                    __tableprefix__ + 'chain', ['chain_id'], ['id'])
+        op.drop_index('__'.join(['ix', __tablename__] + columns),
+                                       __tablename__)
+        op.create_index(
+            '__'.join(['ix', __tablename__, 'chain_id'] + columns),
+                             __tablename__,
+            ['chain_id'] + columns, unique = unique)
+
+def downgrade():
+    alter = op.get_bind().dialect.name != 'sqlite'
+
+    dropped = set()
+    for __tablename__, columns, unique, parent in reversed(TABLES):
+        op.drop_index('__'.join(['ix', __tablename__, 'chain_id'] + columns),
+                                       __tablename__)
+        op.create_index(
+            '__'.join(['ix', __tablename__] + columns),
+                             __tablename__,
+            columns, unique = unique)
+    for __tablename__, columns, unique, parent in reversed(TABLES):
+        if __tablename__ in dropped:
+            continue
+        dropped.add(__tablename__)
+        if alter:
+            op.drop_constraint('__'.join(['fk', __tablename__, 'chain']),
+                                              __tablename__,
+                type_ = 'foreignkey')
+        op.drop_column(__tablename__, 'chain_id')
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2013 by its contributors. See AUTHORS for details.
+# Distributed under the MIT/X11 software license, see the accompanying
+# file LICENSE or http://www.opensource.org/licenses/mit-license.php.
+
+"""\
+Store block hashes and txids big-endian, in their natural order.
+
+Each stored hash is byte-reversed in place, in batches of rows; the
+conversion is its own inverse, so downgrading does the same.
+
+The encoding follows the schema revision rather than a setting: ingest and
+mempool promotion join and copy these columns as raw bytes, so they must
+all share one encoding, and a process reading them with the other would
+silently find nothing. Code reading the tables other than through the
+models must reverse the bytes of these columns to get wire order.
+
+Revision ID: 7c4e1a9b2d05
+Revises: 6a3d2e8f4b17
+Create Date: 2026-10-19 13:41:07.552806
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7c4e1a9b2d05'
+down_revision = '6a3d2e8f4b17'
+
+from alembic import op
+from sqlalchemy import *
+from sqlalchemy import sql
+
+__tableprefix__ = 'bitcoin_'
+
+# (table, primary key columns, hash columns). Rows are visited in ranges of
+# the first primary key column.
+TABLES = [
+    (__tableprefix__ + 'chain',
+        ['id'], ['genesis_hash']),
+    (__tableprefix__ + 'checkpoint',
+        ['chain_id', 'height'], ['hash']),
+    (__tableprefix__ + 'block',
+        ['id'], ['hash', 'parent_hash']),
+    (__tableprefix__ + 'transaction',
+        ['id'], ['hash']),
+    (__tableprefix__ + 'input',
+        ['transaction_id', 'offset'], ['hash']),
+    (__tableprefix__ + 'mempool_transaction',
+        ['id'], ['hash']),
+    (__tableprefix__ + 'mempool_input',
+        ['transaction_id', 'offset'], ['hash']),
+]
+
+STEP = 10000
+
+def _reverse_hashes():
+    bind = op.get_bind()
+    for __tablename__, keys, columns in TABLES:
+        table = sql.table(__tablename__,
+            *([sql.column(key) for key in keys] +
+              [sql.column(column, LargeBinary) for column in columns]))
+        key = table.c[keys[0]]
+        low, high = bind.execute(select([func.min(key), func.max(key)])).first()
+        if low is None:
+            continue
+        update = (table.update()
+            .where(and_(*[table.c[x] == bindparam('_' + x) for x in keys]))
+            .values(**dict((x, bindparam('_' + x)) for x in columns)))
+        for start in xrange(low, high + 1, STEP):
+            rows = bind.execute(select([table])
+                .where(key.between(start, start + STEP - 1))).fetchall()
+            if rows:
+                bind.execute(update, [dict(
+                    [('_' + x, row[x]) for x in keys] +
+                    [('_' + x, bytes(row[x])[::-1]) for x in columns])
+                    for row in rows])
+
+def upgrade():
+    _reverse_hashes()
+
+def downgrade():
+    _reverse_hashes()
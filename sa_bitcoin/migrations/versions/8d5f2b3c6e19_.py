@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2013 by its contributors. See AUTHORS for details.
+# Distributed under the MIT/X11 software license, see the accompanying
+# file LICENSE or http://www.opensource.org/licenses/mit-license.php.
+
+"""\
+Add input, output and fee amount columns to transactions.
+
+Existing rows are populated by `sa_bitcoin.ingest.backfill_values()`.
+
+Revision ID: 8d5f2b3c6e19
+Revises: 7c4e1a9b2d05
+Create Date: 2026-10-19 15:02:44.318920
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8d5f2b3c6e19'
+down_revision = '7c4e1a9b2d05'
+
+from alembic import op
+from sqlalchemy import *
+
+__tableprefix__ = 'bitcoin_'
+
+def upgrade():
+    # Transaction
+    __tablename__ = __tableprefix__ + 'transaction'
+    op.add_column(__tablename__, Column('input_amount', BigInteger))
+    op.add_column(__tablename__, Column('output_amount', BigInteger))
+    op.add_column(__tablename__, Column('fee', BigInteger))
+
+def downgrade():
+    # Transaction
+    __tablename__ = __tableprefix__ + 'transaction'
+    op.drop_column(__tablename__, 'fee')
+    op.drop_column(__tablename__, 'output_amount')
+    op.drop_column(__tablename__, 'input_amount')
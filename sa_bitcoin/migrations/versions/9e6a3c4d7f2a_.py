@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2013 by its contributors. See AUTHORS for details.
+# Distributed under the MIT/X11 software license, see the accompanying
+# file LICENSE or http://www.opensource.org/licenses/mit-license.php.
+
+"""\
+Add the per-block statistics rollup table.
+
+Existing connected blocks are populated by
+`sa_bitcoin.ingest.backfill_stats()`.
+
+Revision ID: 9e6a3c4d7f2a
+Revises: 8d5f2b3c6e19
+Create Date: 2026-10-19 15:47:12.640381
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9e6a3c4d7f2a'
+down_revision = '8d5f2b3c6e19'
+
+from alembic import op
+from sqlalchemy import *
+
+from sa_bitcoin.fields.time_ import UNIXDateTime
+
+__tableprefix__ = 'bitcoin_'
+
+def upgrade():
+    # BlockStats
+    __tablename__ = __tableprefix__ + 'block_stats'
+    op.create_table(__tablename__,
+        Column('block_id', Integer,
+            ForeignKey(__tableprefix__ + 'block.id',
+                name = '__'.join(['fk', __tablename__, 'block_id'])),
+            nullable = False),
+        Column('chain_id', Integer,
+            ForeignKey(__tableprefix__ + 'chain.id',
+                name = '__'.join(['fk', __tablename__, 'chain'])),
+            nullable = False),
+        Column('height', Integer, nullable=False),
+        Column('time', UNIXDateTime, nullable=False),
+        Column('transaction_count', Integer, nullable=False),
+        Column('input_count', Integer, nullable=False),
+        Column('output_count', Integer, nullable=False),
+        Column('output_amount', BigInteger, nullable=False),
+        Column('fee', BigInteger, nullable=False),
+        Column('size', Integer, nullable=False),
+        PrimaryKeyConstraint('block_id',
+            name = '__'.join(['pk', __tablename__])),
+        Index('__'.join(['ix', __tablename__, 'chain_id', 'height']),
+            'chain_id', 'height'),
+        Index('__'.join(['ix', __tablename__, 'chain_id', 'time']),
+            'chain_id', 'time'),)
+
+def downgrade():
+    op.drop_table(__tableprefix__ + 'block_stats')
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2013 by its contributors. See AUTHORS for details.
+# Distributed under the MIT/X11 software license, see the accompanying
+# file LICENSE or http://www.opensource.org/licenses/mit-license.php.
+
+"""\
+Add content-addressed shared scripts, referenced by output contracts.
+
+Existing outputs keep their contracts inline. SQLite cannot relax the NOT
+NULL constraint of the inline column, so there scripts can only be shared in
+a database created from the models.
+
+Revision ID: a4b7d1e8c3f6
+Revises: 9e6a3c4d7f2a
+Create Date: 2026-10-19 16:35:28.904417
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a4b7d1e8c3f6'
+down_revision = '9e6a3c4d7f2a'
+
+from alembic import op
+from sqlalchemy import *
+from sqlalchemy import sql
+
+from sa_bitcoin.fields.hash_ import Hash256
+from sa_bitcoin.fields.script import BitcoinScript
+
+__tableprefix__ = 'bitcoin_'
+
+def upgrade():
+    # SQLite cannot ALTER a table to add constraints.
+    alter = op.get_bind().dialect.name != 'sqlite'
+
+    # SharedScript
+    __tablename__ = __tableprefix__ + 'script'
+    op.create_table(__tablename__,
+        Column('id', Integer,
+            Sequence('__'.join(['sq', __tablename__, 'id'])),
+            nullable = False),
+        Column('hash', Hash256, nullable=False),
+        Column('script', BitcoinScript, nullable=False),
+        PrimaryKeyConstraint('id',
+            name = '__'.join(['pk', __tablename__])),
+        Index('__'.join(['ix', __tablename__, 'hash']),
+            'hash', unique = True),)
+
+    # Output
+    __tablename__ = __tableprefix__ + 'output'
+    op.add_column(__tablename__, Column('contract_id', Integer))
+    op.create_index('__'.join(['ix', __tablename__, 'contract_id']),
+                                     __tablename__,
+        ('contract_id',))
+    if alter:
+        op.alter_column(__tablename__, 'contract', nullable=True)
+        op.create_foreign_key(
+            '__'.join(['fk', __tablename__, 'contract_id']),
+            __tablename__, __tableprefix__ + 'script',
+            ['contract_id'], ['id'])
+        op.create_check_constraint(
+            '__'.join(['ck', __tablename__, 'contract']),
+            __tablename__,
+            ((sql.column('contract')    != None) &
+             (sql.column('contract_id') == None)) |
+            ((sql.column('contract')    == None) &
+             (sql.column('contract_id') != None)))
+
+def downgrade():
+    alter = op.get_bind().dialect.name != 'sqlite'
+
+    # Output
+    __tablename__ = __tableprefix__ + 'output'
+    output = sql.table(__tablename__,
+        sql.column('contract'), sql.column('contract_id'))
+    script = sql.table(__tableprefix__ + 'script',
+        sql.column('id'), sql.column('script'))
+    op.execute(output.update()
+        .where(output.c.contract_id != None)
+        .values(contract = select([script.c.script])
+            .where(script.c.id == output.c.contract_id)
+            .as_scalar()))
+    if alter:
+        op.drop_constraint('__'.join(['ck', __tablename__, 'contract']),
+                           __tablename__)
+        op.drop_constraint('__'.join(['fk', __tablename__, 'contract_id']),
+                           __tablename__)
+        op.alter_column(__tablename__, 'contract', nullable=False)
+    op.drop_index('__'.join(['ix', __tablename__, 'contract_id']),
+                                   __tablename__)
+    op.drop_column(__tablename__, 'contract_id')
+
+    op.drop_table(__tableprefix__ + 'script')
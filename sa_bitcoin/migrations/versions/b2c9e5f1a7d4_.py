@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2013 by its contributors. See AUTHORS for details.
+# Distributed under the MIT/X11 software license, see the accompanying
+# file LICENSE or http://www.opensource.org/licenses/mit-license.php.
+
+"""\
+Add the signature verification cache table.
+
+Revision ID: b2c9e5f1a7d4
+Revises: a4b7d1e8c3f6
+Create Date: 2026-10-19 17:20:53.118204
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b2c9e5f1a7d4'
+down_revision = 'a4b7d1e8c3f6'
+
+from alembic import op
+from sqlalchemy import *
+
+from sa_bitcoin.fields.ecdsa_ import EcdsaCompactSignature
+from sa_bitcoin.fields.hash_ import Hash256
+
+__tableprefix__ = 'bitcoin_'
+
+def upgrade():
+    # VerifiedSignature
+    __tablename__ = __tableprefix__ + 'verified_signature'
+    op.create_table(__tablename__,
+        Column('sighash', Hash256, nullable=False),
+        Column('public_key', LargeBinary(65), nullable=False),
+        Column('signature', EcdsaCompactSignature, nullable=False),
+        PrimaryKeyConstraint('sighash', 'public_key', 'signature',
+            name = '__'.join(['pk', __tablename__])),)
+
+def downgrade():
+    op.drop_table(__tableprefix__ + 'verified_signature')
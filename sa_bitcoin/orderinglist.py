@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+from contextlib import contextmanager
+
+from sqlalchemy.ext.orderinglist import OrderingList, count_from_n_factory
+from sqlalchemy.orm.collections import collection_adapter
+
+class AppendOnlyOrderingList(OrderingList):
+    """An `OrderingList` with an append-only mode for bulk ingest.
+
+    While `append_only` is set each appended entity has its ordering attribute
+    assigned exactly once, in constant time, and any operation which would
+    renumber existing entries raises `TypeError` instead. Outside of
+    append-only mode it behaves like `OrderingList`, except that insertions
+    and removals only renumber the entries following the point of change."""
+
+    def __init__(self, ordering_attr=None, ordering_func=None,
+                 reorder_on_append=False, append_only=False):
+        super(AppendOnlyOrderingList, self).__init__(
+            ordering_attr, ordering_func, reorder_on_append)
+        self.append_only = append_only
+
+    def _check_renumber(self, start):
+        if self.append_only and start < len(self):
+            raise TypeError(u"cannot renumber '%s' in append-only mode"
+                % self.ordering_attr)
+
+    def _reorder_from(self, start):
+        for index in xrange(max(start, 0), len(self)):
+            self._order_entity(index, self[index], True)
+
+    def _start(self, index):
+        if index is None:
+            return 0
+        if index < 0:
+            index += len(self)
+        return min(max(index, 0), len(self))
+
+    def reorder(self):
+        self._check_renumber(0)
+        self._reorder_from(0)
+    _reorder = reorder
+
+    def append(self, entity):
+        if self.append_only:
+            # Nothing is ever renumbered in append-only mode, so the new
+            # entity's position is final and its value is written once,
+            # straight into the instance dictionary without firing attribute
+            # events. This is safe because only entities without a value,
+            # i.e. ones not yet persisted, are written to, and the INSERT
+            # for a pending instance reads its column values from that same
+            # dictionary. Entities which already carry a value (e.g. when
+            # loaded from the database) are left untouched.
+            dict_ = entity.__dict__
+            if dict_.get(self.ordering_attr) is None:
+                dict_[self.ordering_attr] = self.ordering_func(len(self), self)
+            list.append(self, entity)
+        else:
+            list.append(self, entity)
+            self._order_entity(len(self) - 1, entity, self.reorder_on_append)
+
+    def insert(self, index, entity):
+        start = self._start(index)
+        self._check_renumber(start)
+        list.insert(self, start, entity)
+        self._reorder_from(start)
+
+    def remove(self, entity):
+        start = self.index(entity)
+        self._check_renumber(start + 1)
+        list.remove(self, entity)
+        adapter = collection_adapter(self)
+        if adapter and adapter._referenced_by_owner:
+            self._reorder_from(start)
+
+    def pop(self, index=-1):
+        start = self._start(index)
+        self._check_renumber(start + 1)
+        entity = list.pop(self, index)
+        self._reorder_from(start)
+        return entity
+
+    def __setitem__(self, index, entity):
+        if isinstance(index, slice):
+            self._check_renumber(self._start(index.start))
+        else:
+            self._check_renumber(self._start(index))
+        super(AppendOnlyOrderingList, self).__setitem__(index, entity)
+
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            start = self._start(index.start)
+        else:
+            start = self._start(index)
+        self._check_renumber(start + 1)
+        list.__delitem__(self, index)
+        self._reorder_from(start)
+
+    def __setslice__(self, start, end, values):
+        start = self._start(start)
+        self._check_renumber(start)
+        list.__setslice__(self, start, end, values)
+        self._reorder_from(start)
+
+    def __delslice__(self, start, end):
+        start = self._start(start)
+        self._check_renumber(self._start(end))
+        list.__delslice__(self, start, end)
+        self._reorder_from(start)
+
+def ordering_list(attr, count_from=None, append_only=False, **kwargs):
+    """Prepares an `AppendOnlyOrderingList` factory for use in mapper
+    definitions. Takes the same arguments as SQLAlchemy's `ordering_list`,
+    plus the initial value of `append_only` for new collections."""
+    if count_from is not None:
+        kwargs['ordering_func'] = count_from_n_factory(count_from)
+    return lambda: AppendOnlyOrderingList(attr,
+        append_only = append_only, **kwargs)
+
+@contextmanager
+def append_only(*collections):
+    """Places the passed ordering collections into append-only mode for the
+    duration of the `with` block:
+
+        with append_only(tx.inputs, tx.outputs):
+            tx.inputs.extend(inputs)
+            tx.outputs.extend(outputs)
+    """
+    saved = [collection.append_only for collection in collections]
+    for collection in collections:
+        collection.append_only = True
+    try:
+        yield
+    finally:
+        for collection, mode in zip(collections, saved):
+            collection.append_only = mode
@@ -5,13 +5,19 @@ from sqlalchemy import *
 from sqlalchemy import orm
 from . import Base
 
+from .batching import CHUNK_SIZE, _chunks
 from .fields.binary import BitField
 from .fields.hash_ import Hash256
 from .mixins.hashable import HybridHashableMixin
 
 from bitcoin import patricia as core
+from bitcoin.hash import hash256
+from bitcoin.serialize import serialize_hash, serialize_varchar, serialize_varint
 from bitcoin.tools import Bits
 
+from os.path import commonprefix
+from struct import pack
+
 class PatriciaNode(HybridHashableMixin, core.PatriciaNode, Base):
     __slots__ = ('value prune_value '
                  'left_prefix left_node left_hash '
@@ -20,7 +26,13 @@ class PatriciaNode(HybridHashableMixin, core.PatriciaNode, Base):
     __tablename__ = 'bitcoin_patricia_node'
     __table_args__ = (
         Index('__'.join(['ix',__tablename__,'hash']),
-            'hash'),)
+            'hash'),
+        # Child lookups, for the garbage collector and the foreign key
+        # checks made when nodes are deleted.
+        Index('__'.join(['ix',__tablename__,'left_node_id']),
+            'left_node_id'),
+        Index('__'.join(['ix',__tablename__,'right_node_id']),
+            'right_node_id'),)
     __lazy_slots__ = ('hash',)
     id = Column(Integer,
         Sequence('__'.join([__tablename__,'id','seq'])),
@@ -41,14 +53,14 @@ class PatriciaNode(HybridHashableMixin, core.PatriciaNode, Base):
     left_node_id = Column(Integer, ForeignKey('bitcoin_patricia_node.id'))
     left_node    = orm.relationship(lambda: PatriciaNode,
         primaryjoin = 'PatriciaNode.id == PatriciaNode.left_node_id',
-        uselist     = False)
+        remote_side = 'PatriciaNode.id')
     left_hash    = Column(Hash256(length=32))
 
     right_prefix  = Column(BitField(implicit=Bits('0b1')))
     right_node_id = Column(Integer, ForeignKey('bitcoin_patricia_node.id'))
     right_node    = orm.relationship(lambda: PatriciaNode,
         primaryjoin = 'PatriciaNode.id == PatriciaNode.right_node_id',
-        uselist     = False)
+        remote_side = 'PatriciaNode.id')
     right_hash    = Column(Hash256(length=32))
 
     @property
@@ -81,6 +93,138 @@ class PatriciaNode(HybridHashableMixin, core.PatriciaNode, Base):
     def children_create(self):
         pass
 
+    def _branch(self, bit):
+        if bit:
+            return (self.right_prefix, self.right_node, self.right_hash)
+        return (self.left_prefix, self.left_node, self.left_hash)
+    def _set_branch(self, bit, prefix=None, node=None, hash=None):
+        if bit:
+            self.right_prefix, self.right_node, self.right_hash = prefix, node, hash
+        else:
+            self.left_prefix, self.left_node, self.left_hash = prefix, node, hash
+
+    def batch_update(self, changes):
+        """x.batch_update(E) -> int. Applies the (key, value) pairs of the
+        mapping or iterable E in order, where a value of None deletes the key,
+        and returns the number of nodes rehashed.
+
+        Unlike `update()` and `delete()`, which copy and rehash the path from
+        the root for every key, each node on the path to a changed key is
+        copied at most once, then modified in place by later changes in the
+        batch. The hashes, sizes and lengths of the dirty nodes are recomputed
+        in a single bottom-up pass at the end, so that nodes shared by the
+        paths of many keys (such as the root) are hashed once per batch."""
+        node_class = getattr(self, 'get_node_class',
+            lambda: getattr(self, 'node_class', self.__class__))()
+
+        # Nodes created by this batch, which may be modified in place, by id().
+        dirty = {id(self): self}
+        def own(node):
+            if id(node) not in dirty:
+                node = node.copy(node_class=node_class)
+                dirty[id(node)] = node
+            return node
+        def create(value=None):
+            node = node_class(value=value)
+            dirty[id(node)] = node
+            return node
+        def discard(node):
+            del dirty[id(node)]
+            session = orm.object_session(node)
+            if session is not None and node in session.new:
+                session.expunge(node)
+
+        if hasattr(changes, 'keys'):
+            changes = ((key, changes[key]) for key in changes)
+        for key, value in changes:
+            key, key_ = self._prepare_key(key), key
+            if value is not None:
+                value = self._prepare_value(value)
+                if not isinstance(value, bytes):
+                    raise TypeError(u"%s can only map bitstring -> binary type"
+                        % self.__class__.__name__)
+
+            # Walk down to the key, taking ownership of each node on the path.
+            node, subkey, path = self, key, []
+            while len(subkey):
+                prefix, child, hash_ = node._branch(subkey[0])
+                if prefix is None or not subkey.startswith(prefix):
+                    break
+                if child is None:
+                    raise KeyError(key_)
+                child = own(child)
+                node._set_branch(subkey[0], prefix, child)
+                path.append((node, subkey[0]))
+                node, subkey = child, subkey[len(prefix):]
+
+            if value is None:
+                if len(subkey) or node.value is None:
+                    raise KeyError(key_)
+                node.value, node.prune_value = None, None
+                branches = [x for x in (node._branch(False), node._branch(True))
+                            if x[0] is not None]
+                if path and not branches:
+                    # Remove the now empty node from its parent...
+                    parent, bit = path.pop()
+                    parent._set_branch(bit)
+                    discard(node)
+                    node = parent
+                    branches = [x for x in (node._branch(False),
+                                            node._branch(True))
+                                if x[0] is not None]
+                if path and node.value is None and len(branches) == 1:
+                    # ...and squash a valueless node with its only child.
+                    parent, bit = path.pop()
+                    prefix, child, hash_ = branches[0]
+                    parent._set_branch(bit, parent._branch(bit)[0] + prefix,
+                        child, hash_)
+                    discard(node)
+
+            elif not len(subkey):
+                node.value, node.prune_value = value, False
+
+            else:
+                prefix, child, hash_ = node._branch(subkey[0])
+                if prefix is None:
+                    node._set_branch(subkey[0], subkey, create(value))
+                else:
+                    # Split the branch at the point where it diverges from
+                    # the key.
+                    common = commonprefix([prefix, subkey])
+                    inner = create()
+                    inner._set_branch(prefix[len(common)],
+                        prefix[len(common):], child, hash_)
+                    if len(common) == len(subkey):
+                        inner.value, inner.prune_value = value, False
+                    else:
+                        inner._set_branch(subkey[len(common)],
+                            subkey[len(common):], create(value))
+                    node._set_branch(subkey[0], common, inner)
+
+        # Rehash the dirty nodes children first. These form a subtree sharing
+        # the root, so only dirty children need to be descended into.
+        stack = [(self, False)]
+        while stack:
+            node, visited = stack.pop()
+            if not visited:
+                stack.append((node, True))
+                stack.extend((child, False)
+                    for child in (node.left_node, node.right_node)
+                    if child is not None and id(child) in dirty)
+                continue
+            size = int(node.value is not None)
+            length = size - int(node.prune_value is True)
+            for bit in (False, True):
+                prefix, child, hash_ = node._branch(bit)
+                if child is not None:
+                    node._set_branch(bit, prefix, child, child.hash)
+                    size += child.size
+                    length += child.length
+            node.size, node.length = size, length
+            node._hash = None
+            node.hash
+        return len(dirty)
+
     # The digest value which results from applying the double-SHA256 function
     # to the serial representation of this node.
     _hash = Column('hash', Hash256(length=32), nullable=False)
@@ -135,3 +279,272 @@ class PatriciaNodeLink(Base):
         ForeignKey('bitcoin_patricia_link.id'),
         index = True, nullable = False)
     link = orm.relationship(lambda: PatriciaLink)
+
+# ===----------------------------------------------------------------------===
+
+# Helpers for code which walks or rebuilds persisted trees row by row, rather
+# than through the ORM. Rows are those of the `PatriciaNode` table.
+
+def node_flags(row):
+    "Returns the serialization flags of a node row, as `PatriciaNode.flags`."
+    flags = int(row.value is not None) << core.PatriciaNode.HAS_VALUE
+    for prefix, node_id, offset, prune in (
+            (row.left_prefix,  row.left_node_id,
+             core.PatriciaNode.OFFSET_LEFT,  core.PatriciaNode.PRUNE_LEFT),
+            (row.right_prefix, row.right_node_id,
+             core.PatriciaNode.OFFSET_RIGHT, core.PatriciaNode.PRUNE_RIGHT)):
+        if prefix is not None:
+            flags |= min(3, len(prefix)) << offset
+            flags |= int(node_id is None) << prune
+    flags |= int(row.prune_value is True) << core.PatriciaNode.PRUNE_VALUE
+    return flags
+
+def node_digest(flags, branches, value):
+    """Returns the digest serialization of a node, the SHA-256^2 hash of which
+    is the node's hash, given its flags, its (prefix, child hash) branches
+    in left-right order, and its value."""
+    parts = [pack('B', flags & core.PatriciaNode.HASH_MASK)]
+    for prefix, hash_ in branches:
+        if len(prefix) >= 3:
+            parts.append(serialize_varint(len(prefix) - 3))
+        parts.append(prefix[1:].tobytes())
+        parts.append(serialize_hash(hash_, 32))
+    if value is not None:
+        parts.append(serialize_varchar(value))
+    return b''.join(parts)
+
+def select_tree(root_id):
+    """Selects the nodes of the tree rooted at `root_id` in post-order. Each
+    node's path from the root is spelled out in '0' (left) and '1' (right)
+    characters; sorting on the path with a '2' appended places every node
+    after all of its descendants, and left subtrees before right ones."""
+    node = PatriciaNode.__table__
+    parent, child = node.alias(), node.alias()
+    tree = (select([node.c.id, cast(literal(''), Text).label('path')])
+        .where(node.c.id == root_id)
+        .cte('tree', recursive=True))
+    tree = tree.union_all(
+        select([child.c.id, cast(tree.c.path + case(
+                [(child.c.id == parent.c.left_node_id, literal('0'))],
+                else_ = literal('1')), Text)])
+        .select_from(tree
+            .join(parent, parent.c.id == tree.c.id)
+            .join(child, child.c.id.in_([parent.c.left_node_id,
+                                         parent.c.right_node_id]))))
+    return (select([node])
+        .select_from(node.join(tree, tree.c.id == node.c.id))
+        .order_by(tree.c.path + literal('2'))
+        .execution_options(stream_results=True))
+
+def next_node_id(session):
+    """Returns the first free `PatriciaNode` id, for code which allocates node
+    ids itself so that parent rows can reference children in bulk inserts.
+    Nothing else may insert nodes until `sync_node_sequence()` is called."""
+    node = PatriciaNode.__table__
+    return (session.execute(select([func.max(node.c.id)])).scalar() or 0) + 1
+
+def sync_node_sequence(session, last_id):
+    "Advances the id sequence, if any, past ids allocated from `next_node_id()`."
+    sequence = PatriciaNode.__table__.c.id.default
+    if (getattr(sequence, 'is_sequence', False) and
+            session.connection().dialect.name == 'postgresql'):
+        session.execute(select([func.setval(sequence.name, last_id)]))
+
+BATCH_SIZE = 1000
+
+def build_tree(session, node_class, items):
+    """Builds a persisted tree of `node_class` (e.g. `TxIdIndex`) from an
+    iterable of (key, value) pairs in ascending key order, and returns the
+    id of its root node.
+
+    The tree is built bottom-up in a single pass, keeping only the nodes on
+    the path to the most recent key open: when the next key diverges from
+    it, the nodes below the divergence point are complete, and are hashed
+    exactly once and queued for insertion. Rows are written with bulk
+    inserts, children before their parents. The result is identical to,
+    and has the same root hash as, the tree built by inserting each key in
+    turn."""
+    node = PatriciaNode.__table__
+    type_ = node_class.__mapper__.polymorphic_identity
+    next_id = [next_node_id(session)]
+    rows = []
+
+    def close(depth, value, children):
+        # Hashes a completed node, queues its row and returns the (id, hash,
+        # size) of the node for its parent's link to it.
+        row = {'id': next_id[0], 'type': type_, 'value': value,
+               'prune_value': False if value is not None else None,
+               'left_prefix':  None, 'left_node_id':  None, 'left_hash':  None,
+               'right_prefix': None, 'right_node_id': None, 'right_hash': None}
+        flags = int(value is not None) << core.PatriciaNode.HAS_VALUE
+        size = int(value is not None)
+        for prefix, (id_, hash_, size_) in children:
+            side, offset = prefix[0] and ('right', core.PatriciaNode.OFFSET_RIGHT) \
+                                      or ('left',  core.PatriciaNode.OFFSET_LEFT)
+            flags |= min(3, len(prefix)) << offset
+            row[side + '_prefix'], row[side + '_node_id'], row[side + '_hash'] = (
+                prefix, id_, hash_)
+            size += size_
+        row['hash'] = hash256.new(node_digest(flags, [(prefix, child[1])
+            for prefix, child in children], value)).intdigest()
+        row['size'] = row['length'] = size
+        rows.append(row)
+        next_id[0] += 1
+        if len(rows) >= BATCH_SIZE:
+            session.execute(node.insert(), rows)
+            del rows[:]
+        return (row['id'], row['hash'], size)
+
+    # Open nodes on the path to the previous key, as [depth in bits, value,
+    # completed children as (prefix, (id, hash, size))] lists.
+    stack, previous = [[0, None, []]], None
+    for key, value in items:
+        key = node_class._prepare_key(key)
+        value = node_class._prepare_value(value)
+        if previous is not None:
+            if not key > previous:
+                raise ValueError(u"keys must be unique and in ascending order")
+            common = len(commonprefix([previous.bin, key.bin]))
+            while stack[-1][0] > common:
+                depth, value_, children = stack.pop()
+                child = close(depth, value_, children)
+                if stack[-1][0] < common:
+                    stack.append([common, None, []])
+                parent = stack[-1]
+                parent[2].append((previous[parent[0]:depth], child))
+        if len(key) == stack[-1][0]:
+            stack[-1][1] = value
+        else:
+            stack.append([len(key), value, []])
+        previous = key
+    while len(stack) > 1:
+        depth, value_, children = stack.pop()
+        child = close(depth, value_, children)
+        parent = stack[-1]
+        parent[2].append((previous[parent[0]:depth], child))
+    root = close(*stack[0])
+    if rows:
+        session.execute(node.insert(), rows)
+    sync_node_sequence(session, root[0])
+    return root[0]
+
+def select_reachable(root_ids):
+    """Selects the ids of all nodes reachable from the nodes `root_ids`,
+    following both the inline child links of each node and any links through
+    `PatriciaNodeLink`. Subtrees shared between roots are visited once."""
+    node = PatriciaNode.__table__
+    link, node_link = PatriciaLink.__table__, PatriciaNodeLink.__table__
+    edges = union_all(
+        select([node.c.id.label('parent_id'),
+                node.c.left_node_id.label('child_id')])
+            .where(node.c.left_node_id != None),
+        select([node.c.id, node.c.right_node_id])
+            .where(node.c.right_node_id != None),
+        select([node_link.c.parent_id, link.c.node_id])
+            .select_from(node_link.join(link,
+                link.c.id == node_link.c.link_id))).alias('edges')
+    reachable = (select([node.c.id])
+        .where(node.c.id.in_(root_ids))
+        .cte('reachable', recursive=True))
+    reachable = reachable.union(
+        select([edges.c.child_id])
+        .select_from(reachable.join(edges,
+            edges.c.parent_id == reachable.c.id)))
+    return select([reachable.c.id])
+
+# The live node ids marked by `collect_garbage()`. The table is temporary,
+# and so private to the connection; it is left behind empty, to be dropped
+# when the connection is closed.
+_live = Table('bitcoin_patricia_live', MetaData(),
+    Column('id', Integer, primary_key=True),
+    prefixes = ['TEMPORARY'])
+
+def _lock_roots(session, root_ids):
+    node = PatriciaNode.__table__
+    if session.connection().dialect.name == 'sqlite':
+        # A write which changes nothing still takes the database write lock.
+        session.execute(node.update()
+            .where(node.c.id == None)
+            .values(id = node.c.id))
+    else:
+        for chunk in _chunks(root_ids):
+            session.execute(select([node.c.id])
+                .where(node.c.id.in_(chunk))
+                .order_by(node.c.id)
+                .with_for_update()).fetchall()
+
+def _garbage_ids(session, table, garbage, chunk_size):
+    """Yields successive chunks of the ids of the rows of `table` matching
+    `garbage`, in id order, so that each query resumes where the last left
+    off rather than rescanning rows already visited."""
+    last = None
+    while True:
+        where = garbage
+        if last is not None:
+            where = where & (table.c.id > last)
+        ids = [row.id for row in session.execute(select([table.c.id])
+            .where(where)
+            .order_by(table.c.id)
+            .limit(chunk_size))]
+        if not ids:
+            return
+        yield ids
+        last = ids[-1]
+
+def collect_garbage(session, root_ids, chunk_size=CHUNK_SIZE):
+    """Deletes every node, link and node-link row not reachable from the nodes
+    `root_ids`. The live nodes are marked in the database, by filling a
+    temporary table from `select_reachable()`, and the unreachable rows are
+    then deleted in chunks of at most `chunk_size`, so memory use does not
+    depend on the size of the trees. This is a generator, which yields the
+    number of rows deleted after each chunk:
+
+        for count in collect_garbage(session, [index.id]):
+            report(count)
+        session.commit()
+
+    Updates rewrite the root rows of trees in place, so a node written
+    between the mark and the sweep would be deleted while live. The retained
+    roots are therefore locked (on SQLite, the whole database) from before
+    the mark until the session's transaction ends, and updates to them wait
+    for it: the session must not be committed before the generator is
+    exhausted. Trees which are not retained must not be created or updated
+    while the collector runs. On SQLite creating the temporary table commits
+    any open transaction, so start the collection in a transaction of its
+    own."""
+    node = PatriciaNode.__table__
+    link, node_link = PatriciaLink.__table__, PatriciaNodeLink.__table__
+    root_ids = sorted(set(root_ids))
+    _live.create(session.connection(), checkfirst=True)
+    _lock_roots(session, root_ids)
+
+    # Mark.
+    session.execute(_live.delete())
+    session.execute(_live.insert().from_select(['id'],
+        select_reachable(root_ids)))
+    live = select([_live.c.id])
+
+    # Sweep. Link rows refer to nodes, so go first: node links of garbage
+    # parents, then links which no node link refers to any more.
+    for table, garbage in (
+            (node_link, ~node_link.c.parent_id.in_(live)),
+            (link,      ~exists().where(node_link.c.link_id == link.c.id))):
+        for ids in _garbage_ids(session, table, garbage, chunk_size):
+            session.execute(table.delete().where(table.c.id.in_(ids)))
+            yield len(ids)
+
+    # Garbage nodes may refer to each other in any order (roots are updated
+    # in place to point at newer nodes), so their child links are cleared
+    # first, after which they can be deleted in any order.
+    garbage = ~node.c.id.in_(live)
+    for ids in _garbage_ids(session, node, garbage &
+            ((node.c.left_node_id != None) | (node.c.right_node_id != None)),
+            chunk_size):
+        session.execute(node.update()
+            .where(node.c.id.in_(ids))
+            .values(left_node_id = None, right_node_id = None))
+    for ids in _garbage_ids(session, node, garbage, chunk_size):
+        session.execute(node.delete().where(node.c.id.in_(ids)))
+        yield len(ids)
+
+    session.execute(_live.delete())
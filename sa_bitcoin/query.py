@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+# Query helpers for the common access paths into the block chain tables. Each
+# returns an ORM `Query`, so callers may refine, paginate or eagerly load from
+# it as needed. Blocks and transactions are scoped to their chain, and every
+# helper filters on the leading `chain_id` column of the index it uses.
+
+# SQLAlchemy object-relational mapper
+from sqlalchemy import *
+from sqlalchemy import orm
+
+from .core import Block, BlockStats, ConnectedBlockInfo, Output, Transaction
+
+def block_by_hash(session, chain, hash):
+    "Returns a query for the block of `chain` with the passed hash."
+    return (session.query(Block)
+        .filter(Block.chain_id == chain.id)
+        .filter(Block.hash == hash))
+
+def transaction_by_hash(session, chain, hash):
+    "Returns a query for the transaction of `chain` with the passed hash."
+    return (session.query(Transaction)
+        .filter(Transaction.chain_id == chain.id)
+        .filter(Transaction.hash == hash))
+
+def blocks_by_prefix(session, chain, prefix):
+    """Returns a query for the blocks of `chain` whose hash, in hex, begins
+    with the passed string, in hash order."""
+    return (session.query(Block)
+        .filter(Block.chain_id == chain.id)
+        .filter(Block.hash.startswith(prefix))
+        .order_by(Block.hash))
+
+def transactions_by_prefix(session, chain, prefix):
+    """Returns a query for the transactions of `chain` whose hash, in hex,
+    begins with the passed string, in hash order."""
+    return (session.query(Transaction)
+        .filter(Transaction.chain_id == chain.id)
+        .filter(Transaction.hash.startswith(prefix))
+        .order_by(Transaction.hash))
+
+def blocks_at_height(session, chain, height):
+    """Returns a query for the connected blocks of `chain` at the passed
+    height, ordered by descending aggregate work."""
+    return (session.query(Block)
+        .join(ConnectedBlockInfo, ConnectedBlockInfo.block_id == Block.id)
+        .filter(ConnectedBlockInfo.chain_id == chain.id)
+        .filter(ConnectedBlockInfo.height == height)
+        .order_by(ConnectedBlockInfo.aggregate_work.desc()))
+
+def best_tip(session, chain):
+    """Returns a query for the `ConnectedBlockInfo` of the tip of `chain` with
+    the most aggregate work, the first stored of those with equal work."""
+    return (session.query(ConnectedBlockInfo)
+        .filter(ConnectedBlockInfo.chain_id == chain.id)
+        .order_by(ConnectedBlockInfo.aggregate_work.desc(),
+                  ConnectedBlockInfo.block_id)
+        .limit(1))
+
+def outputs_by_address(session, chain, address, unspent=False):
+    """Returns a query for the outputs paying to the passed base58 address of
+    `chain`, resolved against the materialized destination index. If
+    `unspent` is set only outputs not spent on the best chain are returned.
+    The contracts of an address are often shared, so shared contracts are
+    loaded in the same query."""
+    type_, hash = chain.address_destination(address)
+    query = (session.query(Output)
+        .options(orm.joinedload(Output.shared_contract))
+        .join(Transaction, Transaction.id == Output.transaction_id)
+        .filter(Transaction.chain_id == chain.id)
+        .filter(Output.destination_hash == hash)
+        .filter(Output.destination_type == type_))
+    if unspent:
+        query = query.filter(~Output.is_spent)
+    return query
+
+# The summed columns of `BlockStats`.
+STATS_COLUMNS = ('transaction_count', 'input_count', 'output_count',
+                 'output_amount', 'fee', 'size')
+
+def _stats_totals(session, *keys):
+    return session.query(*(keys + (func.count().label('block_count'),) +
+        tuple(func.sum(getattr(BlockStats, name)).label(name)
+              for name in STATS_COLUMNS)))
+
+def block_stats(session, chain, start, end):
+    """Returns a query for the `BlockStats` of `chain` at heights from
+    `start` up to but excluding `end`, in height order."""
+    return (session.query(BlockStats)
+        .filter(BlockStats.chain_id == chain.id)
+        .filter(BlockStats.height >= start)
+        .filter(BlockStats.height <  end)
+        .order_by(BlockStats.height))
+
+def stats_by_height(session, chain, start, end, interval=None):
+    """Returns a query for the block count and the totals of `STATS_COLUMNS`
+    over the blocks of `chain` at heights from `start` up to but excluding
+    `end`. If `interval` is given there is a row for each run of `interval`
+    blocks, labelled with the run's first height as `height`, in height
+    order."""
+    where = ((BlockStats.chain_id == chain.id) &
+             (BlockStats.height >= start) &
+             (BlockStats.height <  end))
+    if interval is None:
+        return _stats_totals(session).filter(where)
+    bucket = (BlockStats.height / interval * interval).label('height')
+    return (_stats_totals(session, bucket)
+        .filter(where)
+        .group_by(bucket)
+        .order_by(bucket))
+
+def stats_by_time(session, chain, start, end):
+    """Returns a query for the block count and the totals of `STATS_COLUMNS`
+    over the blocks of `chain` with a `Block.time` from `start` up to but
+    excluding `end`, each either a datetime or a UNIX timestamp."""
+    return (_stats_totals(session)
+        .filter(BlockStats.chain_id == chain.id)
+        .filter(BlockStats.time >= start)
+        .filter(BlockStats.time <  end))
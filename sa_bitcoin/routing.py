@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+# Read/write splitting for deployments with streaming replicas. A `Router`
+# holds the engine of the primary and those of any number of replicas, and a
+# `RoutingSession` sends ORM reads of the block chain and ledger tables to a
+# replica which is sufficiently up to date, and everything else to the
+# primary:
+#
+#     router = Router(primary, [replica1, replica2], max_lag=2)
+#     Session = orm.sessionmaker(class_=RoutingSession, router=router,
+#                                chain_id=chain.id)
+#
+# How far a replica lags is measured in blocks, as the difference between
+# the best `ConnectedBlockInfo.height` of a chain on the primary and that on
+# the replica, and is rechecked at most every `interval` seconds. A session
+# given the id of the chain it reads is routed by the lag of that chain
+# alone; otherwise a replica must be within `max_lag` blocks on every chain.
+#
+# Once a session has written anything, whether by flushing or by executing
+# a statement other than a SELECT, it reads from the primary until the end of
+# the transaction, so that it always sees its own writes. Core statements
+# passed to `Session.execute()` always run on the primary.
+
+import random
+import threading
+import time
+
+# SQLAlchemy object-relational mapper
+from sqlalchemy import *
+from sqlalchemy import event, exc, orm
+from sqlalchemy.sql.expression import Select
+
+from .core import Block, BlockStats, BlockTransactionListNode, \
+    ConnectedBlockInfo, Input, Output, SharedScript, Transaction
+from .patricia import PatriciaNode
+
+# Classes whose rows are only ever written by ingest, and may therefore be
+# read from a replica.
+REPLICATED = (Block, BlockStats, BlockTransactionListNode, ConnectedBlockInfo,
+              Transaction, Input, Output, SharedScript, PatriciaNode)
+
+class Router(object):
+    """Chooses between a primary engine and its replicas. A replica is only
+    used while its best block is at most `max_lag` blocks behind that of the
+    primary; if none is, reads go to the primary."""
+    def __init__(self, primary, replicas=(), max_lag=1, interval=5.0):
+        self.primary, self.replicas = primary, list(replicas)
+        self.max_lag, self.interval = max_lag, interval
+        # The fresh replicas, and when they were checked, by chain id.
+        self._fresh = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def height(bind, chain_id):
+        """Returns the height of the best connected block of chain `chain_id`
+        in the database, or None if it has none."""
+        info = ConnectedBlockInfo.__table__
+        return bind.execute(select([func.max(info.c.height)])
+            .where(info.c.chain_id == chain_id)).scalar()
+
+    @staticmethod
+    def heights(bind):
+        """Returns a dictionary mapping the id of each chain with connected
+        blocks in the database to the height of its best block."""
+        info = ConnectedBlockInfo.__table__
+        return dict(bind.execute(
+            select([info.c.chain_id, func.max(info.c.height)])
+            .group_by(info.c.chain_id)).fetchall())
+
+    def lag(self, chain_id=None):
+        """Returns a dictionary mapping each replica to the number of blocks
+        it is behind the primary on chain `chain_id`, or on the chain on
+        which it is furthest behind if no chain is given, or to None if it
+        cannot be reached."""
+        if chain_id is not None:
+            heights = lambda bind: dict((chain_id, height)
+                for height in [self.height(bind, chain_id)]
+                if height is not None)
+        else:
+            heights = self.heights
+        primary = heights(self.primary)
+        lag = {}
+        for replica in self.replicas:
+            try:
+                replica_ = heights(replica)
+            except exc.DBAPIError:
+                lag[replica] = None
+                continue
+            # A chain with no blocks at all is one below the genesis block.
+            lag[replica] = max([0] + [height - replica_.get(chain_id_, -1)
+                for chain_id_, height in primary.iteritems()])
+        return lag
+
+    def fresh_replicas(self, chain_id=None):
+        """Returns the replicas within `max_lag` blocks of the primary on
+        chain `chain_id`, or on every chain if none is given."""
+        with self._lock:
+            now = time.time()
+            fresh, checked = self._fresh.get(chain_id, ([], None))
+            if checked is None or now - checked >= self.interval:
+                fresh = [replica
+                    for replica, lag in self.lag(chain_id).iteritems()
+                    if lag is not None and lag <= self.max_lag]
+                self._fresh[chain_id] = (fresh, now)
+            return fresh
+
+    def reader(self, chain_id=None):
+        "Returns the engine to use for a read of chain `chain_id`."
+        replicas = self.fresh_replicas(chain_id)
+        if replicas:
+            return random.choice(replicas)
+        return self.primary
+
+class RoutingSession(orm.Session):
+    """A session which reads the classes of `REPLICATED` through `router`,
+    and performs all other access on the primary. Replicas are chosen by
+    their lag on chain `chain_id`, if given. Setting `use_primary` sends
+    every read to the primary for the rest of the transaction."""
+    def __init__(self, router, chain_id=None, *args, **kwargs):
+        kwargs.pop('bind', None)
+        super(RoutingSession, self).__init__(*args, **kwargs)
+        self.router, self.chain_id = router, chain_id
+        self.use_primary = False
+
+    def get_bind(self, mapper=None, clause=None):
+        if (self._flushing or self.use_primary or mapper is None or
+                not issubclass(mapper.class_, REPLICATED)):
+            return self.router.primary
+        return self.router.reader(self.chain_id)
+
+    def execute(self, clause, *args, **kwargs):
+        if not isinstance(clause, Select):
+            self.use_primary = True
+        return super(RoutingSession, self).execute(clause, *args, **kwargs)
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _after_flush(session, flush_context):
+    session.use_primary = True
+
+@event.listens_for(RoutingSession, 'after_commit')
+@event.listens_for(RoutingSession, 'after_rollback')
+def _after_transaction(session):
+    session.use_primary = False
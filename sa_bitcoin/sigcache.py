@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+# A persistent cache of successful signature verifications, so that the
+# signatures of a block are only checked once, however many times the block
+# is revalidated or reconnected across reorganizations. Only signatures which
+# verify are recorded; a failure is never cached, so the cache cannot be
+# filled with garbage by presenting invalid signatures.
+#
+# Lookups go first to a bounded in-process tier and then to the database, in
+# one batch for all the signature checks of a block:
+#
+#     cache = SignatureCache()
+#     results = cache.verify_many(session,
+#         [(sighash, public_key, signature) for ... in block])
+
+# SQLAlchemy object-relational mapper
+from sqlalchemy import *
+from . import Base
+
+from .batching import _chunks
+from .cache import MemoryStore
+from .fields.ecdsa_ import EcdsaCompactSignature
+from .fields.hash_ import Hash256
+from .locking import insert_ignore
+
+from bitcoin.crypto import CompactSignature, VerifyingKey
+from bitcoin.tools import StringIO
+
+__tableprefix__ = 'bitcoin_'
+
+DEFAULT_SIZE = 100000
+
+class VerifiedSignature(Base):
+    __tablename__ = __tableprefix__ + 'verified_signature'
+
+    # The signature hash of the input, i.e. the digest which was signed.
+    sighash = Column(Hash256, nullable=False)
+
+    # The serialized public key, compressed (33 bytes) or not (65 bytes).
+    public_key = Column(LargeBinary(65), nullable=False)
+
+    # The (r, s) pair of the signature. The recovery id of the compact form
+    # plays no part in verification, and is always stored as zero.
+    signature = Column(EcdsaCompactSignature, nullable=False)
+
+    __table_args__ = (
+        PrimaryKeyConstraint('sighash', 'public_key', 'signature',
+            name = '__'.join(['pk', __tablename__])),)
+
+def verify_signature(sighash, public_key, signature):
+    """Returns whether `signature` is a valid signature of the digest
+    `sighash` by the serialized `public_key`."""
+    key = VerifyingKey.deserialize(StringIO(public_key))
+    return bool(key.verifies(signature, sighash))
+
+def _compact(signature):
+    if getattr(signature, 'v', None) == 0:
+        return signature
+    return CompactSignature(0, signature.r, signature.s)
+
+class SignatureCache(object):
+    """Verifies signatures with `verify`, a function with the signature of
+    `verify_signature()`, skipping those previously verified. At most
+    `size` verified signatures are also held in memory. `hits` and
+    `misses` count checks answered from the cache and by verification."""
+    def __init__(self, size=DEFAULT_SIZE, verify=verify_signature):
+        self.memory, self.verify = MemoryStore(size), verify
+        self.hits = self.misses = 0
+
+    @staticmethod
+    def _key(sighash, public_key, signature):
+        return (sighash, str(public_key), signature.r, signature.s)
+
+    def _lookup(self, session, keys):
+        "Returns those of the passed keys recorded in the database."
+        table = VerifiedSignature.__table__
+        found = set()
+        for chunk in _chunks(list(set(key[0] for key in keys))):
+            found.update(self._key(row.sighash, row.public_key, row.signature)
+                for row in session.execute(select([table])
+                    .where(table.c.sighash.in_(chunk))))
+        return found & set(keys)
+
+    def verify_many(self, session, checks):
+        """Returns a list of whether each of the passed (sighash, public key,
+        signature) triples verifies. The in-memory tier is consulted first,
+        then the database in a single batch of lookups, and the remaining
+        signatures are verified and, if valid, recorded in both."""
+        checks = [(sighash, public_key, _compact(signature))
+                  for sighash, public_key, signature in checks]
+        keys = [self._key(*check) for check in checks]
+        valid = set(key for key in keys if self.memory.get(key) is not None)
+        missing = set(keys) - valid
+        if missing:
+            for key in self._lookup(session, missing):
+                self.memory.set(key, True)
+                valid.add(key)
+
+        new = {}
+        for key, (sighash, public_key, signature) in zip(keys, checks):
+            if key in valid or key in new:
+                self.hits += 1
+            else:
+                self.misses += 1
+                if self.verify(sighash, public_key, signature):
+                    new[key] = {'sighash':    sighash,
+                                'public_key': public_key,
+                                'signature':  signature}
+                    self.memory.set(key, True)
+        if new:
+            # Another session may record the same signature meanwhile.
+            session.execute(insert_ignore(VerifiedSignature.__table__),
+                new.values())
+        valid.update(new)
+        return [key in valid for key in keys]
+
+    def verify_one(self, session, sighash, public_key, signature):
+        "As `verify_many()`, for a single signature."
+        return self.verify_many(session,
+            [(sighash, public_key, signature)])[0]
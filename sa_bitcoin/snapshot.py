@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+
+# Compact binary snapshots of the unspent outputs of a chain and of persisted
+# Patricia trees (`TxIdIndex`, `ContractIndex`), used to bootstrap a replica
+# without replaying the block chain. Both directions stream: rows are written
+# as they are read from the database, and loaded with batched inserts, so
+# neither side ever holds more than a batch in memory.
+#
+# A snapshot is laid out as follows, with integers as variable-length ints and
+# hashes as 32 little-endian bytes:
+#
+#   magic 'sabs', format version, genesis hash of the chain
+#   zero or more sections, each a tag byte followed by records, each record
+#     prefixed with 0x01, and the section terminated by 0x00:
+#       'U': unspent outputs, one record per transaction:
+#            hash, format, version, lock time, reference height,
+#            output count, then per output: offset, amount, contract
+#       'P': a Patricia tree, headed by its node type and root hash, with one
+#            record per node in post-order (children before parents):
+#            flags, left and right branches, value, size, length
+#   0x00
+#   SHA-256 checksum of all preceding bytes
+#
+# Branches are stored as the bit length and bits of the prefix following its
+# implicit first bit, followed by the hash of the child only if it is pruned;
+# the hashes of other children are recomputed while loading, so that the root
+# hash of every tree is verified against the value recorded in its header.
+
+import calendar
+from datetime import datetime
+import hashlib
+from struct import pack
+
+# SQLAlchemy object-relational mapper
+from sqlalchemy import *
+
+from .batching import CHUNK_SIZE, _chunks
+from .core import Output, SharedScript, Transaction
+from .fields.time_ import BlockTime
+from .ingest import _materialize_destinations
+from .patricia import (PatriciaNode, next_node_id, node_digest, node_flags,
+    select_tree, sync_node_sequence)
+
+from bitcoin import patricia as core
+from bitcoin.hash import hash256
+from bitcoin.script import Script
+from bitcoin.serialize import (
+    serialize_hash, deserialize_hash, serialize_varint, deserialize_varint,
+    serialize_varchar, deserialize_varchar)
+from bitcoin.tools import Bits
+
+MAGIC = b'sabs'
+VERSION = 1
+
+class _HashingFile(object):
+    "Wraps a file object, computing the SHA-256 of everything passed through."
+    def __init__(self, file_):
+        self.file_, self.digest = file_, hashlib.sha256()
+    def read(self, size):
+        data = self.file_.read(size)
+        self.digest.update(data)
+        return data
+    def write(self, data):
+        self.digest.update(data)
+        self.file_.write(data)
+
+def _unixtime(value):
+    if isinstance(value, datetime):
+        return calendar.timegm(value.utctimetuple())
+    return value
+
+def _lock_time(value):
+    if value >= BlockTime.THRESHOLD_UNIXTIME:
+        return datetime.utcfromtimestamp(value)
+    return value
+
+def _read_byte(file_):
+    byte = file_.read(1)
+    if not byte:
+        raise EOFError(u"unexpected end-of-file")
+    return ord(byte)
+
+def _records(file_):
+    "Iterates over the records of a section, i.e. until the 0x00 terminator"
+    while True:
+        marker = _read_byte(file_)
+        if marker == 0:
+            return
+        if marker != 1:
+            raise ValueError(u"corrupt snapshot: bad record marker 0x%02x"
+                % marker)
+        yield
+
+# ===----------------------------------------------------------------------===
+
+def _write_outputs(session, chain, file_):
+    tx, output = Transaction.__table__, Output.__table__
+    script = SharedScript.__table__
+    query = (select([tx.c.id, tx.c.hash, tx.c.format, tx.c.version,
+                     tx.c.lock_time, tx.c.reference_height,
+                     output.c.offset, output.c.amount,
+                     func.coalesce(output.c.contract,
+                         script.c.script).label('contract')])
+        .select_from(tx
+            .join(output, output.c.transaction_id == tx.c.id)
+            .outerjoin(script, script.c.id == output.c.contract_id))
+        .where((tx.c.chain_id == chain.id) &
+               (output.c.spent_by_transaction_id == None))
+        .order_by(tx.c.id, output.c.offset)
+        .execution_options(stream_results=True))
+
+    count, current, outputs = 0, None, []
+    def flush():
+        file_.write(b''.join([b'\x01',
+            serialize_hash(current.hash, 32),
+            serialize_varint(current.format),
+            serialize_varint(current.version),
+            serialize_varint(_unixtime(current.lock_time)),
+            serialize_varint(current.reference_height),
+            serialize_varint(len(outputs))] + outputs))
+    for row in session.execute(query):
+        if current is not None and current.id != row.id:
+            flush()
+            outputs = []
+        current = row
+        outputs.append(b''.join([
+            serialize_varint(row.offset),
+            serialize_varint(row.amount),
+            serialize_varchar(row.contract)]))
+        count += 1
+    if current is not None:
+        flush()
+    file_.write(b'\x00')
+    return count
+
+def _write_tree(session, root, file_):
+    file_.write(b''.join([b'P',
+        serialize_varchar(root.type.encode('ascii')),
+        serialize_hash(root.hash, 32)]))
+    count = 0
+    for row in session.execute(select_tree(root.id)):
+        parts = [b'\x01', pack('B', node_flags(row))]
+        for prefix, node_id, hash_ in (
+                (row.left_prefix,  row.left_node_id,  row.left_hash),
+                (row.right_prefix, row.right_node_id, row.right_hash)):
+            if prefix is not None:
+                parts.append(serialize_varint(len(prefix) - 1))
+                parts.append(prefix[1:].tobytes())
+                if node_id is None:
+                    parts.append(serialize_hash(hash_, 32))
+        if row.value is not None:
+            parts.append(serialize_varchar(row.value))
+        parts.append(serialize_varint(row.size))
+        parts.append(serialize_varint(row.length))
+        file_.write(b''.join(parts))
+        count += 1
+    file_.write(b'\x00')
+    return count
+
+def export_snapshot(session, chain, file_, roots=()):
+    """Writes a snapshot of the unspent outputs of `chain`, followed by the
+    Patricia trees rooted at each of the passed `PatriciaNode` instances, to
+    the binary file object `file_`. Returns the pair (number of outputs,
+    number of tree nodes) written."""
+    file_ = _HashingFile(file_)
+    file_.write(b''.join([MAGIC, serialize_varint(VERSION),
+        serialize_hash(chain.genesis_hash, 32), b'U']))
+    outputs = _write_outputs(session, chain, file_)
+    nodes = sum(_write_tree(session, root, file_) for root in roots)
+    file_.write(b'\x00')
+    file_.file_.write(file_.digest.digest())
+    return (outputs, nodes)
+
+# ===----------------------------------------------------------------------===
+
+def _store_outputs(session, chain, batch):
+    tx, output = Transaction.__table__, Output.__table__
+    session.execute(tx.insert(), [x[0] for x in batch])
+    ids = {}
+    for chunk in _chunks([x[0]['hash'] for x in batch]):
+        ids.update((row.hash, row.id) for row in session.execute(
+            select([tx.c.hash, tx.c.id])
+            .where((tx.c.chain_id == chain.id) & tx.c.hash.in_(chunk))))
+    session.execute(output.insert(), [
+        dict(row, transaction_id=ids[txn['hash']])
+        for txn, outputs in batch for row in outputs])
+    _materialize_destinations(session,
+        output.c.transaction_id.in_(ids.values()))
+
+def _read_outputs(session, chain, file_):
+    batch, count = [], 0
+    for _ in _records(file_):
+        txn = {
+            'chain_id':         chain.id,
+            'hash':             deserialize_hash(file_, 32),
+            'format':           deserialize_varint(file_),
+            'version':          deserialize_varint(file_),
+            'lock_time':        _lock_time(deserialize_varint(file_)),
+            'reference_height': deserialize_varint(file_),
+        }
+        outputs = [{
+            'offset':   deserialize_varint(file_),
+            'amount':   deserialize_varint(file_),
+            'contract': Script(deserialize_varchar(file_)),
+        } for _ in xrange(deserialize_varint(file_))]
+        batch.append((txn, outputs))
+        count += len(outputs)
+        if len(batch) >= CHUNK_SIZE:
+            _store_outputs(session, chain, batch)
+            batch = []
+    if batch:
+        _store_outputs(session, chain, batch)
+    return count
+
+def _read_tree(session, file_, next_id):
+    """Loads one Patricia tree section, assigning node ids from `next_id`.
+    Returns the pair (root id, number of nodes)."""
+    node = PatriciaNode.__table__
+    type_ = deserialize_varchar(file_).decode('ascii')
+    root_hash = deserialize_hash(file_, 32)
+
+    # Completed subtrees, as (id, hash) pairs. As nodes arrive in post-order
+    # the children of each node are the topmost entries, so the stack never
+    # grows beyond the depth of the tree.
+    stack, rows, count = [], [], 0
+    for _ in _records(file_):
+        flags = _read_byte(file_)
+        row = {'id': next_id + count, 'type': type_}
+        branches = []
+        for side, implicit, offset, prune in (
+                ('left',  Bits('0b0'),
+                 core.PatriciaNode.OFFSET_LEFT,  core.PatriciaNode.PRUNE_LEFT),
+                ('right', Bits('0b1'),
+                 core.PatriciaNode.OFFSET_RIGHT, core.PatriciaNode.PRUNE_RIGHT)):
+            if not (flags >> offset) & 3:
+                row.update({side + '_prefix': None, side + '_node_id': None,
+                            side + '_hash': None})
+                continue
+            bitlength = deserialize_varint(file_)
+            prefix = implicit + Bits(bytes=file_.read((bitlength + 7) // 8),
+                                     length=bitlength)
+            pruned = bool(flags & (1 << prune))
+            row[side + '_prefix'] = prefix
+            row[side + '_hash'] = \
+                deserialize_hash(file_, 32) if pruned else None
+            branches.append((side, prefix, pruned))
+        # Non-pruned children are popped right-to-left.
+        for side, prefix, pruned in reversed(branches):
+            if pruned:
+                row[side + '_node_id'] = None
+            else:
+                if not stack:
+                    raise ValueError(u"corrupt snapshot: missing subtree")
+                row[side + '_node_id'], row[side + '_hash'] = stack.pop()
+        if flags & (1 << core.PatriciaNode.HAS_VALUE):
+            row['value'] = deserialize_varchar(file_)
+            row['prune_value'] = bool(flags & (1 << core.PatriciaNode.PRUNE_VALUE))
+        else:
+            row['value'], row['prune_value'] = None, None
+        row['size'] = deserialize_varint(file_)
+        row['length'] = deserialize_varint(file_)
+
+        row['hash'] = hash256.new(node_digest(flags,
+            [(prefix, row[side + '_hash']) for side, prefix, pruned in branches],
+            row['value'])).intdigest()
+
+        stack.append((row['id'], row['hash']))
+        rows.append(row)
+        count += 1
+        if len(rows) >= CHUNK_SIZE:
+            session.execute(node.insert(), rows)
+            rows = []
+    if rows:
+        session.execute(node.insert(), rows)
+
+    if len(stack) != 1 or stack[0][1] != root_hash:
+        raise ValueError(u"root hash of %s tree does not match the snapshot"
+            % type_)
+    return (stack[0][0], count)
+
+def import_snapshot(session, chain, file_):
+    """Loads a snapshot written by `export_snapshot()` into the tables of
+    `chain`, which must have the same genesis block and must not yet hold
+    any of the snapshot's transactions. The root hash of each tree is
+    verified as it is loaded, and the checksum of the whole file once it has
+    been read; on any mismatch `ValueError` is raised, and the caller should
+    roll back the session. Patricia node ids are allocated sequentially above
+    the current maximum, so nothing else may write to the Patricia tables
+    while the import runs. Returns the list of the ids of the loaded tree
+    roots, in the order they were written."""
+    file_ = _HashingFile(file_)
+    if file_.read(len(MAGIC)) != MAGIC:
+        raise ValueError(u"not a snapshot file")
+    version = deserialize_varint(file_)
+    if version != VERSION:
+        raise ValueError(u"unsupported snapshot version %d" % version)
+    if deserialize_hash(file_, 32) != chain.genesis_hash:
+        raise ValueError(u"snapshot is of a different chain")
+
+    next_id = next_node_id(session)
+    roots = []
+    while True:
+        tag = file_.read(1)
+        if tag == b'U':
+            _read_outputs(session, chain, file_)
+        elif tag == b'P':
+            root_id, count = _read_tree(session, file_, next_id)
+            roots.append(root_id)
+            next_id += count
+        elif tag == b'\x00':
+            break
+        else:
+            raise ValueError(u"corrupt snapshot: unknown section %r" % tag)
+
+    if file_.file_.read(32) != file_.digest.digest():
+        raise ValueError(u"snapshot checksum mismatch")
+
+    if roots:
+        sync_node_sequence(session, next_id - 1)
+    return roots
@@ -10,7 +10,7 @@ README = open(os.path.join(here, 'README.md')).read()
 CHANGES = open(os.path.join(here, 'CHANGES.md')).read()
 requires = filter(lambda r:'libs/' not in r,
     open(os.path.join(here, 'requirements.txt')).read().split())
-packages = filter(lambda p:not p.startswith('xunit'), find_packages())
+packages = filter(lambda p:not p.startswith(('xunit', 'bench')), find_packages())
 
 version = '0.0.3pre-alpha'
 setup(**{
@@ -1 +1,104 @@
 # -*- coding: utf-8 -*-
+
+import unittest2
+
+from sqlalchemy import create_engine, orm, select
+
+from bitcoin.script import Script
+from bitcoin import core
+
+from sa_bitcoin import Base
+from sa_bitcoin.core import Block, Chain, Input, Output, Transaction
+
+def make_session(url='sqlite://'):
+    "Returns a session bound to a new database with the full schema."
+    engine = create_engine(url)
+    Base.metadata.create_all(engine)
+    return orm.sessionmaker(bind=engine)()
+
+def make_chain(**kwargs):
+    "Returns a mainnet-like `Chain` for test fixtures."
+    params = dict(magic=b'\xf9\xbe\xb4\xd9', port=8333, genesis=b'\0'*80,
+        genesis_hash=0, pubkey_hash_prefix=0, script_hash_prefix=5,
+        secret_prefix=128, is_testnet=False)
+    params.update(kwargs)
+    return Chain(**params)
+
+def pubkey_hash_contract(payload):
+    "Returns the pay-to-pubkey-hash contract for a 20-byte payload."
+    return Script(b'\x76\xa9\x14' + payload + b'\x88\xac')
+
+def script_hash_contract(payload):
+    "Returns the pay-to-script-hash contract for a 20-byte payload."
+    return Script(b'\xa9\x14' + payload + b'\x87')
+
+def make_transaction(chain_id, spends=(), amounts=(50,), tag=b'',
+                     contracts=None):
+    """Returns a `Transaction` of chain `chain_id` spending the passed (hash,
+    index) outpoints, or a coinbase identified by `tag` if there are none,
+    with one output of each of the passed amounts, paying to the matching
+    entry of `contracts` or else anyone-can-spend. The chain is referred to
+    by id, so the transaction is not added to any session until it is
+    stored."""
+    if spends:
+        inputs = [Input(hash=hash, index=index, endorsement=Script(b'\x51'),
+                        sequence=0) for hash, index in spends]
+    else:
+        inputs = [Input(endorsement=Script(b'\x04' + tag), sequence=0)]
+    return Transaction(chain_id=chain_id, format=0, version=1, lock_time=0,
+        reference_height=0, inputs=inputs,
+        outputs=[Output(amount=amount, contract=contract)
+                 for amount, contract in zip(amounts,
+                     contracts or [Script(b'\x51')] * len(amounts))])
+
+def make_block(parent, nonce, transactions):
+    "Returns a block header with the passed parent hash and transactions."
+    block = core.Block(parent_hash=parent, time=1231006505+nonce, nonce=nonce)
+    block.transactions = transactions
+    return block
+
+def spent_outputs(session):
+    """Returns a dictionary mapping the (transaction hash, offset) of every
+    stored output to the (spending transaction hash, spent height), or to
+    None if it is unspent."""
+    output, tx = Output.__table__, Transaction.__table__
+    spender = tx.alias()
+    return dict(((row[0], row[1]),
+                 (row[2], row[3]) if row[2] is not None else None)
+        for row in session.execute(
+            select([tx.c.hash, output.c.offset, spender.c.hash,
+                    output.c.spent_height])
+            .select_from(output
+                .join(tx, tx.c.id == output.c.transaction_id)
+                .outerjoin(spender,
+                    spender.c.id == output.c.spent_by_transaction_id))))
+
+class ChainTestCase(unittest2.TestCase):
+    """Stores a chain of three blocks, the second spending an output of the
+    first, and the third an output of each of the first two:
+
+        0: cb0 (two outputs)
+        1: cb1, tx1 spending cb0:0
+        2: cb2, tx2 spending tx1:0 and cb0:1
+    """
+    def setUp(self):
+        self.session = make_session()
+        self.chain = make_chain()
+        self.session.add(self.chain)
+        self.session.flush()
+        id_ = self.chain.id
+        self.cb0 = make_transaction(id_, amounts=(50, 25), tag=b'0')
+        self.cb1 = make_transaction(id_, tag=b'1')
+        self.tx1 = make_transaction(id_, [(self.cb0.hash, 0)], (40, 10))
+        self.cb2 = make_transaction(id_, tag=b'2')
+        self.tx2 = make_transaction(id_,
+            [(self.tx1.hash, 0), (self.cb0.hash, 1)], (60,))
+        self.blocks = [make_block(0, 0, [self.cb0])]
+        self.blocks.append(make_block(self.blocks[-1].hash, 1,
+            [self.cb1, self.tx1]))
+        self.blocks.append(make_block(self.blocks[-1].hash, 2,
+            [self.cb2, self.tx2]))
+
+    def block_id(self, height):
+        return (self.session.query(Block.id)
+            .filter(Block.hash == self.blocks[height].hash).scalar())
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+
+import unittest2
+
+from sa_bitcoin import bulkload
+from sa_bitcoin.bulkload import DEFERRED, bulk_load, drop_deferred, \
+    restore_deferred
+from sa_bitcoin.core import Output
+
+from . import make_session
+
+def schema_sql(engine, type_='index'):
+    "The SQL of each index (or table) of the database, by name."
+    return dict(engine.execute("SELECT name, sql FROM sqlite_master "
+        "WHERE type = ? AND sql IS NOT NULL", type_).fetchall())
+
+class TestBulkLoad(unittest2.TestCase):
+    def setUp(self):
+        # Indexes are rebuilt on connections of their own, which would each
+        # see an empty in-memory database.
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.engine = make_session(
+            'sqlite:///' + os.path.join(directory, 'bulk.db')).bind
+        self.schema = schema_sql(self.engine)
+
+    def test_partial_index(self):
+        # A fresh process has not created the table, so the condition of the
+        # partial index was never attached.
+        for index in Output.__table__.indexes:
+            index.dialect_kwargs['sqlite_where'] = None
+        with bulk_load(self.engine):
+            pass
+        self.assertIn('WHERE', self.schema['ix__bitcoin_output__unspent'])
+        self.assertEqual(schema_sql(self.engine), self.schema)
+
+    def test_drop_and_restore(self):
+        tables = schema_sql(self.engine, 'table')
+        names = sorted(name for table, name in DEFERRED
+                       if name.startswith('ix__'))
+        self.assertEqual(sorted(drop_deferred(self.engine)), names)
+        self.assertEqual(
+            sorted(set(self.schema) - set(schema_sql(self.engine))), names)
+        self.assertEqual(drop_deferred(self.engine), [])
+        progress = []
+        self.assertEqual(sorted(restore_deferred(self.engine,
+            progress=lambda *args: progress.append(args))), names)
+        self.assertEqual([(done, total) for name, done, total in progress],
+            [(n + 1, len(names)) for n in xrange(len(names))])
+        self.assertEqual(schema_sql(self.engine), self.schema)
+        # Check constraints cannot be dropped on SQLite, so are kept.
+        self.assertEqual(schema_sql(self.engine, 'table'), tables)
+        self.assertEqual(restore_deferred(self.engine), [])
+
+    def test_raises(self):
+        with self.assertRaises(KeyError):
+            with bulk_load(self.engine):
+                self.assertNotIn('ix__bitcoin_output__unspent',
+                    schema_sql(self.engine))
+                raise KeyError()
+        self.assertEqual(schema_sql(self.engine), self.schema)
+
+    def test_serial_fallback(self):
+        # Once a build fails the rest are created one by one, the failed
+        # item is left missing and the error re-raised; a later call
+        # creates it.
+        drop_deferred(self.engine)
+        create = bulkload._create
+        self.addCleanup(setattr, bulkload, '_create', create)
+        calls = []
+        def failing(bind, item):
+            calls.append(item.name)
+            if item.name == 'ix__bitcoin_output__destination':
+                raise ValueError(item.name)
+            create(bind, item)
+        bulkload._create = failing
+        self.assertRaises(ValueError, restore_deferred, self.engine)
+        missing = set(self.schema) - set(schema_sql(self.engine))
+        self.assertEqual(missing, set(['ix__bitcoin_output__destination']))
+        self.assertEqual(calls.count('ix__bitcoin_output__destination'), 2)
+        bulkload._create = create
+        self.assertEqual(restore_deferred(self.engine),
+            ['ix__bitcoin_output__destination'])
+        self.assertEqual(schema_sql(self.engine), self.schema)
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+from sa_bitcoin import ingest
+from sa_bitcoin.cache import MemoryStore, QueryCache
+
+from . import ChainTestCase
+
+class CountingStore(MemoryStore):
+    "A `MemoryStore` counting the scans of its keys."
+    scans = 0
+    def keys(self):
+        self.scans += 1
+        return super(CountingStore, self).keys()
+
+class TestInvalidate(ChainTestCase):
+    def setUp(self):
+        super(TestInvalidate, self).setUp()
+        ingest.ingest_blocks(self.session, self.chain, self.blocks)
+        self.store = CountingStore()
+        self.cache = QueryCache(depth=1, stores=[self.store])
+        # Heights 0 and 1 are deep enough to be admitted; 2 is the tip.
+        for height in xrange(3):
+            self.cache.block_at_height(self.session, self.chain, height)
+
+    def cached(self):
+        return sorted(entry[0] for entry in (self.store.get(key)
+            for key in MemoryStore.keys(self.store)) if entry[1] is not None)
+
+    def test_shallow(self):
+        self.assertEqual(self.cached(), [0, 1])
+        self.cache.invalidate(self.chain, 2)
+        self.assertEqual(self.store.scans, 0)
+        self.assertEqual(self.cached(), [0, 1])
+
+    def test_disconnect(self):
+        ingest.disconnect_block(self.session, self.block_id(2), self.cache)
+        self.assertEqual(self.store.scans, 0)
+        ingest.disconnect_block(self.session, self.block_id(1), self.cache)
+        self.assertEqual(self.cached(), [0])
+        # Admitted again before the disconnection is committed, and dropped
+        # again once it is.
+        self.cache.block_at_height(self.session, self.chain, 1)
+        self.session.commit()
+        self.assertEqual(self.cached(), [0])
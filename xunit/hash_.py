@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+import imp
+import os
+
+import unittest2
+
+from sqlalchemy import select
+
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+
+from bitcoin.serialize import serialize_beint, serialize_hash
+
+# The mempool tables are among those the migration converts.
+from sa_bitcoin import ingest, mempool, query
+from sa_bitcoin.core import Block, Transaction
+from sa_bitcoin.fields.hash_ import Hash256
+
+from . import ChainTestCase
+
+def load_migration(revision):
+    import sa_bitcoin
+    return imp.load_source('_migration_' + revision,
+        os.path.join(os.path.dirname(sa_bitcoin.__file__),
+            'migrations', 'versions', revision + '_.py'))
+
+class TestPrefixRange(unittest2.TestCase):
+    def test_even(self):
+        self.assertEqual(Hash256(order_preserving=True).prefix_range('00ab'),
+            (0x00ab << 240, ((0x00ab + 1) << 240) - 1))
+
+    def test_odd(self):
+        self.assertEqual(Hash256(order_preserving=True).prefix_range('abc'),
+            (0xabc << 244, ((0xabc + 1) << 244) - 1))
+
+    def test_empty(self):
+        self.assertEqual(Hash256(order_preserving=True).prefix_range(''),
+            (0, 2**256 - 1))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError,
+            Hash256(order_preserving=True).prefix_range, '0' * 65)
+        self.assertRaises(ValueError, Hash256().prefix_range, 'ab')
+
+    def test_between(self):
+        self.assertIn('BETWEEN', str(Transaction.hash.startswith('abc')))
+
+class TestPrefixSearch(ChainTestCase):
+    def setUp(self):
+        super(TestPrefixSearch, self).setUp()
+        ingest.ingest_blocks(self.session, self.chain, self.blocks)
+        self.hashes = [tx.hash for tx in
+            (self.cb0, self.cb1, self.tx1, self.cb2, self.tx2)]
+
+    def found(self, prefix):
+        return [tx.hash for tx in
+            query.transactions_by_prefix(self.session, self.chain, prefix)]
+
+    def test_prefixes(self):
+        for hash_ in self.hashes:
+            for length in xrange(1, 6):
+                prefix = ('%064x' % hash_)[:length]
+                self.assertEqual(self.found(prefix), sorted(hash_
+                    for hash_ in self.hashes
+                    if ('%064x' % hash_).startswith(prefix)))
+        self.assertEqual(self.found(''), sorted(self.hashes))
+        self.assertEqual(self.found('%064x' % self.hashes[0]),
+            [self.hashes[0]])
+
+    def test_big_endian(self):
+        tx = Transaction.__table__
+        stored = dict(self.session.execute(select([tx.c.id, tx.c.hash]))
+            .fetchall())
+        raw = self.session.execute('SELECT id, hash FROM bitcoin_transaction '
+            'ORDER BY hash').fetchall()
+        self.assertEqual([bytes(row[1]) for row in raw],
+            [serialize_beint(stored[row[0]], 32) for row in raw])
+        self.assertEqual([stored[row[0]] for row in raw],
+            sorted(self.hashes))
+
+class TestReverseHashes(ChainTestCase):
+    "The migration storing hashes big-endian, and back."
+    def setUp(self):
+        super(TestReverseHashes, self).setUp()
+        ingest.ingest_blocks(self.session, self.chain, self.blocks)
+        self.session.commit()
+        self.migration = load_migration('7c4e1a9b2d05')
+
+    def migrate(self, direction):
+        connection = self.session.connection()
+        with Operations.context(MigrationContext.configure(connection)):
+            getattr(self.migration, direction)()
+        self.session.expire_all()
+
+    def raw(self, table):
+        return sorted(bytes(row[0]) for row in
+            self.session.execute('SELECT hash FROM %s' % table))
+
+    def test_round_trip(self):
+        hashes = sorted(block.hash for block in self.blocks)
+        self.assertEqual(self.raw('bitcoin_block'),
+            sorted(serialize_beint(hash_, 32) for hash_ in hashes))
+        self.migrate('downgrade')
+        self.assertEqual(self.raw('bitcoin_block'),
+            sorted(serialize_hash(hash_, 32) for hash_ in hashes))
+        self.migrate('upgrade')
+        self.assertEqual(sorted(block.hash
+            for block in self.session.query(Block)), hashes)
+        self.assertEqual(self.session.query(Transaction)
+            .filter(Transaction.hash == self.tx2.hash).one().hash,
+            self.tx2.hash)
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+
+import unittest2
+
+from sa_bitcoin.indexfile import IndexFile, export_index, verify_proof
+from sa_bitcoin.ledger import TxIdIndex
+from sa_bitcoin.patricia import PatriciaNode, build_tree
+
+from . import make_session
+
+class TestIndexFile(unittest2.TestCase):
+    "An image of a tree of 40 keys, one of which has an empty value."
+    def setUp(self):
+        self.session = make_session()
+        self.items = dict((b'%032d' % key, b'%d' % key) for key in xrange(40))
+        self.items[b'%032d' % 7] = b''
+        self.root = self.session.query(PatriciaNode).get(build_tree(
+            self.session, TxIdIndex, sorted(self.items.iteritems())))
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'txid.idx')
+        self.assertEqual(export_index(self.session, self.root, path),
+            self.session.query(PatriciaNode).count())
+        self.index = IndexFile(path)
+        self.addCleanup(self.index.close)
+        self.missing = [b'%032d' % key for key in (40, 41, 100)]
+
+    def test_header(self):
+        self.assertEqual(self.index.node_class, TxIdIndex)
+        self.assertEqual(self.index.root_hash, self.root.hash)
+        self.assertEqual(len(self.index), len(self.root))
+
+    def test_lookup(self):
+        for key, value in self.items.iteritems():
+            self.assertIn(key, self.root)
+            self.assertIn(key, self.index)
+            self.assertEqual(bytes(self.index.get_view(key)), value)
+        for key in self.missing:
+            self.assertNotIn(key, self.root)
+            self.assertNotIn(key, self.index)
+            self.assertIsNone(self.index.get_view(key))
+
+    def test_proof(self):
+        for key, value in self.items.iteritems():
+            self.assertEqual(verify_proof(self.root.hash, key,
+                self.index.proof(key), TxIdIndex), value)
+        for key in self.missing:
+            self.assertIsNone(verify_proof(self.root.hash, key,
+                self.index.proof(key), TxIdIndex))
+
+    def test_invalid_proof(self):
+        key = b'%032d' % 3
+        proof = self.index.proof(key)
+        self.assertRaises(ValueError, verify_proof,
+            self.root.hash ^ 1, key, proof, TxIdIndex)
+        self.assertRaises(ValueError, verify_proof,
+            self.root.hash, key, proof[:-1], TxIdIndex)
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+from sqlalchemy import func, select
+
+from bitcoin.script import Script
+
+from sa_bitcoin import batching, ingest, query
+from sa_bitcoin.core import Block, Checkpoint, ConnectedBlockInfo, Output, \
+    SharedScript, Transaction
+from sa_bitcoin.locking import insert_ignore
+
+from . import ChainTestCase, make_block, make_transaction, spent_outputs
+
+class TestSpent(ChainTestCase):
+    def test_connect(self):
+        ingest.ingest_blocks(self.session, self.chain, self.blocks)
+        spent = spent_outputs(self.session)
+        self.assertEqual(spent, {
+            (self.cb0.hash, 0): (self.tx1.hash, 1),
+            (self.cb0.hash, 1): (self.tx2.hash, 2),
+            (self.cb1.hash, 0): None,
+            (self.tx1.hash, 0): (self.tx2.hash, 2),
+            (self.tx1.hash, 1): None,
+            (self.cb2.hash, 0): None,
+            (self.tx2.hash, 0): None})
+
+    def test_disconnect_and_reconnect(self):
+        ingest.ingest_blocks(self.session, self.chain, self.blocks)
+        connected = spent_outputs(self.session)
+        ingest.disconnect_block(self.session, self.block_id(2))
+        spent = spent_outputs(self.session)
+        self.assertEqual(spent[(self.cb0.hash, 0)], (self.tx1.hash, 1))
+        self.assertIsNone(spent[(self.cb0.hash, 1)])
+        self.assertIsNone(spent[(self.tx1.hash, 0)])
+        ingest.connect_block(self.session, self.block_id(2), 2)
+        self.assertEqual(spent_outputs(self.session), connected)
+
+    def test_fork(self):
+        # A branch from block 0 spending cb0:0 with tx1', which has no more
+        # work than the best chain until its third block, and is stored but
+        # not connected.
+        ingest.ingest_blocks(self.session, self.chain, self.blocks)
+        connected = spent_outputs(self.session)
+        id_ = self.chain.id
+        tx1x = make_transaction(id_, [(self.cb0.hash, 0)], (30,))
+        fork = [make_block(self.blocks[0].hash, 11,
+            [make_transaction(id_, tag=b'1x'), tx1x])]
+        for nonce in (12, 13):
+            fork.append(make_block(fork[-1].hash, nonce,
+                [make_transaction(id_, tag=b'%dx' % nonce)]))
+        ids = ingest.ingest_blocks(self.session, self.chain, fork)
+        spent = spent_outputs(self.session)
+        self.assertEqual(dict((key, spent[key]) for key in connected),
+            connected)
+        self.assertIsNone(spent[(tx1x.hash, 0)])
+        self.assertEqual(query.best_tip(self.session, self.chain).one()
+            .block_id, ids[-1])
+
+        ingest.reorganize(self.session,
+            *ingest.branches(self.session, self.block_id(2), ids[-1]))
+        spent = spent_outputs(self.session)
+        self.assertEqual(spent[(self.cb0.hash, 0)], (tx1x.hash, 1))
+        self.assertIsNone(spent[(self.cb0.hash, 1)])
+        self.assertIsNone(spent[(self.tx1.hash, 0)])
+
+    def test_disconnect_keeps_values(self):
+        ingest.ingest_blocks(self.session, self.chain, self.blocks)
+        tx = Transaction.__table__
+        values = select([tx.c.hash, tx.c.input_amount, tx.c.output_amount,
+                         tx.c.fee]).order_by(tx.c.hash)
+        connected = self.session.execute(values).fetchall()
+        self.assertIn((self.tx2.hash, 65, 60, 5), connected)
+        ingest.disconnect_block(self.session, self.block_id(2))
+        self.assertEqual(self.session.execute(values).fetchall(), connected)
+
+def stored(session):
+    """The spent outputs, connected blocks and transaction values, which
+    are the same however the blocks were ingested."""
+    info, tx = ConnectedBlockInfo.__table__, Transaction.__table__
+    block = Block.__table__
+    return (spent_outputs(session),
+        sorted(tuple(row) for row in session.execute(
+            select([block.c.hash, info.c.height, info.c.aggregate_work])
+            .select_from(block.join(info, info.c.block_id == block.c.id)))),
+        sorted(tuple(row) for row in session.execute(
+            select([tx.c.hash, tx.c.input_amount, tx.c.output_amount,
+                    tx.c.fee]))))
+
+class TestCheckpoint(ChainTestCase):
+    "Blocks up to a checkpoint are bulk-written, with the same result."
+    def stored(self):
+        return stored(self.session)
+
+    def ingest(self, height):
+        self.session.add(Checkpoint(chain=self.chain, height=height,
+            hash=self.blocks[height].hash))
+        return ingest.ingest_blocks(self.session, self.chain, self.blocks)
+
+    def test_equivalent(self):
+        ingest.ingest_blocks(self.session, self.chain, self.blocks)
+        expected = self.stored()
+        for height in (0, 1, 2):
+            self.setUp()
+            ids = self.ingest(height)
+            self.assertEqual(len(ids), 3)
+            self.assertEqual(self.stored(), expected)
+
+    def test_incremental(self):
+        self.session.add(Checkpoint(chain=self.chain, height=2,
+            hash=self.blocks[2].hash))
+        ingest.ingest_blocks(self.session, self.chain, self.blocks[:2])
+        ingest.ingest_blocks(self.session, self.chain, self.blocks)
+        self.assertEqual(spent_outputs(self.session)[(self.tx1.hash, 0)],
+            (self.tx2.hash, 2))
+
+    def test_fork(self):
+        # A sibling of block 1, below the checkpoint, is rejected whether it
+        # is written along with the checkpointed block or after it, however
+        # many pages the walk back from the checkpoint takes.
+        for page_size in (1, batching.PAGE_SIZE):
+            for incremental in (False, True):
+                self.setUp()
+                self.addCleanup(setattr, batching, 'PAGE_SIZE',
+                    batching.PAGE_SIZE)
+                batching.PAGE_SIZE = page_size
+                self.session.add(Checkpoint(chain=self.chain, height=2,
+                    hash=self.blocks[2].hash))
+                sibling = make_block(self.blocks[0].hash, 11,
+                    [make_transaction(self.chain.id, tag=b'1x')])
+                if incremental:
+                    ingest.ingest_blocks(self.session, self.chain,
+                        self.blocks)
+                    blocks = [sibling]
+                else:
+                    blocks = self.blocks[:2] + [sibling] + self.blocks[2:]
+                self.assertRaises(ValueError, ingest.ingest_blocks,
+                    self.session, self.chain, blocks)
+
+    def test_mismatch(self):
+        self.session.add(Checkpoint(chain=self.chain, height=1,
+            hash=self.blocks[0].hash))
+        self.assertRaises(ValueError,
+            ingest.ingest_blocks, self.session, self.chain, self.blocks)
+
+class TestSharedScripts(ChainTestCase):
+    "Contracts of bulk-written blocks may be stored as shared scripts."
+    def setUp(self):
+        super(TestSharedScripts, self).setUp()
+        self.session.add(Checkpoint(chain=self.chain, height=1,
+            hash=self.blocks[1].hash))
+        ingest.ingest_blocks(self.session, self.chain, self.blocks,
+            share_scripts=True)
+        self.session.expire_all()
+
+    def test_contract(self):
+        outputs = self.session.query(Output).all()
+        self.assertEqual(len(outputs), 7)
+        self.assertEqual(len([x for x in outputs if x.contract_id]), 5)
+        for output in outputs:
+            self.assertEqual(output.contract, Script(b'\x51'))
+
+    def test_compare(self):
+        # Equality with a script probes the inline and shared contracts
+        # separately, rather than comparing their coalesce().
+        where = Output.contract == Script(b'\x51')
+        self.assertNotIn('coalesce', str(where).lower())
+        self.assertEqual(
+            self.session.query(Output).filter(where).count(), 7)
+        self.assertEqual(self.session.query(Output)
+            .filter(Output.contract == Script(b'\x52')).count(), 0)
+        self.assertEqual(self.session.query(Output)
+            .filter(Output.contract != Script(b'\x52')).count(), 7)
+
+    def test_store_existing(self):
+        script = SharedScript.__table__
+        ids = ingest._store_scripts(self.session, [Script(b'\x51')])
+        # A script inserted by another session after the lookup is skipped.
+        self.session.execute(insert_ignore(script),
+            [{'hash': SharedScript.digest(Script(b'\x51')),
+              'script': Script(b'\x51')}])
+        self.assertEqual(self.session.execute(
+            select([func.count()]).select_from(script)).scalar(), 1)
+        self.assertEqual(ingest._store_scripts(self.session,
+            [Script(b'\x51'), Script(b'\x52')])[Script(b'\x51')],
+            ids[Script(b'\x51')])
+
+class TestChunked(ChainTestCase):
+    """Streaming transactions in chunks, and paging the rows of the derived
+    index updates, give the same result as ingesting in one go."""
+    def test_equivalent(self):
+        ingest.ingest_blocks(self.session, self.chain, self.blocks)
+        expected = stored(self.session)
+        for checkpoint in (None, 1):
+            for page_size in (1, batching.PAGE_SIZE):
+                self.setUp()
+                self.addCleanup(setattr, batching, 'PAGE_SIZE',
+                    batching.PAGE_SIZE)
+                batching.PAGE_SIZE = page_size
+                if checkpoint is not None:
+                    self.session.add(Checkpoint(chain=self.chain,
+                        height=checkpoint, hash=self.blocks[checkpoint].hash))
+                ingest.ingest_blocks(self.session, self.chain, self.blocks,
+                    chunk_size=1)
+                self.assertEqual(stored(self.session), expected)
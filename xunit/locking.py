@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+
+import unittest2
+
+from sqlalchemy import create_engine, func, orm
+
+from sa_bitcoin import Base, ingest
+from sa_bitcoin.core import Block, BlockStats, Chain
+
+from . import ChainTestCase, make_block, make_chain, make_transaction, \
+    spent_outputs
+
+# The concurrent tests need a database with real row and advisory locks.
+URL = os.environ.get('SA_BITCOIN_POSTGRESQL_URL')
+
+class TestReorganize(ChainTestCase):
+    """Block 2 and a sibling, 2', spending only tx1:0, which has no more
+    work and is only stored."""
+    def setUp(self):
+        super(TestReorganize, self).setUp()
+        ingest.ingest_blocks(self.session, self.chain, self.blocks)
+        self.before = spent_outputs(self.session)
+        self.cb2x = make_transaction(self.chain.id, tag=b'2x')
+        self.tx2x = make_transaction(self.chain.id, [(self.tx1.hash, 0)])
+        self.sibling = make_block(self.blocks[1].hash, 3,
+            [self.cb2x, self.tx2x])
+        self.sibling_id, = ingest.ingest_blocks(self.session, self.chain,
+            [self.sibling])
+
+    def stats(self):
+        return set(block_id for block_id, in
+            self.session.query(BlockStats.block_id))
+
+    def check(self):
+        "Checks that block 2, rather than its sibling, is connected."
+        spent = spent_outputs(self.session)
+        self.assertEqual(dict((key, spent[key]) for key in self.before),
+            self.before)
+        self.assertEqual(self.stats(),
+            set([self.block_id(0), self.block_id(1), self.block_id(2)]))
+
+    def test_stored(self):
+        self.check()
+
+    def test_branches(self):
+        self.assertEqual(ingest.branches(self.session, self.block_id(2),
+            self.sibling_id), ([self.block_id(2)], {self.sibling_id: 2}))
+        self.assertEqual(ingest.branches(self.session, self.block_id(2),
+            self.block_id(2)), ([], {}))
+
+    def test_reorganize(self):
+        ingest.reorganize(self.session,
+            *ingest.branches(self.session, self.block_id(2), self.sibling_id))
+        spent = spent_outputs(self.session)
+        self.assertEqual(spent[(self.tx1.hash, 0)], (self.tx2x.hash, 2))
+        self.assertIsNone(spent[(self.cb0.hash, 1)])
+        self.assertEqual(self.stats(),
+            set([self.block_id(0), self.block_id(1), self.sibling_id]))
+
+        ingest.reorganize(self.session,
+            *ingest.branches(self.session, self.sibling_id, self.block_id(2)))
+        self.check()
+
+def make_branch(chain_id, parent, first, count, n):
+    "Returns `count` blocks from height `first`, distinct for each `n`."
+    blocks = []
+    for height in xrange(first, first + count):
+        blocks.append(make_block(parent, 1000*n + height,
+            [make_transaction(chain_id, tag=b'%d:%d' % (n, height))]))
+        parent = blocks[-1].hash
+    return blocks
+
+@unittest2.skipUnless(URL, 'SA_BITCOIN_POSTGRESQL_URL is not set')
+class TestConcurrentConnectors(unittest2.TestCase):
+    """Connectors extending branches of their own from a common trunk, while
+    others reorganize back and forth between two branches A and B, in
+    opposite directions."""
+    WORKERS = 4
+    ROUNDS = 10
+    LENGTH = 3
+
+    def setUp(self):
+        engine = create_engine(URL)
+        Base.metadata.drop_all(engine)
+        Base.metadata.create_all(engine)
+        self.addCleanup(Base.metadata.drop_all, engine)
+        self.Session = orm.sessionmaker(bind=engine)
+        session = self.Session()
+        chain = make_chain()
+        session.add(chain)
+        session.flush()
+        self.chain_id = chain.id
+        trunk = make_branch(chain.id, 0, 0, self.LENGTH, 0)
+        ingest.ingest_blocks(session, chain, trunk)
+        self.tip = trunk[-1].hash
+        # Branch 1 extends the trunk and is connected, while branch 2 is
+        # only stored. Reorganizers switch between the two in opposite
+        # directions, which the locks must serialize without deadlock.
+        self.branches = [dict(zip(ingest.ingest_blocks(session, chain,
+                make_branch(chain.id, self.tip, self.LENGTH, self.LENGTH, n)),
+                xrange(self.LENGTH, 2 * self.LENGTH)))
+            for n in (1, 2)]
+        session.commit()
+        session.close()
+        self.errors = []
+
+    def run_worker(self, target, *args):
+        session = self.Session()
+        try:
+            target(session, *args)
+        except Exception as e:
+            session.rollback()
+            self.errors.append(e)
+        finally:
+            session.close()
+
+    def connect(self, session, worker):
+        chain = session.query(Chain).get(self.chain_id)
+        blocks = make_branch(self.chain_id, self.tip, self.LENGTH,
+            self.ROUNDS, 3 + worker)
+        for block in blocks:
+            ingest.ingest_blocks(session, chain, [block])
+            session.commit()
+
+    def reorganize(self, session, worker):
+        # Every other reorganizer starts from the other branch.
+        old, new = self.branches[worker // 2 % 2], \
+            self.branches[1 - worker // 2 % 2]
+        for n in xrange(self.ROUNDS):
+            ingest.reorganize(session, old, new)
+            session.commit()
+            old, new = new, old
+
+    def test_connect_and_reorganize(self):
+        threads = [threading.Thread(target=self.run_worker,
+                args=(self.reorganize if worker % 2 else self.connect,
+                      worker))
+            for worker in xrange(2 * self.WORKERS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.errors, [])
+        session = self.Session()
+        self.assertEqual(session.query(func.count(Block.id)).scalar(),
+            3 * self.LENGTH + self.WORKERS * self.ROUNDS)
+        session.close()
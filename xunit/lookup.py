@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+from sa_bitcoin import ingest, lookup
+from sa_bitcoin.core import Block
+
+from . import ChainTestCase
+
+class TestLookup(ChainTestCase):
+    def setUp(self):
+        super(TestLookup, self).setUp()
+        ingest.ingest_blocks(self.session, self.chain, self.blocks[:2])
+
+    def test_found(self):
+        block = lookup.block_by_hash(self.session, self.chain,
+            self.blocks[1].hash)
+        self.assertEqual(block.hash, self.blocks[1].hash)
+        tx = lookup.transaction_by_hash(self.session, self.chain,
+            self.tx1.hash)
+        self.assertEqual(tx.hash, self.tx1.hash)
+        output = lookup.output_by_outpoint(self.session, self.chain,
+            self.cb0.hash, 1)
+        self.assertEqual(output.amount, 25)
+        self.assertIsNone(lookup.block_by_hash(self.session, self.chain,
+            self.blocks[2].hash))
+
+    def test_pending(self):
+        # Objects added to the session but not yet flushed are found.
+        block = Block(chain=self.chain, format=0, version=1,
+            parent_hash=self.blocks[1].hash, merkle_hash=0,
+            time=1231006600, bits=self.blocks[1].bits, nonce=7)
+        self.session.add(block)
+        self.assertIs(lookup.block_by_hash(self.session, self.chain,
+            block.hash), block)
+
+    def test_stats(self):
+        lookup.reset_stats()
+        for n in xrange(3):
+            lookup.best_tip(self.session, self.chain)
+        calls, hits, misses = lookup.stats()['best_tip']
+        self.assertEqual(calls, 3)
+        if lookup.baked is None:
+            self.assertEqual(hits + misses, 3)
+            self.assertLessEqual(misses, 1)
+        else:
+            self.assertEqual((hits, misses), (0, 0))
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+import unittest2
+
+from sqlalchemy import select
+
+from bitcoin.script import Script
+
+from sa_bitcoin import ingest
+from sa_bitcoin.core import BlockStats, Checkpoint, Transaction, Input, Output
+from sa_bitcoin.mempool import MempoolTransaction, evict_conflicts, stage
+
+from . import ChainTestCase, make_block, make_chain, make_session, \
+    make_transaction as make_chain_transaction
+from .ingest import stored
+
+def make_transaction(hash, index, amount=1):
+    return Transaction(format=0, version=1, lock_time=0, reference_height=0,
+        inputs=[Input(hash=hash, index=index, endorsement=Script(b'\x51'),
+                      sequence=0)],
+        outputs=[Output(amount=amount, contract=Script(b'\x51'))])
+
+def staged(session):
+    txn = MempoolTransaction.__table__
+    return sorted(row.hash for row in session.execute(select([txn.c.hash])))
+
+class TestStage(unittest2.TestCase):
+    def setUp(self):
+        self.session = make_session()
+        self.chain = make_chain()
+        self.session.add(self.chain)
+        self.session.flush()
+
+    def staged(self):
+        return staged(self.session)
+
+    def test_double_spend_rejected(self):
+        a, b = make_transaction(1, 0, 1), make_transaction(1, 0, 2)
+        self.assertEqual(stage(self.session, self.chain, [a, b]), [b])
+        self.assertEqual(self.staged(), [a.hash])
+        c = make_transaction(1, 0, 3)
+        self.assertEqual(stage(self.session, self.chain, [c]), [c])
+
+    def test_duplicate_in_batch(self):
+        a = make_transaction(1, 0)
+        self.assertEqual(stage(self.session, self.chain, [a, a]), [])
+        self.assertEqual(self.staged(), [a.hash])
+
+    def test_already_staged_skipped(self):
+        a = make_transaction(1, 0)
+        stage(self.session, self.chain, [a])
+        self.assertEqual(stage(self.session, self.chain, [a]), [])
+        self.assertEqual(self.staged(), [a.hash])
+
+class TestPromote(ChainTestCase):
+    """Staging tx2 before block 2 is ingested gives the same rows as
+    ingesting it directly, however the block is written."""
+    MODES = [{}, {'checkpoint': 2}, {'checkpoint': 2, 'share_scripts': True},
+             {'chunk_size': 1}, {'checkpoint': 2, 'chunk_size': 1}]
+
+    def rows(self):
+        output, stats = Output.__table__, BlockStats.__table__
+        return stored(self.session) + (
+            sorted(tuple(row) for row in self.session.execute(
+                select([output.c.amount, output.c.destination_type,
+                        output.c.contract_id == None]))),
+            sorted(tuple(row)[1:] for row in self.session.execute(
+                select([stats]))))
+
+    def ingest(self, staged, checkpoint=None, **kwargs):
+        self.setUp()
+        if checkpoint is not None:
+            self.session.add(Checkpoint(chain=self.chain, height=checkpoint,
+                hash=self.blocks[checkpoint].hash))
+        if staged:
+            ingest.ingest_blocks(self.session, self.chain, self.blocks[:2],
+                **kwargs)
+            self.assertEqual(stage(self.session, self.chain, [self.tx2]), [])
+        ingest.ingest_blocks(self.session, self.chain, self.blocks, **kwargs)
+        return self.rows()
+
+    def test_equivalent(self):
+        for mode in self.MODES:
+            expected = self.ingest(False, **mode)
+            self.assertEqual(self.ingest(True, **mode), expected)
+            self.assertEqual(staged(self.session), [])
+            self.assertEqual(self.session.query(Transaction)
+                .filter(Transaction.hash == self.tx2.hash).count(), 1)
+
+class TestEvict(ChainTestCase):
+    """Block 2 confirms tx2, which is staged with a child, and a transaction
+    double-spending the staged spend of tx1:1, which also has a child."""
+    def setUp(self):
+        super(TestEvict, self).setUp()
+        ingest.ingest_blocks(self.session, self.chain, self.blocks[:2])
+        id_ = self.chain.id
+        self.child = make_chain_transaction(id_, [(self.tx2.hash, 0)], (60,))
+        self.spend = make_chain_transaction(id_, [(self.tx1.hash, 1)], (10,))
+        self.grandchild = make_chain_transaction(id_,
+            [(self.spend.hash, 0)], (10,))
+        self.conflict = make_chain_transaction(id_, [(self.tx1.hash, 1)], (9,))
+        self.blocks[2].transactions.append(self.conflict)
+        self.staged = [self.tx2, self.child, self.spend, self.grandchild]
+
+    def test_connect(self):
+        stage(self.session, self.chain, self.staged)
+        ingest.ingest_blocks(self.session, self.chain, self.blocks)
+        self.assertEqual(staged(self.session), [self.child.hash])
+
+    def test_stored_before_staged(self):
+        # The block was stored, and tx2 confirmed, before tx2 was staged: its
+        # staged copy is dropped, but not its child.
+        block_id, = ingest.ingest_blocks(self.session, self.chain,
+            self.blocks[2:])
+        stage(self.session, self.chain, self.staged)
+        self.assertEqual(len(staged(self.session)), 4)
+        self.assertEqual(evict_conflicts(self.session, block_id), 2)
+        self.assertEqual(staged(self.session), [self.child.hash])
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+import unittest2
+
+from bitcoin.script import Script
+
+from sa_bitcoin.core import Transaction, Input, Output
+from sa_bitcoin.orderinglist import append_only
+
+def make_output(amount):
+    return Output(amount=amount, contract=Script(b'\x51'))
+
+class TestAppendOnlyOrderingList(unittest2.TestCase):
+    def setUp(self):
+        self.tx = Transaction(format=0, version=1, lock_time=0,
+            reference_height=0)
+
+    def test_append_only_offsets(self):
+        outputs = [make_output(n) for n in xrange(5)]
+        with append_only(self.tx.outputs):
+            self.tx.outputs.append(outputs[0])
+            self.tx.outputs.extend(outputs[1:])
+        self.assertEqual([x.offset for x in self.tx.outputs], range(5))
+        self.assertFalse(self.tx.outputs.append_only)
+
+    def test_append_only_keeps_existing_offsets(self):
+        self.tx.outputs.extend([make_output(0), make_output(1)])
+        with append_only(self.tx.outputs):
+            self.tx.outputs.append(make_output(2))
+        self.assertEqual([x.offset for x in self.tx.outputs], [0, 1, 2])
+
+    def test_append_only_rejects_renumbering(self):
+        self.tx.outputs.extend([make_output(0), make_output(1)])
+        with append_only(self.tx.outputs):
+            self.assertRaises(TypeError,
+                self.tx.outputs.insert, 0, make_output(2))
+            self.assertRaises(TypeError,
+                self.tx.outputs.remove, self.tx.outputs[0])
+            self.assertRaises(TypeError, self.tx.outputs.pop, 0)
+            self.assertRaises(TypeError, self.tx.outputs.__delitem__, 0)
+        self.assertEqual([x.amount for x in self.tx.outputs], [0, 1])
+        self.assertEqual([x.offset for x in self.tx.outputs], [0, 1])
+
+    def test_append_only_allows_removing_last(self):
+        self.tx.outputs.extend([make_output(0), make_output(1)])
+        with append_only(self.tx.outputs):
+            self.tx.outputs.pop()
+        self.assertEqual([x.offset for x in self.tx.outputs], [0])
+
+    def test_default_mode_renumbers(self):
+        self.tx.inputs.extend([Input(hash=n+1, index=0,
+            endorsement=Script(b''), sequence=0) for n in xrange(3)])
+        self.tx.inputs.insert(0, Input(hash=9, index=0,
+            endorsement=Script(b''), sequence=0))
+        self.assertEqual([x.offset for x in self.tx.inputs], range(4))
+        self.tx.inputs.remove(self.tx.inputs[1])
+        self.assertEqual([x.offset for x in self.tx.inputs], range(3))
+        self.assertEqual([x.hash for x in self.tx.inputs], [9, 2, 3])
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+import random
+
+import unittest2
+
+from sqlalchemy import func, select
+
+from sa_bitcoin.ledger import TxIdIndex
+from sa_bitcoin.patricia import PatriciaLink, PatriciaNode, \
+    PatriciaNodeLink, build_tree, collect_garbage, select_reachable
+
+from . import make_session
+
+def items(keys, value=b'\x00'):
+    return sorted(((b'%032d' % key), value) for key in keys)
+
+def rows(session, root_id):
+    """The rows of the nodes reachable from `root_id` by node hash, without
+    their ids. The hash of a child which is not pruned is only a cache, left
+    unset by the ORM, and is omitted too."""
+    node = PatriciaNode.__table__
+    ids = [row[0] for row in session.execute(select_reachable([root_id]))]
+    return dict((row.hash, (row.type, row.value, row.prune_value,
+            row.left_prefix,
+            row.left_hash if row.left_node_id is None else None,
+            row.right_prefix,
+            row.right_hash if row.right_node_id is None else None,
+            row.size, row.length))
+        for row in session.execute(select([node]).where(node.c.id.in_(ids))))
+
+def count(session, class_):
+    return session.execute(
+        select([func.count()]).select_from(class_.__table__)).scalar()
+
+class TestBuildTree(unittest2.TestCase):
+    def test_same_as_inserted(self):
+        session = make_session()
+        items = sorted((b'%032d' % (key * 7919 % 1000), b'%d' % key)
+                       for key in xrange(60))
+        root_id = build_tree(session, TxIdIndex, items)
+        index = TxIdIndex()
+        for key, value in items:
+            index[key] = value
+        session.add(index)
+        session.flush()
+        self.assertEqual(session.query(PatriciaNode).get(root_id).hash,
+            index.hash)
+        self.assertEqual(rows(session, root_id), rows(session, index.id))
+
+class TestBatchUpdate(unittest2.TestCase):
+    def check(self, rng, count, changes):
+        session = make_session()
+        keys = rng.sample(xrange(1000), count)
+        expected = dict(items(keys))
+        batch, single = [session.query(PatriciaNode).get(
+                build_tree(session, TxIdIndex, sorted(expected.iteritems())))
+            for n in xrange(2)]
+        updates = []
+        for n in xrange(changes):
+            choice = rng.random()
+            if expected and choice < 0.3:
+                key = rng.choice(sorted(expected))
+                updates.append((key, None))
+                del expected[key]
+            else:
+                key = (rng.choice(sorted(expected)) if choice < 0.6
+                       and expected else b'%032d' % rng.randrange(1000))
+                updates.append((key, chr(n % 256)))
+                expected[key] = chr(n % 256)
+
+        batch.batch_update(updates)
+        for key, value in updates:
+            if value is None:
+                del single[key]
+            else:
+                single[key] = value
+        session.flush()
+        session.expire_all()
+
+        hash_ = session.query(PatriciaNode).get(
+            build_tree(session, TxIdIndex, sorted(expected.iteritems()))).hash
+        for root in (batch, single):
+            self.assertEqual(root.hash, hash_)
+            self.assertEqual(len(root), len(expected))
+        for key, value in updates:
+            self.assertEqual(key in batch, key in expected)
+
+    def test_mixed(self):
+        rng = random.Random(0)
+        for trial in xrange(10):
+            self.check(rng, rng.randrange(1, 60), rng.randrange(1, 40))
+
+    def test_delete_all(self):
+        session = make_session()
+        root = session.query(PatriciaNode).get(
+            build_tree(session, TxIdIndex, items(xrange(10))))
+        root.batch_update((key, None) for key, value in items(xrange(10)))
+        session.flush()
+        self.assertEqual(len(root), 0)
+        self.assertEqual(root.hash, TxIdIndex().hash)
+
+class TestCollectGarbage(unittest2.TestCase):
+    def setUp(self):
+        self.session = make_session()
+        self.kept_id = build_tree(self.session, TxIdIndex, items(xrange(40)))
+        self.other_id = build_tree(self.session, TxIdIndex,
+            items(xrange(20, 60), b'\x01'))
+        self.session.commit()
+
+    def collect(self, root_ids, chunk_size=7):
+        deleted = sum(collect_garbage(self.session, root_ids, chunk_size))
+        self.session.commit()
+        self.session.expire_all()
+        return deleted
+
+    def reachable(self, root_ids):
+        return set(row[0] for row in
+            self.session.execute(select_reachable(root_ids)))
+
+    def test_retained(self):
+        kept = self.reachable([self.kept_id])
+        root = self.session.query(PatriciaNode).get(self.kept_id)
+        hash_ = root.hash
+        before = count(self.session, PatriciaNode)
+        self.assertEqual(self.collect([self.kept_id]), before - len(kept))
+        ids = set(row[0] for row in self.session.execute(
+            select([PatriciaNode.__table__.c.id])))
+        self.assertEqual(ids, kept)
+        root = self.session.query(PatriciaNode).get(self.kept_id)
+        self.assertEqual(root.hash, hash_)
+        self.assertEqual(len(root), 40)
+        for key, value in items(xrange(40)):
+            self.assertIn(key, root)
+
+    def test_updated_in_place(self):
+        # Updating the root in place leaves the nodes of the old version
+        # behind, referring to nodes which are still live.
+        root = self.session.query(PatriciaNode).get(self.kept_id)
+        root.batch_update(items(xrange(40, 50)) +
+            [(key, None) for key, value in items(xrange(10))])
+        self.session.commit()
+        hash_ = root.hash
+        self.collect([self.kept_id])
+        self.assertEqual(count(self.session, PatriciaNode),
+            len(self.reachable([self.kept_id])))
+        root = self.session.query(PatriciaNode).get(self.kept_id)
+        self.assertEqual(root.hash, hash_)
+        self.assertEqual(root.hash, self.session.query(PatriciaNode).get(
+            build_tree(self.session, TxIdIndex, items(xrange(10, 50)))).hash)
+
+    def test_links(self):
+        # A node link from a live node keeps its target, and the target's own
+        # node links, alive; links from garbage nodes are deleted with them.
+        link, node_link = PatriciaLink.__table__, PatriciaNodeLink.__table__
+        other = self.session.query(PatriciaNode).get(self.other_id)
+        for parent_id in (self.kept_id, self.other_id):
+            link_id = self.session.execute(link.insert().values(
+                prefix=b'\x01', node_id=self.other_id,
+                hash=other.hash)).inserted_primary_key[0]
+            self.session.execute(node_link.insert().values(
+                parent_id=parent_id, link_id=link_id))
+        self.session.commit()
+        self.collect([self.kept_id])
+        self.assertEqual(count(self.session, PatriciaLink), 2)
+        self.assertEqual(count(self.session, PatriciaNodeLink), 2)
+        other = self.session.query(PatriciaNode).get(self.other_id)
+        self.assertEqual(len(other), 40)
+
+        self.collect([self.other_id])
+        self.assertEqual(count(self.session, PatriciaLink), 1)
+        self.assertEqual(count(self.session, PatriciaNodeLink), 1)
+        self.assertIsNone(self.session.query(PatriciaNode).get(self.kept_id))
+        self.assertEqual(count(self.session, PatriciaNode),
+            len(self.reachable([self.other_id])))
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime
+
+import unittest2
+
+from bitcoin.base58 import VersionedPayload
+from bitcoin.script import Script
+
+from sa_bitcoin import ingest, query
+from sa_bitcoin.core import BlockStats, Checkpoint, Output
+
+from . import ChainTestCase, make_block, make_chain, make_session, \
+    make_transaction, pubkey_hash_contract, script_hash_contract
+
+class TestChainIsolation(unittest2.TestCase):
+    """Two chains storing the same blocks and transactions, the second with
+    one more block."""
+    def setUp(self):
+        self.session = make_session()
+        self.chains = [make_chain(),
+            make_chain(magic=b'\x0b\x11\x09\x07', genesis=b'\1' * 80,
+                       genesis_hash=1)]
+        self.session.add_all(self.chains)
+        self.session.flush()
+        self.blocks = [self.make_blocks(chain, length)
+            for chain, length in zip(self.chains, (2, 3))]
+        for chain, blocks in zip(self.chains, self.blocks):
+            ingest.ingest_blocks(self.session, chain, blocks)
+
+    def make_blocks(self, chain, length):
+        blocks, parent = [], 0
+        for height in xrange(length):
+            blocks.append(make_block(parent, height,
+                [make_transaction(chain.id, tag=b'%d' % height)]))
+            parent = blocks[-1].hash
+        return blocks
+
+    def assertChain(self, objects, chain, count=1):
+        self.assertEqual([x.chain_id for x in objects], [chain.id] * count)
+
+    def test_same_hashes(self):
+        self.assertEqual([x.hash for x in self.blocks[0]],
+            [x.hash for x in self.blocks[1][:2]])
+
+    def test_by_hash(self):
+        block, tx = self.blocks[0][1], self.blocks[0][1].transactions[0]
+        for chain in self.chains:
+            self.assertChain(
+                query.block_by_hash(self.session, chain, block.hash).all(),
+                chain)
+            self.assertChain(
+                query.transaction_by_hash(self.session, chain, tx.hash).all(),
+                chain)
+
+    def test_by_prefix(self):
+        for chain, blocks in zip(self.chains, self.blocks):
+            self.assertChain(
+                query.blocks_by_prefix(self.session, chain, '').all(),
+                chain, len(blocks))
+            self.assertChain(
+                query.transactions_by_prefix(self.session, chain, '').all(),
+                chain, len(blocks))
+            prefix = '%064x' % blocks[0].hash
+            self.assertEqual([x.hash for x in
+                query.blocks_by_prefix(self.session, chain, prefix[:3])],
+                [blocks[0].hash])
+
+    def test_best_tip(self):
+        for chain, blocks in zip(self.chains, self.blocks):
+            tip = query.best_tip(self.session, chain).one()
+            self.assertEqual(tip.chain_id, chain.id)
+            self.assertEqual(tip.height, len(blocks) - 1)
+            self.assertEqual(tip.block.hash, blocks[-1].hash)
+
+class TestOutputsByAddress(unittest2.TestCase):
+    """Block 0 pays 50 to pubkey hash A, 25 to script hash S and 10 to
+    anyone; block 1 spends A's output, paying 40 to A and 10 to pubkey hash
+    B."""
+    A, B, S = b'\xaa' * 20, b'\xbb' * 20, b'\x55' * 20
+
+    def setUp(self):
+        self.session = make_session()
+        self.chain = make_chain()
+        self.session.add(self.chain)
+        self.session.flush()
+        self.cb0 = make_transaction(self.chain.id, amounts=(50, 25, 10),
+            contracts=[pubkey_hash_contract(self.A),
+                       script_hash_contract(self.S), Script(b'\x51')])
+        self.tx1 = make_transaction(self.chain.id, [(self.cb0.hash, 0)],
+            (40, 10), contracts=[pubkey_hash_contract(self.A),
+                                 pubkey_hash_contract(self.B)])
+        self.blocks = [make_block(0, 0, [self.cb0])]
+        self.blocks.append(make_block(self.blocks[0].hash, 1,
+            [make_transaction(self.chain.id, tag=b'1'), self.tx1]))
+
+    def address(self, payload, version=0):
+        return VersionedPayload(payload, version=version).encode('base58')
+
+    def amounts(self, payload, version=0, unspent=False):
+        return sorted(output.amount for output in query.outputs_by_address(
+            self.session, self.chain, self.address(payload, version),
+            unspent=unspent))
+
+    def check(self):
+        self.assertEqual(self.amounts(self.A), [40, 50])
+        self.assertEqual(self.amounts(self.A, unspent=True), [40])
+        self.assertEqual(self.amounts(self.B), [10])
+        self.assertEqual(self.amounts(self.S, version=5), [25])
+        # The same payload under the other address version.
+        self.assertEqual(self.amounts(self.S), [])
+        self.assertEqual(self.amounts(self.A, version=5), [])
+
+    def test_ingested(self):
+        ingest.ingest_blocks(self.session, self.chain, self.blocks)
+        self.check()
+
+    def test_shared_scripts(self):
+        self.session.add(Checkpoint(chain=self.chain, height=1,
+            hash=self.blocks[1].hash))
+        ingest.ingest_blocks(self.session, self.chain, self.blocks,
+            share_scripts=True)
+        self.check()
+
+    def test_backfill(self):
+        ingest.ingest_blocks(self.session, self.chain, self.blocks)
+        output = Output.__table__
+        self.session.execute(output.update()
+            .values(destination_type=None, destination_hash=None))
+        self.assertEqual(self.amounts(self.A), [])
+        batches = list(ingest.backfill_destinations(self.session,
+            batch_size=1))
+        self.assertEqual(len(batches), 3)
+        self.assertEqual(sum(count for upto, count in batches), 4)
+        self.check()
+        # Outputs which already have a destination are left alone.
+        self.assertEqual(sum(count for upto, count in
+            ingest.backfill_destinations(self.session)), 0)
+
+class TestStats(ChainTestCase):
+    def setUp(self):
+        super(TestStats, self).setUp()
+        ingest.ingest_blocks(self.session, self.chain, self.blocks)
+
+    def heights(self, start, end):
+        return [stats.height for stats in
+            query.block_stats(self.session, self.chain, start, end)]
+
+    def test_rows(self):
+        # Coinbases are excluded; tx1 spends 50 for 50, and tx2 65 for 60.
+        fees = [0, 0, 5]
+        for height, block in enumerate(self.blocks):
+            stats = self.session.query(BlockStats).get(self.block_id(height))
+            txs = block.transactions
+            self.assertEqual((stats.chain_id, stats.height, stats.time),
+                (self.chain.id, height, datetime.utcfromtimestamp(block.time)))
+            self.assertEqual(stats.transaction_count, len(txs))
+            self.assertEqual(stats.input_count,
+                sum(len(tx.inputs) for tx in txs))
+            self.assertEqual(stats.output_count,
+                sum(len(tx.outputs) for tx in txs))
+            self.assertEqual(stats.output_amount,
+                sum(output.amount for tx in txs for output in tx.outputs))
+            self.assertEqual(stats.fee, fees[height])
+            self.assertEqual(stats.size, 80 + 1 +
+                sum(len(tx.serialize()) for tx in txs))
+
+    def test_disconnect(self):
+        ingest.disconnect_block(self.session, self.block_id(2))
+        self.assertEqual(self.heights(0, 3), [0, 1])
+        self.assertIsNone(
+            self.session.query(BlockStats).get(self.block_id(2)))
+        ingest.connect_block(self.session, self.block_id(2), 2)
+        self.assertEqual(self.heights(0, 3), [0, 1, 2])
+
+    def test_block_stats(self):
+        self.assertEqual(self.heights(1, 3), [1, 2])
+        self.assertEqual(self.heights(3, 10), [])
+
+    def test_by_height(self):
+        totals = query.stats_by_height(self.session, self.chain, 0, 3).one()
+        self.assertEqual((totals.block_count, totals.transaction_count,
+                          totals.input_count, totals.output_count,
+                          totals.output_amount, totals.fee, totals.size),
+            (3, 5, 6, 7, 285, 5, 154 + 216 + 248))
+        self.assertEqual([(row.height, row.block_count, row.fee)
+            for row in query.stats_by_height(self.session, self.chain,
+                0, 3, interval=2)], [(0, 2, 0), (2, 1, 5)])
+
+    def test_by_time(self):
+        for start, end in ((self.blocks[1].time, self.blocks[2].time + 1),
+                (datetime.utcfromtimestamp(self.blocks[1].time),
+                 datetime.utcfromtimestamp(self.blocks[2].time + 1))):
+            totals = query.stats_by_time(self.session, self.chain,
+                start, end).one()
+            self.assertEqual((totals.block_count, totals.fee), (2, 5))
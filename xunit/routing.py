@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+
+import unittest2
+
+from sqlalchemy import create_engine, event, orm
+
+from sa_bitcoin import Base, ingest
+from sa_bitcoin.core import Block
+from sa_bitcoin.routing import Router, RoutingSession
+
+from . import make_block, make_chain, make_transaction
+
+def populate(engine, lengths):
+    """Stores chains of the passed lengths, of one coinbase per block, the
+    same on every database given the same lengths."""
+    Base.metadata.create_all(engine)
+    session = orm.sessionmaker(bind=engine)()
+    for n, length in enumerate(lengths):
+        chain = make_chain(magic=b'\xf9\xbe\xb4' + chr(n),
+            genesis=chr(n) * 80, genesis_hash=n)
+        session.add(chain)
+        session.flush()
+        blocks, parent = [], 0
+        for height in xrange(length):
+            blocks.append(make_block(parent, 100*n + height,
+                [make_transaction(chain.id, tag=b'%d:%d' % (n, height))]))
+            parent = blocks[-1].hash
+        ingest.ingest_blocks(session, chain, blocks)
+    session.commit()
+    session.close()
+
+class TestRouting(unittest2.TestCase):
+    "A primary with two chains of three blocks each, and one replica."
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        # The statements reading blocks run on each engine, by name.
+        self.reads = {}
+        self.primary = self.engine('primary')
+        populate(self.primary, [3, 3])
+
+    def engine(self, name):
+        engine = create_engine('sqlite:///' +
+            os.path.join(self.directory, name + '.db'))
+        @event.listens_for(engine, 'before_cursor_execute')
+        def count(conn, cursor, statement, *args):
+            if statement.lstrip().startswith('SELECT bitcoin_block.'):
+                self.reads.setdefault(name, []).append(statement)
+        return engine
+
+    def router(self, lengths):
+        "Returns a router to a replica with chains of the passed lengths."
+        replica = self.engine('replica')
+        populate(replica, lengths)
+        return Router(self.primary, [replica], max_lag=0, interval=0)
+
+    def read(self, session):
+        "Reads the blocks, returning the name of the engine which served it."
+        self.reads.clear()
+        session.query(Block).all()
+        self.assertEqual(len(self.reads), 1)
+        return self.reads.keys()[0]
+
+    def test_caught_up(self):
+        session = RoutingSession(self.router([3, 3]))
+        self.assertEqual(self.read(session), 'replica')
+
+    def test_lagging(self):
+        session = RoutingSession(self.router([3, 2]))
+        self.assertEqual(self.read(session), 'primary')
+
+    def test_chain(self):
+        # Only the lag of the chain read counts.
+        router = self.router([3, 1])
+        self.assertEqual(self.read(RoutingSession(router, chain_id=1)),
+            'replica')
+        self.assertEqual(self.read(RoutingSession(router, chain_id=2)),
+            'primary')
+
+    def test_after_flush(self):
+        session = RoutingSession(self.router([3, 3]))
+        session.add(make_chain(magic=b'\xfa\xbf\xb5\xda', genesis=b'x' * 80,
+            genesis_hash=10))
+        session.flush()
+        self.assertEqual(self.read(session), 'primary')
+        session.rollback()
+        self.assertEqual(self.read(session), 'replica')
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+from sqlalchemy import select, type_coerce
+
+from bitcoin.hash import hash256
+from bitcoin.script import Script
+
+from sa_bitcoin import ingest
+from sa_bitcoin.core import Checkpoint, Output, SharedScript, Transaction
+from sa_bitcoin.fields.script import BitcoinScript, LazyScript
+
+from . import ChainTestCase
+
+class TestScript(ChainTestCase):
+    def setUp(self):
+        super(TestScript, self).setUp()
+        # Blocks up to the checkpoint store their contracts shared.
+        self.session.add(Checkpoint(chain=self.chain, height=1,
+            hash=self.blocks[1].hash))
+        ingest.ingest_blocks(self.session, self.chain, self.blocks,
+            share_scripts=True)
+        self.session.commit()
+        self.session.expunge_all()
+
+    def test_loaded(self):
+        for output in self.session.query(Output):
+            self.assertIsInstance(output.contract, Script)
+            self.assertEqual(hash256(output.contract).intdigest(),
+                SharedScript.digest(output.contract))
+
+    def test_serialize(self):
+        txs = self.session.query(Transaction).all()
+        self.assertEqual(len(txs), 5)
+        for tx in txs:
+            self.assertEqual(hash256(tx.serialize()).intdigest(), tx.hash)
+
+    def test_lazy(self):
+        output = Output.__table__
+        contracts = [row[0] for row in self.session.execute(select([
+            type_coerce(output.c.contract, BitcoinScript(lazy=True))])
+            .where(output.c.contract != None))]
+        self.assertEqual(len(contracts), 2)
+        for contract in contracts:
+            self.assertIsInstance(contract, LazyScript)
+            self.assertEqual(str(contract.raw), b'\x51')
+            self.assertEqual(contract, Script(b'\x51'))
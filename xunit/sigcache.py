@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+import unittest2
+
+from sqlalchemy import func, select
+
+from bitcoin.crypto import CompactSignature
+
+from sa_bitcoin.sigcache import SignatureCache, VerifiedSignature
+
+from . import make_session
+
+class RacingCache(SignatureCache):
+    "A cache whose lookups miss rows recorded by other sessions meanwhile."
+    def _lookup(self, session, keys):
+        return set()
+
+class TestSignatureCache(unittest2.TestCase):
+    def setUp(self):
+        self.session = make_session()
+        self.checks = [(n, b'\x02' + chr(n) * 32,
+                        CompactSignature(0, n + 1, n + 2)) for n in xrange(3)]
+        self.verified = []
+        def verify(sighash, public_key, signature):
+            self.verified.append(sighash)
+            return sighash != 2
+        self.verify = verify
+
+    def count(self):
+        return self.session.execute(select([func.count()])
+            .select_from(VerifiedSignature.__table__)).scalar()
+
+    def test_cached(self):
+        cache = SignatureCache(verify=self.verify)
+        self.assertEqual(cache.verify_many(self.session, self.checks),
+            [True, True, False])
+        self.assertEqual(self.count(), 2)
+        # Another process finds the verified signatures in the database.
+        other = SignatureCache(verify=self.verify)
+        del self.verified[:]
+        self.assertEqual(other.verify_many(self.session, self.checks),
+            [True, True, False])
+        self.assertEqual(self.verified, [2])
+
+    def test_race(self):
+        SignatureCache(verify=self.verify).verify_many(self.session,
+            self.checks)
+        self.assertEqual(RacingCache(verify=self.verify).verify_many(
+            self.session, self.checks), [True, True, False])
+        self.assertEqual(self.count(), 2)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+from StringIO import StringIO
+
+from sqlalchemy import select
+
+from sa_bitcoin import ingest
+from sa_bitcoin.core import Output, Transaction
+from sa_bitcoin.ledger import TxIdIndex
+from sa_bitcoin.patricia import PatriciaNode, build_tree
+from sa_bitcoin.snapshot import export_snapshot, import_snapshot
+
+from . import ChainTestCase, make_chain, make_session
+
+def unspent(session):
+    "The (hash, offset, amount, contract) of each unspent output"
+    tx, output = Transaction.__table__, Output.__table__
+    return sorted((row[0], row[1], row[2], str(row[3]))
+        for row in session.execute(
+            select([tx.c.hash, output.c.offset, output.c.amount,
+                    output.c.contract])
+            .select_from(tx.join(output, output.c.transaction_id == tx.c.id))
+            .where(output.c.spent_by_transaction_id == None)))
+
+class TestSnapshot(ChainTestCase):
+    def setUp(self):
+        super(TestSnapshot, self).setUp()
+        ingest.ingest_blocks(self.session, self.chain, self.blocks)
+        self.items = items = sorted((('%064x' % tx.hash).decode('hex'), b'\x00' * (n+1))
+            for n, tx in enumerate([self.cb0, self.cb1, self.tx1,
+                                    self.cb2, self.tx2]))
+        self.root = self.session.query(PatriciaNode).get(
+            build_tree(self.session, TxIdIndex, items))
+        self.file_ = StringIO()
+        self.counts = export_snapshot(self.session, self.chain, self.file_,
+            [self.root])
+        self.replica = make_session()
+        self.replica_chain = make_chain()
+        self.replica.add(self.replica_chain)
+        self.replica.flush()
+
+    def test_round_trip(self):
+        self.assertEqual(self.counts[0], len(unspent(self.session)))
+        roots = import_snapshot(self.replica, self.replica_chain,
+            StringIO(self.file_.getvalue()))
+        self.assertEqual(unspent(self.replica), unspent(self.session))
+        self.assertEqual(len(roots), 1)
+        root = self.replica.query(PatriciaNode).get(roots[0])
+        self.assertEqual(root.hash, self.root.hash)
+        self.assertEqual(len(root), len(self.items))
+        for key, value in self.items:
+            self.assertIn(key, root)
+
+    def test_corrupt(self):
+        data = self.file_.getvalue()
+        data = data[:40] + chr(ord(data[40]) ^ 1) + data[41:]
+        self.assertRaises(ValueError, import_snapshot,
+            self.replica, self.replica_chain, StringIO(data))
+
+    def test_other_chain(self):
+        self.replica_chain.genesis_hash = 1
+        self.assertRaises(ValueError, import_snapshot,
+            self.replica, self.replica_chain, StringIO(self.file_.getvalue()))